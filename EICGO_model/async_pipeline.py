@@ -0,0 +1,553 @@
+import os
+import json
+import io
+import asyncio
+
+import httpx
+from werkzeug.formparser import FormDataParser
+from werkzeug.http import parse_options_header
+from azure.core.credentials import AzureKeyCredential
+from azure.ai.formrecognizer import AnalysisFeature
+from azure.ai.formrecognizer.aio import DocumentAnalysisClient
+from groq import AsyncGroq
+from twilio.rest import Client as TwilioClient
+from twilio.http.async_http_client import AsyncTwilioHttpClient
+
+from journal import FLUSHER_ENV, JournalFlusher, get_journal, record_write
+from governor import get_governor, estimate_tokens, QuotaTimeout, QUOTA_RETRY_SECONDS, QUOTA_MAX_RETRIES
+from llm_cache import get_llm_cache
+from llm_batcher import BATCH_ENABLED, AsyncLLMBatcher, batch_messages, batch_max_tokens, COMPLETION_TOKENS_PER_ITEM
+from uploads import get_dedup_index, accept_photos, accept_batch_photo
+from phones import format_phone_number, is_valid_phone_number
+import receiver
+import sender
+
+# Asyncio version of the receiver.py -> sender.py -> message.py flow.
+# Azure OCR, Groq, Google Geocoding and Twilio are awaited on their async
+# clients, so one process keeps hundreds of envelopes in flight. Every
+# dependency has its own semaphore (ASYNC_*_CONCURRENCY) so a burst of uploads
+# cannot open too many connections to a provider, and every call also waits
+# for quota from the shared governor (governor.py). Posts are written through the local
+# journal like the subprocess pipeline (journal.py) and pushed to Firestore by
+# a flusher thread in this process. Work that runs out of quota (QuotaTimeout)
+# is submitted again after QUOTA_RETRY_SECONDS rather than failed.
+#
+# `app` is a plain ASGI application, e.g.:
+#   uvicorn async_pipeline:app --host 0.0.0.0 --port 5001
+# (an ASGI server is not pinned in requirements.txt; install uvicorn or hypercorn)
+
+GEOCODE_URL = "https://maps.googleapis.com/maps/api/geocode/json"
+MESSAGE_TEMPLATE = "Dear user, your post is received and is in transit. You can click on the link to track the post: https://7a8e-49-249-229-42.ngrok-free.app/Tracking?page={post_id}"
+
+CONCURRENCY = {
+    "azure": int(os.getenv("ASYNC_AZURE_CONCURRENCY", 16)),
+    "groq": int(os.getenv("ASYNC_GROQ_CONCURRENCY", 16)),
+    "geocode": int(os.getenv("ASYNC_GEOCODE_CONCURRENCY", 32)),
+    "journal": int(os.getenv("ASYNC_JOURNAL_CONCURRENCY", 8)),
+    "twilio": int(os.getenv("ASYNC_TWILIO_CONCURRENCY", 8)),
+}
+MAX_IN_FLIGHT = int(os.getenv("ASYNC_MAX_IN_FLIGHT", 500))
+MAX_UPLOAD_BYTES = int(os.getenv("ASYNC_MAX_UPLOAD_MB", 25)) * 1024 * 1024
+
+# This process drains the journal itself (see AsyncPipeline.start)
+os.environ[FLUSHER_ENV] = "server"
+
+
+class _Limit:
+    """Semaphore for one dependency that also counts active and queued calls."""
+
+    def __init__(self, size):
+        self.size = size
+        self._semaphore = asyncio.Semaphore(size)
+        self.active = 0
+        self.waiting = 0
+        self.calls = 0
+
+    async def __aenter__(self):
+        self.waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self.active += 1
+        self.calls += 1
+
+    async def __aexit__(self, *exc):
+        self.active -= 1
+        self._semaphore.release()
+
+    def metrics(self):
+        return {"limit": self.size, "active": self.active, "waiting": self.waiting, "calls": self.calls}
+
+
+class AsyncPipeline:
+    def __init__(self, concurrency=CONCURRENCY):
+        self.limits = {name: _Limit(size) for name, size in concurrency.items()}
+        self.stats = {"in_flight": 0, "accepted": 0, "completed": 0, "failed": 0, "rejected": 0, "requeued": 0}
+        self._tasks = set()
+        self.azure = self.groq = self.http = self.twilio = None
+        self.batchers = {}
+        self.flusher = None
+
+    async def start(self):
+        endpoint, key = os.getenv("AZURE_ENDPOINT"), os.getenv("AZURE_KEY")
+        if not endpoint or not key:
+            raise ValueError("Azure OCR credentials (endpoint and key) are not set in .env")
+        self.azure = DocumentAnalysisClient(endpoint=endpoint, credential=AzureKeyCredential(key))
+        self.azure_key = key
+        self.groq = AsyncGroq(api_key=os.getenv("GROQ_API_KEY"))
+        self.http = httpx.AsyncClient(timeout=10)
+        self.google_key = os.getenv("GOOGLE_API_KEY")
+        self.twilio = TwilioClient(os.getenv("TWILIO_ACCOUNT_SID"), os.getenv("TWILIO_AUTH_TOKEN"),
+                                   http_client=AsyncTwilioHttpClient())
+        self.twilio_number = os.getenv("TWILIO_PHONE_NUMBER")
+        if BATCH_ENABLED:
+            # Concurrent envelopes in this process share LLM requests (see llm_batcher.py);
+            # /status reports them under llm_batches
+            for model, prompt in ((receiver.RECEIVER_MODEL, receiver.RECEIVER_PROMPT),
+                                  (sender.SENDER_MODEL, sender.SENDER_PROMPT)):
+                self.batchers[(model, prompt)] = AsyncLLMBatcher(
+                    lambda texts, model=model, prompt=prompt: self._send_batch(texts, model, prompt),
+                    lambda text, model=model, prompt=prompt: self._extract_uncached(text, model, prompt))
+        self.flusher = JournalFlusher(get_journal(), lambda: receiver.db).start()
+        print(f"[{os.getpid()}] Async pipeline started with limits {CONCURRENCY}")
+
+    async def close(self):
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        await self.azure.close()
+        await self.groq.close()
+        await self.http.aclose()
+        await self.twilio.http_client.close()
+        self.flusher.stop()
+
+    def submit(self, coro, retry=False):
+        """Run coro in the background; returns False when MAX_IN_FLIGHT envelopes are already running."""
+        # A retry was accepted once already, so it is never turned away
+        if not retry and self.stats["in_flight"] >= MAX_IN_FLIGHT:
+            coro.close()
+            self.stats["rejected"] += 1
+            return False
+        self.stats["accepted"] += 1
+        self.stats["in_flight"] += 1
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._done)
+        return True
+
+    def requeue(self, attempt, job, *args):
+        """Submit job(*args, attempt=attempt + 1) after QUOTA_RETRY_SECONDS; returns False once retries run out."""
+        if attempt >= QUOTA_MAX_RETRIES:
+            return False
+        print(f"Out of quota, retrying in {QUOTA_RETRY_SECONDS:.0f}s ({attempt + 1}/{QUOTA_MAX_RETRIES})")
+        self.stats["requeued"] += 1
+        asyncio.get_running_loop().call_later(
+            QUOTA_RETRY_SECONDS, lambda: self.submit(job(*args, attempt=attempt + 1), retry=True))
+        return True
+
+    def _done(self, task):
+        self._tasks.discard(task)
+        self.stats["in_flight"] -= 1
+        if task.cancelled() or task.exception() is not None or not task.result():
+            self.stats["failed"] += 1
+        else:
+            self.stats["completed"] += 1
+
+    async def metrics(self):
+        # The journal, governor and cache metrics are SQLite queries; keep them off the event loop
+        journal, quota, llm_cache = await asyncio.gather(asyncio.to_thread(get_journal().metrics),
+                                                         asyncio.to_thread(get_governor().metrics),
+                                                         asyncio.to_thread(get_llm_cache().metrics))
+        return {**self.stats, "limits": {name: limit.metrics() for name, limit in self.limits.items()},
+                "journal": journal, "quota": quota, "llm_cache": llm_cache,
+                "llm_batches": {model: batcher.metrics() for (model, _), batcher in self.batchers.items()}}
+
+    # Function to OCR a photo with Azure prebuilt-read
+    async def ocr(self, photo_path, features=None):
+        data = await asyncio.to_thread(_read_file, photo_path)
+        async def analyze():
+            poller = await self.azure.begin_analyze_document("prebuilt-read", document=data, features=features)
+            return await poller.result()
+
+        async with self.limits["azure"]:
+            return await get_governor().call_async("azure", analyze, key=self.azure_key)
+
+    # Function to extract Name/PhoneNumber/Address/Pincode from OCR text, or None
+    async def extract(self, text, model, prompt):
+        cached = await asyncio.to_thread(get_llm_cache().get, text, model, prompt)
+        if cached is not None:
+            return cached
+        batcher = self.batchers.get((model, prompt))
+        if batcher is not None:
+            result = await batcher.extract(text)
+        else:
+            result = await self._extract_uncached(text, model, prompt)
+        await asyncio.to_thread(get_llm_cache().put, text, model, prompt, result)
+        return result
+
+    async def _send_batch(self, texts, model, prompt):
+        messages = batch_messages(prompt, texts)
+        tokens = estimate_tokens(messages[0]["content"], messages[1]["content"],
+                                 completion=COMPLETION_TOKENS_PER_ITEM * len(texts))
+        async with self.limits["groq"]:
+            completion = await get_governor().call_async("groq", lambda: self.groq.chat.completions.create(
+                model=model,
+                messages=messages,
+                temperature=1,
+                max_tokens=batch_max_tokens(len(texts)),
+                top_p=1,
+            ), key=f"{self.groq.api_key}:{model}", cost={"requests": 1, "tokens": tokens})
+        return completion.choices[0].message.content or ""
+
+    async def _extract_uncached(self, text, model, prompt):
+        try:
+            async with self.limits["groq"]:
+                completion = await get_governor().call_async("groq", lambda: self.groq.chat.completions.create(
+                    model=model,
+                    messages=[{"role": "system", "content": prompt}, {"role": "user", "content": text}],
+                    temperature=1,
+                    max_tokens=1024,
+                    top_p=1,
+                ), key=f"{self.groq.api_key}:{model}", cost={"requests": 1, "tokens": estimate_tokens(prompt, text)})
+            return receiver.parse_address_json(completion.choices[0].message.content or "")
+        except QuotaTimeout:
+            raise  # Not a failed extraction: the envelope is requeued
+        except json.JSONDecodeError as e:
+            print("Error decoding JSON(llama):", e)
+        except Exception as e:
+            print("An error occurred(llama):", e)
+        return None
+
+    # Function to geocode an address, falling back to the gazetteer like receiver.geocode_address
+    async def geocode(self, addr, pincode):
+        address = f"{addr or ''} {pincode or ''}".strip()
+        try:
+            async with self.limits["geocode"]:
+                response = await get_governor().call_async(
+                    "google", lambda: self.http.get(GEOCODE_URL, params={"address": address, "key": self.google_key}),
+                    key=self.google_key, throttled=receiver.geocode_throttled)
+        except httpx.HTTPError as e:
+            return receiver.geocode_fallback(pincode, f"Geocoding failed: {e}")
+        if response.status_code == 200:
+            output = receiver.parse_geocode_response(response.json())
+            if output is not None:
+                return output
+        return receiver.geocode_fallback(pincode, f"Geocoding failed: {response.status_code}")
+
+    # Function to geocode an address and pick its nearest post office
+    async def resolve_location(self, addr, pincode):
+        geocoded_info = await self.geocode(addr, pincode)
+        if "error" in geocoded_info:
+            return geocoded_info, geocoded_info
+        # The first geocode already has the coordinates; receiver.py geocodes the formatted address again
+        office_pincode = geocoded_info.get("pincode") or pincode
+        nearest_post_office = await asyncio.to_thread(
+            receiver.nearest_post_office_to, geocoded_info["latitude"], geocoded_info["longitude"], office_pincode)
+        return geocoded_info, nearest_post_office
+
+    # Function to pick the nearest post office from a locality + pincode guess
+    async def nearest_office(self, locality, pincode):
+        geocoded_info = await self.geocode(locality, pincode)
+        if "error" in geocoded_info:
+            return geocoded_info
+        return await asyncio.to_thread(
+            receiver.nearest_post_office_to, geocoded_info["latitude"], geocoded_info["longitude"], pincode)
+
+    # Function to turn the OCR text of one address into a stored, labelled post
+    async def process_address(self, text):
+        speculative, guess_pincode = None, None
+        if receiver.SPECULATIVE_GEOCODE:
+            guess_locality, guess_pincode = receiver.guess_locality_and_pincode(text)
+            if guess_pincode:
+                speculative = asyncio.create_task(self.nearest_office(guess_locality, guess_pincode))
+
+        details = await self.extract(text, receiver.RECEIVER_MODEL, receiver.RECEIVER_PROMPT)
+        if details is None:
+            if speculative is not None:
+                speculative.cancel()
+            raise ValueError("Could not extract address details")
+        receiver_pincode = receiver.validate_pincode(details.get("Pincode"))
+
+        nearest_post_office = None
+        if speculative is not None:
+            if receiver.normalise_pincode(receiver_pincode) == guess_pincode:
+                try:
+                    nearest_post_office = await speculative
+                except Exception as e:
+                    print(f"Speculative geocode failed: {e}")
+                if nearest_post_office is not None and "error" in nearest_post_office:
+                    nearest_post_office = None
+            else:
+                speculative.cancel()
+                print(f"Speculative geocode discarded: guessed {guess_pincode}, LLM said {receiver_pincode}")
+        if nearest_post_office is None:
+            geocoded_info, nearest_post_office = await self.resolve_location(details.get("Address"), receiver_pincode)
+        else:
+            # The guess only picks the office; the stored geocode is the full extracted address
+            geocoded_info = await self.geocode(details.get("Address"), receiver_pincode)
+
+        post_id = await asyncio.to_thread(receiver.generate_unique_post_id)
+        data = receiver.build_receiver_post(post_id, details.get("Name"), details.get("PhoneNumber"),
+                                            details.get("Address"), receiver_pincode, geocoded_info,
+                                            nearest_post_office)
+        await self.journal("receiver_post", post_id, data)
+        await asyncio.to_thread(receiver.generate_qr_code, receiver.qr_link_for(post_id),
+                                nearest_post_office.get("pincode", "Unknown"),
+                                nearest_post_office.get("name", "Unknown"), f"{post_id}.png")
+        return data
+
+    # Function to read the sender's details from the back of the envelope
+    async def process_sender(self, photo_path):
+        result = await self.ocr(photo_path)
+        text = " ".join(line.content for page in result.pages for line in page.lines).strip()
+        if not text:
+            print("Error: Failed to extract text from the sender photo.")
+            return None
+        return await self.extract(text, sender.SENDER_MODEL, sender.SENDER_PROMPT)
+
+    async def journal(self, kind, post_id, data):
+        async with self.limits["journal"]:
+            await asyncio.to_thread(record_write, receiver.db, kind, post_id, data)
+
+    async def notify(self, post_id, receiver_phone, sender_phone=None):
+        body = MESSAGE_TEMPLATE.format(post_id=post_id)
+        sends = []
+        for role, raw_phone in (("receiver", receiver_phone), ("sender", sender_phone)):
+            phone = format_phone_number(raw_phone)
+            if not is_valid_phone_number(phone):
+                print(f"Skipping message to {role} due to invalid phone number: {phone}")
+                continue
+            sends.append(self._send_sms(role, phone, body))
+        await asyncio.gather(*sends)
+
+    async def _send_sms(self, role, phone, body):
+        try:
+            async with self.limits["twilio"]:
+                message = await get_governor().call_async(
+                    "twilio", lambda: self.twilio.messages.create_async(to=phone, from_=self.twilio_number, body=body),
+                    key=self.twilio_number)
+            print(f"Message sent to {role}: {phone}, SID: {message.sid}")
+        except Exception as e:
+            print(f"Error sending message to {role} {phone}: {e}")
+
+    async def process_envelope(self, front_path, rear_path=None, dedup_key=None, attempt=0):
+        """Receiver -> sender -> notify for one envelope; returns the post_id or None."""
+        post_id = None
+        requeued = False
+        # The back of the envelope does not depend on the front until it is stored
+        sender_task = asyncio.create_task(self.process_sender(rear_path)) if rear_path else None
+        try:
+            result = await self.ocr(front_path, features=[AnalysisFeature.LANGUAGES])
+            text = "\n".join(line.content for page in result.pages for line in page.lines).strip()
+            data = await self.process_address(text)
+            post_id = data["receiver_details"]["post_id"]
+
+            sender_details = None
+            if sender_task is not None:
+                try:
+                    sender_details = await sender_task
+                except QuotaTimeout as e:
+                    print(f"Out of quota for sender photo of post_id={post_id}: {e}")
+                    if not self.requeue(attempt, self.attach_sender, post_id, rear_path):
+                        print(f"Gave up on sender photo {rear_path}")
+                except Exception as e:
+                    print(f"Error processing sender photo: {e}")
+                if sender_details is not None:
+                    await self.journal("sender_details", post_id, sender_details)
+
+            await self.notify(post_id, data["receiver_details"].get("phone_number"),
+                              (sender_details or {}).get("PhoneNumber"))
+            print(f"Photo processing completed for post_id={post_id}")
+        except QuotaTimeout as e:
+            # Nothing was stored yet, so the whole envelope goes round again
+            print(f"Out of quota processing {front_path}: {e}")
+            if sender_task is not None:
+                sender_task.cancel()
+            requeued = self.requeue(attempt, self.process_envelope, front_path, rear_path, dedup_key)
+        except Exception as e:
+            print(f"Error in async processing of {front_path}: {e}")
+            if sender_task is not None:
+                sender_task.cancel()
+        finally:
+            # A requeued envelope keeps its dedup entry pending until the retry finishes
+            if dedup_key and not requeued:
+                if post_id:
+                    await asyncio.to_thread(get_dedup_index().assign, dedup_key, post_id)
+                else:
+                    await asyncio.to_thread(get_dedup_index().discard, dedup_key)
+        return post_id
+
+    async def attach_sender(self, post_id, rear_path, attempt=0):
+        """Sender step of a stored post whose sender photo ran out of quota earlier."""
+        try:
+            sender_details = await self.process_sender(rear_path)
+        except QuotaTimeout as e:
+            print(f"Out of quota for sender photo of post_id={post_id}: {e}")
+            if not self.requeue(attempt, self.attach_sender, post_id, rear_path):
+                print(f"Gave up on sender photo {rear_path}")
+            return None
+        if sender_details is None:
+            return None
+        await self.journal("sender_details", post_id, sender_details)
+        await self.notify(post_id, None, sender_details.get("PhoneNumber"))
+        return post_id
+
+    async def process_batch(self, photo_path, attempt=0):
+        """One frame, several envelopes: OCR once and create one post per address block."""
+        try:
+            result = await self.ocr(photo_path)
+        except QuotaTimeout as e:
+            print(f"Out of quota for batch photo {photo_path}: {e}")
+            if not self.requeue(attempt, self.process_batch, photo_path):
+                print(f"Gave up on batch photo {photo_path}")
+            return []
+        except Exception as e:
+            print(f"Error in async batch processing of {photo_path}: {e}")
+            return []
+        blocks = await asyncio.to_thread(receiver.cluster_address_blocks, result)
+        print(f"Found {len(blocks)} address blocks in {photo_path}")
+        return await self.process_blocks(blocks)
+
+    async def process_blocks(self, blocks, attempt=0):
+        """Create and notify one post per address block; blocks that ran out of quota are requeued."""
+        posts = await asyncio.gather(*(self.process_address(block) for block in blocks), return_exceptions=True)
+        post_ids = []
+        out_of_quota = []
+        for block, data in zip(blocks, posts):
+            if isinstance(data, QuotaTimeout):
+                out_of_quota.append(block)
+                continue
+            if isinstance(data, Exception):
+                print(f"Error processing address block {block!r}: {data}")
+                continue
+            post_ids.append(data["receiver_details"]["post_id"])
+        if out_of_quota and not self.requeue(attempt, self.process_blocks, out_of_quota):
+            print(f"Gave up on {len(out_of_quota)} address blocks still out of quota")
+        await asyncio.gather(*(self.notify(data["receiver_details"]["post_id"], data["receiver_details"].get("phone_number"))
+                               for data in posts if not isinstance(data, Exception)))
+        return post_ids
+
+
+def _read_file(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+# Function to parse a multipart/form-data body into werkzeug (form, files), as Flask would
+def parse_form(content_type, body):
+    mimetype, options = parse_options_header(content_type.decode("latin-1"))
+    _, form, files = FormDataParser(max_content_length=MAX_UPLOAD_BYTES).parse(
+        io.BytesIO(body), mimetype, len(body), options)
+    return form, files
+
+
+pipeline = AsyncPipeline()
+
+
+async def upload(form, files):
+    status, response, photos, dedup_key = await asyncio.to_thread(accept_photos, form, files)
+    if "1" in photos:
+        if not pipeline.submit(pipeline.process_envelope(photos["1"], photos.get("2"), dedup_key)):
+            if dedup_key:
+                await asyncio.to_thread(get_dedup_index().discard, dedup_key)
+            return 503, {"error": "Too many envelopes in flight, retry shortly", "uploads": response["uploads"]}
+    return status, response
+
+
+async def upload_batch(form, files):
+    status, response, photo_path = await asyncio.to_thread(accept_batch_photo, files)
+    if photo_path and not pipeline.submit(pipeline.process_batch(photo_path)):
+        return 503, {"error": "Too many envelopes in flight, retry shortly"}
+    return status, response
+
+
+ROUTES = {
+    ("POST", "/upload"): upload,
+    ("POST", "/upload_batch"): upload_batch,
+}
+
+
+class ClientDisconnected(Exception):
+    pass
+
+
+# Function to read the request body; None if it is larger than MAX_UPLOAD_BYTES
+async def _read_body(receive):
+    body = bytearray()
+    while True:
+        event = await receive()
+        if event["type"] == "http.disconnect":
+            raise ClientDisconnected()
+        body.extend(event.get("body", b""))
+        if len(body) > MAX_UPLOAD_BYTES:
+            return None
+        if not event.get("more_body"):
+            return bytes(body)
+
+
+async def _send_json(send, status, payload):
+    body = json.dumps(payload).encode("utf-8")
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())]})
+    await send({"type": "http.response.body", "body": body})
+
+
+async def _lifespan(receive, send):
+    while True:
+        event = await receive()
+        if event["type"] == "lifespan.startup":
+            try:
+                await pipeline.start()
+            except Exception as e:
+                await send({"type": "lifespan.startup.failed", "message": str(e)})
+                return
+            await send({"type": "lifespan.startup.complete"})
+        elif event["type"] == "lifespan.shutdown":
+            await pipeline.close()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+# ASGI entry point
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await _lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+
+    method, path = scope["method"], scope["path"]
+    if method == "GET" and path == "/":
+        await _send_json(send, 200, {"message": "Async pipeline is running! Use the /upload endpoint to upload photos."})
+        return
+    if method == "GET" and path == "/status":
+        await _send_json(send, 200, await pipeline.metrics())
+        return
+
+    handler = ROUTES.get((method, path))
+    if handler is None:
+        await _send_json(send, 404, {"error": "Not found"})
+        return
+
+    headers = dict(scope["headers"])
+    content_type = headers.get(b"content-type", b"")
+    if not content_type.startswith(b"multipart/form-data"):
+        await _send_json(send, 400, {"error": "Expected multipart/form-data"})
+        return
+    try:
+        body = await _read_body(receive)
+    except ClientDisconnected:
+        # Nobody is left to answer; the upload is simply dropped
+        print(f"Client disconnected during {method} {path}")
+        return
+    if body is None:
+        await _send_json(send, 413, {"error": f"Upload larger than {MAX_UPLOAD_BYTES} bytes"})
+        return
+
+    try:
+        form, files = await asyncio.to_thread(parse_form, content_type, body)
+        status, payload = await handler(form, files)
+    except Exception as e:
+        print(f"Error handling {method} {path}: {e}")
+        status, payload = 500, {"error": str(e)}
+    await _send_json(send, status, payload)
@@ -0,0 +1,250 @@
+import os
+import time
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+from PIL import Image, ImageOps
+
+# Perceptual-hash index over recent uploads in scanned_posts/.
+# Each entry is a 64-bit dHash, the upload time and the post_id it produced.
+# Every process keeps the entries inside the lookup window in parallel numpy
+# arrays, so a lookup is one vectorised XOR/popcount over memory.
+#
+# The shared copy is an append-only SQLite log of add/assign/discard events so
+# that every gunicorn worker sees the same index: a process only reads the
+# events after the last one it applied, and check_and_add runs inside one
+# write transaction so two workers cannot both register the same envelope.
+
+DEDUP_WINDOW_SECONDS = int(os.getenv("DEDUP_WINDOW_SECONDS", 3 * 24 * 3600))
+DEDUP_MAX_DISTANCE = int(os.getenv("DEDUP_MAX_DISTANCE", 6))
+DEDUP_INDEX_PATH = os.getenv("DEDUP_INDEX_PATH", os.path.join("scanned_posts", ".phash_index.db"))
+
+PENDING = ""  # post_id placeholder while receiver.py is still running
+PENDING_TTL_SECONDS = 15 * 60  # Pending entries older than this belong to a dead worker
+
+_SIGN_BIT = 1 << 63
+_HASH_MASK = (1 << 64) - 1
+
+
+# Function to compute a 64-bit difference hash (dHash) of an image
+def dhash(photo_path, hash_size=8):
+    with Image.open(photo_path) as img:
+        img = ImageOps.exif_transpose(img)  # Phone photos carry their rotation in EXIF
+        gray = img.convert("L").resize((hash_size + 1, hash_size), Image.LANCZOS)
+
+    pixels = np.asarray(gray, dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return int(np.packbits(bits).view(">u8")[0])
+
+
+# SQLite integers are signed 64-bit
+def _to_sql(photo_hash):
+    return photo_hash - (1 << 64) if photo_hash >= _SIGN_BIT else photo_hash
+
+
+def _from_sql(value):
+    return value & _HASH_MASK
+
+
+class PerceptualIndex:
+    def __init__(self, path=DEDUP_INDEX_PATH, window_seconds=DEDUP_WINDOW_SECONDS,
+                 max_distance=DEDUP_MAX_DISTANCE, capacity=1024):
+        self.path = path
+        self.window_seconds = window_seconds
+        self.max_distance = max_distance
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._last_seq = 0
+        # Ordered by scan id (the seq of its add event)
+        self._scans = np.zeros(capacity, dtype=np.int64)
+        self._hashes = np.zeros(capacity, dtype=np.uint64)
+        self._times = np.zeros(capacity, dtype=np.float64)
+        self._post_ids = np.full(capacity, PENDING, dtype="U16")
+        self._size = 0
+        # upload key -> scan id of scans this process is still processing
+        self._pending = {}
+        conn = self._connect()
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS events (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                scan INTEGER,
+                hash INTEGER,
+                added_at REAL NOT NULL,
+                post_id TEXT
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS events_added_at ON events (added_at)")
+
+    def __len__(self):
+        with self._locked() as conn:
+            self._sync(conn)
+            return self._size
+
+    def _connect(self):
+        # One connection per thread, and never one inherited across a gunicorn fork
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @contextmanager
+    def _locked(self, write=False):
+        with self._lock:
+            conn = self._connect()
+            if not write:
+                yield conn
+                return
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    def _sync(self, conn):
+        # Apply the events other processes logged since we last looked
+        rows = conn.execute(
+            "SELECT seq, kind, scan, hash, added_at, post_id FROM events WHERE seq > ? ORDER BY seq",
+            (self._last_seq,)).fetchall()
+        for seq, kind, scan, photo_hash, added_at, post_id in rows:
+            if kind == "add":
+                self._append(seq, _from_sql(photo_hash), added_at)
+            elif kind == "assign":
+                slot = self._find_slot(scan)
+                if slot is not None:
+                    self._post_ids[slot] = post_id
+            elif kind == "discard":
+                slot = self._find_slot(scan)
+                if slot is not None:
+                    self._remove(slot)
+            self._last_seq = seq
+
+    def _grow(self, needed):
+        capacity = len(self._hashes)
+        if needed <= capacity:
+            return
+        capacity = max(needed, capacity * 2)
+        for name in ("_scans", "_hashes", "_times", "_post_ids"):
+            old = getattr(self, name)
+            new = np.full(capacity, PENDING, dtype=old.dtype) if name == "_post_ids" else np.zeros(capacity, dtype=old.dtype)
+            new[:self._size] = old[:self._size]
+            setattr(self, name, new)
+
+    def _append(self, scan, photo_hash, added_at):
+        if self._size >= len(self._hashes):
+            self._compact(time.time())
+        self._grow(self._size + 1)
+        slot = self._size
+        self._scans[slot] = scan
+        self._hashes[slot] = np.uint64(photo_hash)
+        self._times[slot] = added_at
+        self._post_ids[slot] = PENDING
+        self._size += 1
+
+    def _remove(self, slot):
+        n = self._size
+        for array in (self._scans, self._hashes, self._times, self._post_ids):
+            array[slot:n - 1] = array[slot + 1:n]
+        self._post_ids[n - 1] = PENDING
+        self._size = n - 1
+
+    def _compact(self, now):
+        # Drop everything older than the window from memory
+        n = self._size
+        keep = np.flatnonzero(self._times[:n] >= now - self.window_seconds)
+        if len(keep) == n:
+            return
+        m = len(keep)
+        for array in (self._scans, self._hashes, self._times, self._post_ids):
+            array[:m] = array[keep]
+        self._post_ids[m:n] = PENDING
+        self._size = m
+
+    def _find_slot(self, scan):
+        n = self._size
+        slot = int(np.searchsorted(self._scans[:n], scan))
+        if slot < n and self._scans[slot] == scan:
+            return slot
+        return None
+
+    def _lookup(self, photo_hash, now):
+        n = self._size
+        post_ids = self._post_ids[:n]
+        times = self._times[:n]
+        # Pending entries this old belonged to a worker that died mid-scan
+        live = np.flatnonzero((times >= now - self.window_seconds)
+                              & ((post_ids != PENDING) | (times >= now - PENDING_TTL_SECONDS)))
+        if len(live) == 0:
+            return None
+        distances = np.bitwise_count(self._hashes[live] ^ np.uint64(photo_hash))
+        best = int(np.argmin(distances))
+        if distances[best] > self.max_distance:
+            return None
+        return str(post_ids[live[best]]), int(distances[best])
+
+    def _add(self, conn, photo_hash, key, now):
+        # Old events are never looked at again; the added_at index keeps this cheap
+        conn.execute("DELETE FROM events WHERE added_at < ?", (now - self.window_seconds,))
+        scan = conn.execute("INSERT INTO events (kind, hash, added_at) VALUES ('add', ?, ?)",
+                            (_to_sql(photo_hash), now)).lastrowid
+        self._sync(conn)
+        self._pending[key] = scan
+
+    def _log(self, key, kind, post_id=None):
+        # Record an assign/discard for the scan registered under key
+        try:
+            with self._locked(write=True) as conn:
+                scan = self._pending.pop(key, None)
+                if scan is None:
+                    return
+                self._sync(conn)
+                slot = self._find_slot(scan)
+                if slot is None:
+                    return
+                conn.execute("INSERT INTO events (kind, scan, added_at, post_id) VALUES (?, ?, ?, ?)",
+                             (kind, scan, float(self._times[slot]), post_id))
+                self._sync(conn)
+        except sqlite3.Error as e:
+            print(f"Error updating perceptual index {self.path}: {e}")
+
+    def lookup(self, photo_hash, now=None):
+        """Return (post_id, distance) of the closest recent scan, or None."""
+        with self._locked() as conn:
+            self._sync(conn)
+            return self._lookup(photo_hash, time.time() if now is None else now)
+
+    def add(self, photo_hash, key, now=None):
+        with self._locked(write=True) as conn:
+            self._sync(conn)
+            self._add(conn, photo_hash, key, time.time() if now is None else now)
+
+    def assign(self, key, post_id):
+        self._log(key, "assign", str(post_id))
+
+    def discard(self, key):
+        # Processing failed: drop the entry so the envelope can be rescanned
+        self._log(key, "discard")
+
+    def check_and_add(self, photo_path, key=None, now=None):
+        """Hash photo_path; return the matching (post_id, distance) or register it and return None.
+
+        A post_id of PENDING means the matching scan is still being processed.
+        """
+        photo_hash = dhash(photo_path)
+        now = time.time() if now is None else now
+        with self._locked(write=True) as conn:
+            self._sync(conn)
+            match = self._lookup(photo_hash, now)
+            if match is None:
+                self._add(conn, photo_hash, key or photo_path, now)
+        return match
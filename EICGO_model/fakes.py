@@ -0,0 +1,333 @@
+import os
+import copy
+import json
+import time
+import random
+import itertools
+import threading
+import subprocess
+
+from firebase_admin import firestore
+from google.api_core.exceptions import AlreadyExists
+
+# In-memory stand-ins for Firestore, S3 and the receiver/sender/message scripts.
+# server.py switches to these when DAKMADAD_FAKE_BACKENDS=1 so loadtest.py can
+# measure the web tier without touching Google, AWS, Azure, Groq or Twilio.
+# FAKE_FIRESTORE_LATENCY_MS / FAKE_PIPELINE_SECONDS simulate network time.
+
+FIRESTORE_LATENCY = float(os.getenv("FAKE_FIRESTORE_LATENCY_MS", 20)) / 1000
+PIPELINE_SECONDS = float(os.getenv("FAKE_PIPELINE_SECONDS", 0.5))
+SEEDED_POSTS = int(os.getenv("FAKE_SEEDED_POSTS", 1000))
+
+
+def _simulate_latency():
+    if FIRESTORE_LATENCY > 0:
+        time.sleep(FIRESTORE_LATENCY)
+
+
+class FakeSnapshot:
+    def __init__(self, doc_id, data):
+        self.id = doc_id
+        self._data = data
+
+    @property
+    def exists(self):
+        return self._data is not None
+
+    def to_dict(self):
+        return copy.deepcopy(self._data) if self._data is not None else None
+
+
+class FakeDocument:
+    def __init__(self, store, path):
+        self._store = store
+        self._path = path
+        self.id = path[-1]
+
+    def collection(self, name):
+        return FakeCollection(self._store, self._path + (name,))
+
+    def get(self):
+        _simulate_latency()
+        with self._store.lock:
+            return FakeSnapshot(self.id, self._store.docs.get(self._path))
+
+    def set(self, data, merge=False):
+        _simulate_latency()
+        with self._store.lock:
+            current = self._store.docs.get(self._path) if merge else None
+            self._store.docs[self._path] = _merge(current or {}, data)
+
+    def update(self, data):
+        _simulate_latency()
+        with self._store.lock:
+            if self._path not in self._store.docs:
+                raise KeyError(f"No document to update: {'/'.join(self._path)}")
+            self._store.docs[self._path] = _merge(self._store.docs[self._path], _expand_field_paths(data))
+
+    def delete(self):
+        _simulate_latency()
+        with self._store.lock:
+            self._store.docs.pop(self._path, None)
+
+
+class FakeCollection:
+    def __init__(self, store, path):
+        self._store = store
+        self._path = path
+
+    def document(self, doc_id):
+        return FakeDocument(self._store, self._path + (str(doc_id),))
+
+    def where(self, filter):
+        return FakeQuery(self, [filter])
+
+    def order_by(self, field, direction="ASCENDING"):
+        return FakeQuery(self, [], order=(field, direction))
+
+    def stream(self):
+        _simulate_latency()
+        with self._store.lock:
+            items = [(path[-1], copy.deepcopy(data)) for path, data in self._store.docs.items()
+                     if len(path) == len(self._path) + 1 and path[:-1] == self._path]
+        return [FakeSnapshot(doc_id, data) for doc_id, data in items]
+
+
+class FakeQuery:
+    OPERATORS = {
+        "==": lambda a, b: a == b,
+        "<": lambda a, b: a is not None and a < b,
+        "<=": lambda a, b: a is not None and a <= b,
+        ">": lambda a, b: a is not None and a > b,
+        ">=": lambda a, b: a is not None and a >= b,
+    }
+
+    def __init__(self, collection, filters, order=None, limit=None, start_after=None):
+        self._collection = collection
+        self._filters = filters
+        self._order = order
+        self._limit = limit
+        self._start_after = start_after
+
+    def _copy(self, **changes):
+        state = dict(filters=self._filters, order=self._order, limit=self._limit, start_after=self._start_after)
+        state.update(changes)
+        return FakeQuery(self._collection, **state)
+
+    def where(self, filter):
+        return self._copy(filters=self._filters + [filter])
+
+    def order_by(self, field, direction="ASCENDING"):
+        return self._copy(order=(field, direction))
+
+    def limit(self, count):
+        return self._copy(limit=count)
+
+    def start_after(self, values):
+        return self._copy(start_after=values)
+
+    def stream(self):
+        snapshots = [s for s in self._collection.stream()
+                     if all(self.OPERATORS[f.op_string](_get_path(s._data, f.field_path), f.value) for f in self._filters)]
+        if self._order:
+            field, direction = self._order
+            snapshots.sort(key=lambda s: _get_path(s._data, field), reverse=direction == "DESCENDING")
+            if self._start_after is not None:
+                after = self._start_after.get(field) if isinstance(self._start_after, dict) else self._start_after
+                before = direction == "DESCENDING"
+                snapshots = [s for s in snapshots if (_get_path(s._data, field) < after if before else _get_path(s._data, field) > after)]
+        return snapshots[:self._limit] if self._limit is not None else snapshots
+
+
+def _get_path(data, path):
+    for part in path.split("."):
+        if not isinstance(data, dict):
+            return None
+        data = data.get(part)
+    return data
+
+
+class FakeBatch:
+    def __init__(self, store):
+        self._store = store
+        self._ops = []
+
+    def set(self, ref, data, merge=False):
+        self._ops.append(("set", ref, data, merge))
+
+    def create(self, ref, data):
+        self._ops.append(("create", ref, data, None))
+
+    def update(self, ref, data):
+        self._ops.append(("update", ref, data, None))
+
+    def delete(self, ref):
+        self._ops.append(("delete", ref, None, None))
+
+    def commit(self):
+        _simulate_latency()
+        with self._store.lock:
+            # Like Firestore, a failed create() fails the whole batch
+            for op, ref, data, merge in self._ops:
+                if op == "create" and ref._path in self._store.docs:
+                    self._ops = []
+                    raise AlreadyExists(f"Document already exists: {'/'.join(ref._path)}")
+            for op, ref, data, merge in self._ops:
+                path = ref._path
+                if op in ("set", "create"):
+                    current = self._store.docs.get(path) if merge else None
+                    self._store.docs[path] = _merge(current or {}, data)
+                elif op == "update":
+                    if path not in self._store.docs:
+                        raise KeyError(f"No document to update: {'/'.join(path)}")
+                    self._store.docs[path] = _merge(self._store.docs[path], _expand_field_paths(data))
+                else:
+                    self._store.docs.pop(path, None)
+        self._ops = []
+
+
+class FakeFirestore:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.docs = {}  # (collection, doc_id, ...) -> dict
+
+    def collection(self, name):
+        return FakeCollection(self, (name,))
+
+    def batch(self):
+        return FakeBatch(self)
+
+    def get_all(self, refs):
+        _simulate_latency()
+        with self.lock:
+            return [FakeSnapshot(ref.id, copy.deepcopy(self.docs.get(ref._path))) for ref in refs]
+
+    @classmethod
+    def seeded(cls, count=SEEDED_POSTS):
+        db = cls()
+        for post_id in seeded_post_ids(count):
+            post = fake_post(post_id)
+            db.docs[("post_details", post_id)] = post
+            if not post["isDelivered"]:
+                _seed_pending(db, post_id, post)
+            _seed_phone(db, post_id, post)
+        return db
+
+
+def _seed_phone(db, post_id, post):
+    from indexes import PHONE_INDEX
+    from phones import normalise_phone_number
+    phone = normalise_phone_number(post["receiver_details"]["phone_number"])
+    db.docs[(PHONE_INDEX, phone, "posts", post_id)] = {"post_id": post_id, "roles": ["receiver"]}
+
+
+def _seed_pending(db, post_id, post):
+    from indexes import PENDING_BY_OFFICE, office_key_for
+    office = post["nearest_post_office"]
+    db.docs[(PENDING_BY_OFFICE, office_key_for(office), "posts", post_id)] = {
+        "post_id": post_id,
+        "latitude": post["geocoded_info"]["latitude"],
+        "longitude": post["geocoded_info"]["longitude"],
+        "address": post["geocoded_info"]["formattedAddress"],
+        "name": post["receiver_details"]["name"],
+        "office": {key: office[key] for key in ("name", "pincode", "latitude", "longitude")},
+    }
+
+
+def _merge(current, data):
+    merged = dict(current)
+    for key, value in data.items():
+        if value is firestore.DELETE_FIELD:
+            merged.pop(key, None)
+        elif isinstance(value, firestore.ArrayUnion):
+            existing = list(merged.get(key) or [])
+            merged[key] = existing + [copy.deepcopy(v) for v in value.values if v not in existing]
+        elif isinstance(value, firestore.ArrayRemove):
+            merged[key] = [v for v in merged.get(key) or [] if v not in value.values]
+        elif isinstance(value, firestore.Increment):
+            merged[key] = (merged.get(key) or 0) + value.value
+        elif isinstance(value, dict):
+            merged[key] = _merge(merged[key] if isinstance(merged.get(key), dict) else {}, value)
+        else:
+            merged[key] = copy.deepcopy(value)
+    return merged
+
+
+def _expand_field_paths(data):
+    # update() takes dotted field paths ("a.b" or "a.`123`"); turn them into nested dicts
+    nested = {}
+    for path, value in data.items():
+        parts = [part.strip("`") for part in path.split(".")]
+        target = nested
+        for part in parts[:-1]:
+            target = target.setdefault(part, {})
+        target[parts[-1]] = value
+    return nested
+
+
+def seeded_post_ids(count=SEEDED_POSTS):
+    return [str(170000000000 + i) for i in range(count)]
+
+
+def fake_post(post_id):
+    rng = random.Random(post_id)
+    latitude = 22.7 + rng.uniform(-0.05, 0.05)
+    longitude = 75.85 + rng.uniform(-0.05, 0.05)
+    return {
+        "isDelivered": int(post_id) % 2 == 0,
+        "receiver_details": {
+            "post_id": post_id,
+            "name": "Test Receiver",
+            "phone_number": f"98{int(post_id) % 1000:08d}",  # ~1000 distinct numbers
+            "address": "5 A Parshwanath Nagar Indore (M.P)",
+            "pincode": "452009",
+        },
+        "geocoded_info": {
+            "formattedAddress": "5A, Parshwanath Nagar, Indore, Madhya Pradesh 452009, India",
+            "latitude": latitude,
+            "longitude": longitude,
+            "pincode": "452009",
+            "city": "Indore",
+            "state": "Madhya Pradesh",
+        },
+        "nearest_post_office": {
+            "name": "Sudama Nagar S.O",
+            "pincode": 452009,
+            "delivery_type": "Delivery",
+            "state": "MADHYA PRADESH",
+            "latitude": 22.6953333,
+            "longitude": 75.8360556,
+            "office_type": "PO",
+        },
+        "events": [{"date": "2025-04-11", "time": "10:00 AM", "location": "post office", "status": "Post Received"}],
+    }
+
+
+class FakeS3:
+    def __init__(self):
+        self.objects = {}
+
+    def upload_file(self, filename, bucket, key, **kwargs):
+        with open(filename, "rb") as f:
+            self.objects[(bucket, key)] = f.read()
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.objects[(Bucket, Key)] = Body if isinstance(Body, bytes) else Body.read()
+
+
+_fake_ids = itertools.count()
+
+
+def fake_run_script(args, **kwargs):
+    """Drop-in for subprocess.run used by server.process_photos."""
+    time.sleep(PIPELINE_SECONDS)
+    script = os.path.basename(args[1])
+    if script == "receiver.py" and "--batch" in args:
+        post_ids = [str(180000000000 + (os.getpid() % 1000) * 10**6 + next(_fake_ids) % 10**6) for _ in range(5)]
+        stdout = f"fake OCR output\n{json.dumps({'post_ids': post_ids})}\n"
+    elif script == "receiver.py":
+        post_id = str(180000000000 + (os.getpid() % 1000) * 10**6 + next(_fake_ids) % 10**6)
+        stdout = f"fake OCR output\n{json.dumps({'post_id': post_id})}\n"
+    else:
+        stdout = f"fake {script} output\n"
+    return subprocess.CompletedProcess(args, 0, stdout=stdout, stderr="")
@@ -0,0 +1,279 @@
+import os
+import sys
+import json
+import mmap
+import sqlite3
+import argparse
+import threading
+
+import numpy as np
+
+# Offline pincode gazetteer built from the PostOfficeDetails table.
+# One record per pincode (centroid of its offices' coordinates, state,
+# district, list of office names), stored as memory-mapped numpy files:
+#   <base>.npy           records sorted by pincode (searchsorted lookups)
+#   <base>_offices.npy   uint32 offsets into the office name blob
+#   <base>_offices.bin   UTF-8 office names, back to back
+#   <base>.json          state and district name tables
+# Used to validate LLM pincodes, repair single-digit OCR errors and to give a
+# location without calling Google when geocoding fails.
+
+GAZETTEER_PATH = os.getenv("PINCODE_GAZETTEER", "pincode_gazetteer")
+
+RECORD_DTYPE = np.dtype([
+    ("pincode", "<u4"),
+    ("latitude", "<f4"),
+    ("longitude", "<f4"),
+    ("state", "<u2"),
+    ("district", "<u2"),
+    ("offices_start", "<u4"),
+    ("offices_count", "<u2"),
+])
+
+# Characters OCR commonly reads in place of digits
+OCR_DIGITS = str.maketrans({"O": "0", "o": "0", "D": "0", "Q": "0", "I": "1", "l": "1", "|": "1",
+                            "Z": "2", "S": "5", "s": "5", "G": "6", "b": "6", "T": "7", "B": "8", "g": "9"})
+# Digit pairs that are easy to confuse in print and handwriting
+CONFUSABLE = {frozenset(p) for p in ("17", "38", "56", "08", "68", "49", "35", "12", "27", "69", "01")}
+
+
+def _parse_coordinate(value):
+    try:
+        value = float(str(value).strip())
+    except (TypeError, ValueError):
+        return None
+    return value if np.isfinite(value) and value != 0 else None
+
+
+# Function to build the gazetteer files from post_office.db
+def build_gazetteer(db_path="post_office.db", base=GAZETTEER_PATH):
+    conn = sqlite3.connect(db_path)
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(PostOfficeDetails)")}
+    district_column = next((c for c in ("District", "DistrictName", "Districtname") if c in columns), None)
+    cursor = conn.execute(f"""
+        SELECT Pincode, OfficeName, StateName, {district_column or "NULL"}, Latitude, Longitude
+        FROM PostOfficeDetails
+    """)
+
+    by_pincode = {}
+    for pincode, office_name, state, district, latitude, longitude in cursor:
+        try:
+            pincode = int(str(pincode).strip())
+        except (TypeError, ValueError):
+            continue
+        if not 100000 <= pincode <= 999999:
+            continue
+        entry = by_pincode.setdefault(pincode, {"offices": [], "coords": [], "state": state, "district": district})
+        entry["offices"].append(str(office_name or "").strip())
+        entry["state"] = entry["state"] or state
+        entry["district"] = entry["district"] or district
+        latitude, longitude = _parse_coordinate(latitude), _parse_coordinate(longitude)
+        # Skip coordinates outside India's bounding box (swapped or garbage values in the source)
+        if latitude is not None and longitude is not None and 6 <= latitude <= 38 and 68 <= longitude <= 98:
+            entry["coords"].append((latitude, longitude))
+    conn.close()
+
+    states, districts = [""], [""]
+    state_ids, district_ids = {"": 0}, {"": 0}
+    records = np.zeros(len(by_pincode), dtype=RECORD_DTYPE)
+    names = []
+    for i, pincode in enumerate(sorted(by_pincode)):
+        entry = by_pincode[pincode]
+        state = str(entry["state"] or "").strip().upper()
+        district = str(entry["district"] or "").strip().upper()
+        if state not in state_ids:
+            state_ids[state] = len(states)
+            states.append(state)
+        if district not in district_ids:
+            district_ids[district] = len(districts)
+            districts.append(district)
+        if entry["coords"]:
+            latitude, longitude = np.median(np.array(entry["coords"]), axis=0)
+        else:
+            latitude = longitude = np.nan
+        offices = sorted(set(name for name in entry["offices"] if name))
+        records[i] = (pincode, latitude, longitude, state_ids[state], district_ids[district], len(names), len(offices))
+        names.extend(offices)
+
+    blob = bytearray()
+    offsets = np.zeros(len(names) + 1, dtype="<u4")
+    for i, name in enumerate(names):
+        blob.extend(name.encode("utf-8"))
+        offsets[i + 1] = len(blob)
+
+    np.save(base + ".npy", records)
+    np.save(base + "_offices.npy", offsets)
+    with open(base + "_offices.bin", "wb") as f:
+        f.write(bytes(blob))
+    with open(base + ".json", "w") as f:
+        json.dump({"states": states, "districts": districts}, f)
+    print(f"Gazetteer written to {base}.*: {len(records)} pincodes, {len(names)} offices")
+    return len(records)
+
+
+class Gazetteer:
+    def __init__(self, base=GAZETTEER_PATH):
+        self.records = np.load(base + ".npy", mmap_mode="r")
+        self.offsets = np.load(base + "_offices.npy", mmap_mode="r")
+        with open(base + "_offices.bin", "rb") as f:
+            self._blob = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(base + "_offices.bin") else b""
+        with open(base + ".json") as f:
+            tables = json.load(f)
+        self.states = tables["states"]
+        self.districts = tables["districts"]
+        self.pincodes = self.records["pincode"]
+
+    def __len__(self):
+        return len(self.records)
+
+    def _index(self, pincode):
+        pincode = normalise_pincode(pincode)
+        if pincode is None:
+            return None
+        i = int(np.searchsorted(self.pincodes, int(pincode)))
+        return i if i < len(self.pincodes) and self.pincodes[i] == int(pincode) else None
+
+    def is_valid(self, pincode):
+        return self._index(pincode) is not None
+
+    def _record(self, i):
+        record = self.records[i]
+        start, count = int(record["offices_start"]), int(record["offices_count"])
+        offices = [bytes(self._blob[self.offsets[k]:self.offsets[k + 1]]).decode("utf-8")
+                   for k in range(start, start + count)]
+        latitude, longitude = float(record["latitude"]), float(record["longitude"])
+        return {
+            "pincode": f"{int(record['pincode']):06d}",
+            "latitude": latitude if np.isfinite(latitude) else None,
+            "longitude": longitude if np.isfinite(longitude) else None,
+            "state": self.states[int(record["state"])],
+            "district": self.districts[int(record["district"])],
+            "offices": offices,
+        }
+
+    def lookup(self, pincode):
+        i = self._index(pincode)
+        return self._record(i) if i is not None else None
+
+    def correct_pincode(self, pincode, state=None, near=None):
+        """Return pincode if valid, else the best valid pincode one OCR slip away, else None.
+
+        Candidates differ by one digit or one adjacent swap. Ties are broken by
+        matching state, then distance to near=(lat, lon), then digit confusability.
+        Without a state or near hint only a sole candidate is returned: picking
+        between several by confusability alone is a guess, and the gazetteer may
+        simply be missing the pincode, so the caller keeps it for review instead.
+        """
+        digits = normalise_pincode(pincode)
+        if digits is None:
+            return None
+        if self.is_valid(digits):
+            return digits
+
+        candidates = {}
+        for pos in range(6):
+            for d in "0123456789":
+                if d != digits[pos] and not (pos == 0 and d == "0"):
+                    candidates[digits[:pos] + d + digits[pos + 1:]] = frozenset((digits[pos], d)) in CONFUSABLE
+            if pos < 5 and digits[pos] != digits[pos + 1] and not (pos == 0 and digits[1] == "0"):
+                candidates[digits[:pos] + digits[pos + 1] + digits[pos] + digits[pos + 2:]] = True
+
+        values = np.array([int(c) for c in candidates], dtype=np.uint32)
+        idx = np.searchsorted(self.pincodes, values)
+        idx[idx >= len(self.pincodes)] = 0
+        valid = [f"{int(v):06d}" for v, i in zip(values, idx) if self.pincodes[i] == v]
+        if not valid:
+            return None
+
+        state = str(state or "").strip().upper()
+        if not state and near is None and len(valid) > 1:
+            return None
+
+        def score(candidate):
+            record = self.lookup(candidate)
+            wrong_state = bool(state) and record["state"] != state
+            distance = 0.0
+            if near is not None and record["latitude"] is not None:
+                distance = np.hypot(record["latitude"] - near[0], (record["longitude"] - near[1]) * np.cos(np.radians(near[0])))
+            return (wrong_state, distance, not candidates[candidate])
+
+        ranked = sorted(valid, key=score)
+        # Without any hint two equally plausible candidates are a guess, not a fix
+        if len(ranked) > 1 and score(ranked[0]) == score(ranked[1]):
+            return None
+        return ranked[0]
+
+    def fallback_geocode(self, pincode):
+        """Geocode result shaped like receiver.geocode_address, from the pincode centroid."""
+        record = self.lookup(pincode)
+        if record is None or record["latitude"] is None:
+            return None
+        district = record["district"].title()
+        state = record["state"].title()
+        return {
+            "formattedAddress": ", ".join(part for part in (district, f"{state} {record['pincode']}", "India") if part),
+            "latitude": record["latitude"],
+            "longitude": record["longitude"],
+            "pincode": record["pincode"],
+            "city": district,
+            "state": state,
+            "source": "gazetteer",
+        }
+
+
+# Function to normalise a pincode string ("452 009", "45200g") to 6 digits or None
+def normalise_pincode(pincode):
+    if pincode is None:
+        return None
+    text = "".join(str(pincode).split())
+    # Only read letters as digits in something that looks like a bare pincode
+    if len(text) <= 7:
+        text = text.translate(OCR_DIGITS)
+    digits = "".join(ch for ch in text if ch.isdigit())
+    return digits if len(digits) == 6 and digits[0] != "0" else None
+
+
+_gazetteer = None
+_gazetteer_lock = threading.Lock()
+_gazetteer_warned = False
+
+
+# Function to get the shared gazetteer, or None if it has not been built
+def get_gazetteer():
+    global _gazetteer, _gazetteer_warned
+    if _gazetteer is not None:
+        return _gazetteer
+    with _gazetteer_lock:
+        # Threads that waited here find it loaded; a failed load is retried on the next call
+        if _gazetteer is None:
+            try:
+                _gazetteer = Gazetteer(GAZETTEER_PATH)
+            except FileNotFoundError:
+                if not _gazetteer_warned:
+                    print(f"Pincode gazetteer not found at {GAZETTEER_PATH}.*; run `python gazetteer.py build`")
+                    _gazetteer_warned = True
+            except Exception as e:
+                print(f"Error loading pincode gazetteer: {e}")
+    return _gazetteer
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build or query the offline pincode gazetteer.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    build = sub.add_parser("build", help="Build the gazetteer from post_office.db")
+    build.add_argument("--db", default="post_office.db")
+    build.add_argument("--out", default=GAZETTEER_PATH)
+    query = sub.add_parser("lookup", help="Look up (and if needed correct) a pincode")
+    query.add_argument("pincode")
+    query.add_argument("--state")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        build_gazetteer(args.db, args.out)
+    else:
+        gazetteer = get_gazetteer()
+        if gazetteer is None:
+            sys.exit(1)
+        corrected = gazetteer.correct_pincode(args.pincode, state=args.state)
+        print(json.dumps({"input": args.pincode, "pincode": corrected,
+                          "record": gazetteer.lookup(corrected) if corrected else None}, indent=4))
@@ -0,0 +1,507 @@
+import os
+import sys
+import json
+import time
+import random
+import atexit
+import asyncio
+import hashlib
+import sqlite3
+import argparse
+import threading
+
+# Shared rate-limit and quota governor for Azure, Groq, Google and Twilio.
+# Every provider call takes tokens from one token bucket per (provider, key,
+# dimension) first, e.g. groq requests/min and groq tokens/min, and waits when
+# a bucket is empty instead of going out and getting a 429.
+#
+# A 429 (or Retry-After) blocks the bucket until the provider says so and, in
+# adaptive mode, cuts its learned rate; successes grow it back towards the
+# configured limit (AIMD). receiver.py/sender.py/message.py run as separate
+# processes, so buckets live in a shared SQLite file by default
+# (GOVERNOR_BACKEND=sqlite); GOVERNOR_BACKEND=local keeps them in-process
+# (async_pipeline.py run on its own) and "off" disables the governor.
+#
+# No provider is limited unless configured: a paid account must not be held to
+# free-tier rates. GOVERNOR_PRESET=free loads the documented free-tier limits
+# below and GOVERNOR_LIMITS adds or overrides providers on top. Unconfigured
+# providers skip the buckets until they send a 429: that creates a shared
+# "learned" requests bucket for the provider and key, blocked for Retry-After,
+# whose rate AIMD then learns below GOVERNOR_LEARNED_PER_MINUTE.
+#
+# A call that cannot get quota within GOVERNOR_MAX_WAIT raises QuotaTimeout.
+# Callers retry the work later instead of failing it: the scripts exit with
+# QUOTA_EXIT_CODE and server.py requeues them (async_pipeline.py requeues the
+# envelope itself).
+
+GOVERNOR_BACKEND = os.getenv("GOVERNOR_BACKEND", "sqlite")
+GOVERNOR_PATH = os.getenv("GOVERNOR_DB", "governor.db")
+ADAPTIVE = os.getenv("GOVERNOR_ADAPTIVE", "1") == "1"
+MAX_WAIT_SECONDS = float(os.getenv("GOVERNOR_MAX_WAIT", 120))
+MAX_RETRIES = int(os.getenv("GOVERNOR_MAX_RETRIES", 3))
+LLM_COMPLETION_ESTIMATE = int(os.getenv("GOVERNOR_LLM_COMPLETION_TOKENS", 150))
+GOVERNOR_PRESET = os.getenv("GOVERNOR_PRESET", "")
+LEARNED_PER_MINUTE = float(os.getenv("GOVERNOR_LEARNED_PER_MINUTE", 600))
+
+QUOTA_EXIT_CODE = 75  # EX_TEMPFAIL: the script ran out of provider quota, run it again later
+QUOTA_RETRY_SECONDS = float(os.getenv("QUOTA_RETRY_SECONDS", 300))
+QUOTA_MAX_RETRIES = int(os.getenv("QUOTA_MAX_RETRIES", 5))
+
+# Per-minute limits and bursts, e.g.
+# GOVERNOR_LIMITS='{"groq": {"requests": 1000, "tokens": {"per_minute": 300000, "burst": 20000}}}'
+PRESETS = {"free": {
+    "azure": {"requests": {"per_minute": 900, "burst": 15}},    # Form Recognizer S0: 15 TPS
+    "groq": {"requests": {"per_minute": 30, "burst": 30},       # Groq free tier
+             "tokens": {"per_minute": 6000, "burst": 6000}},
+    "google": {"requests": {"per_minute": 3000, "burst": 50}},  # Geocoding: 50 QPS
+    "twilio": {"requests": {"per_minute": 60, "burst": 1}},     # 1 SMS/s per long code
+}}
+
+ADAPTIVE_DECREASE = 0.7       # Rate multiplier on a 429
+ADAPTIVE_INCREASE = 0.02      # Fraction of the configured rate regained per success
+ADAPTIVE_MIN_FRACTION = 0.05  # Never learn a rate below this fraction of the configured one
+DEFAULT_RETRY_AFTER = 1.0
+
+
+class QuotaTimeout(TimeoutError):
+    pass
+
+
+def load_limits(preset=None, overrides=None):
+    preset = GOVERNOR_PRESET if preset is None else preset
+    if preset and preset not in PRESETS:
+        raise ValueError(f"Unknown GOVERNOR_PRESET {preset!r}; expected one of {sorted(PRESETS)}")
+    limits = {provider: dict(dimensions) for provider, dimensions in PRESETS.get(preset, {}).items()}
+    overrides = os.getenv("GOVERNOR_LIMITS") if overrides is None else overrides
+    if overrides:
+        for provider, dimensions in json.loads(overrides).items():
+            limits.setdefault(provider, {}).update(dimensions)
+    for dimensions in limits.values():
+        for dimension, spec in dimensions.items():
+            if not isinstance(spec, dict):
+                spec = {"per_minute": spec}
+            per_minute = float(spec["per_minute"])
+            burst = float(spec.get("burst", per_minute))
+            if not per_minute > 0 or not burst > 0:
+                raise ValueError(f"GOVERNOR_LIMITS {dimension} needs a positive per_minute and burst, got {spec}")
+            dimensions[dimension] = {"per_minute": per_minute, "burst": burst}
+    return limits
+
+
+# Function to build the ceiling of a bucket learned from 429s (see the header)
+def learned_limit(per_minute=LEARNED_PER_MINUTE):
+    return {"per_minute": per_minute, "burst": max(1.0, per_minute / 60), "learned": True}
+
+
+# Function to estimate Groq tokens for a call (prompt characters / 4 plus the expected reply)
+def estimate_tokens(*texts, completion=LLM_COMPLETION_ESTIMATE):
+    return sum(len(text or "") for text in texts) // 4 + completion
+
+
+# Function to read (is_rate_limited, retry_after_seconds) from an SDK error or HTTP response
+def rate_limit_info(obj):
+    response = getattr(obj, "response", None)
+    status = getattr(obj, "status_code", None) or getattr(obj, "status", None) or getattr(response, "status_code", None)
+    if status != 429:
+        return False, None
+    headers = getattr(obj, "headers", None) or getattr(response, "headers", None) or {}
+    retry_after = None
+    for name in ("retry-after", "Retry-After", "x-ms-retry-after-ms", "retry-after-ms"):
+        value = headers.get(name) if hasattr(headers, "get") else None
+        if value is None:
+            continue
+        try:
+            retry_after = float(value) / (1000 if name.endswith("-ms") else 1)
+            break
+        except ValueError:
+            continue
+    return True, retry_after
+
+
+def _bucket_name(provider, key, dimension):
+    # Buckets are per key, but keys never reach the state file
+    key_id = hashlib.sha1(str(key).encode("utf-8")).hexdigest()[:10] if key else "default"
+    return f"{provider}:{key_id}:{dimension}"
+
+
+def _new_state(limit, now):
+    return {"tokens": limit["burst"], "updated": now, "rate": limit["per_minute"], "blocked_until": 0.0,
+            "granted": 0, "consumed": 0.0, "waited": 0.0, "throttled": 0}
+
+
+def _take(states, wanted, now, adaptive):
+    """Refill states and take every cost in wanted, or nothing; returns seconds to wait (0 if taken)."""
+    wait = 0.0
+    for name, cost, limit in wanted:
+        state = states[name]
+        rate = (state["rate"] if adaptive else limit["per_minute"]) / 60
+        state["tokens"] = min(limit["burst"], state["tokens"] + max(0.0, now - state["updated"]) * rate)
+        state["updated"] = now
+        cost = min(cost, limit["burst"])  # A call larger than the burst would otherwise never fit
+        if now < state["blocked_until"]:
+            wait = max(wait, state["blocked_until"] - now)
+        elif state["tokens"] < cost:
+            wait = max(wait, (cost - state["tokens"]) / rate)
+    if wait > 0:
+        return wait
+    for name, cost, limit in wanted:
+        states[name]["tokens"] -= min(cost, limit["burst"])
+        states[name]["granted"] += 1
+        states[name]["consumed"] += cost
+    return 0.0
+
+
+def _penalise(state, limit, retry_after, adaptive, now):
+    state["blocked_until"] = max(state["blocked_until"], now + (retry_after or DEFAULT_RETRY_AFTER))
+    state["tokens"] = 0.0
+    state["throttled"] += 1
+    if adaptive:
+        state["rate"] = max(limit["per_minute"] * ADAPTIVE_MIN_FRACTION, state["rate"] * ADAPTIVE_DECREASE)
+
+
+class LocalBackend:
+    """Buckets held in this process only."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._states = {}
+
+    def take(self, wanted, adaptive, waited=0.0):
+        now = time.time()
+        with self._lock:
+            # A learned bucket only exists once its provider has sent a 429
+            wanted = [item for item in wanted if item[0] in self._states or not item[2].get("learned")]
+            if not wanted:
+                return 0.0
+            for name, _, limit in wanted:
+                self._states.setdefault(name, _new_state(limit, now))
+            wait = _take(self._states, wanted, now, adaptive)
+            if not wait:
+                for name, _, _ in wanted:
+                    self._states[name]["waited"] += waited
+            return wait
+
+    def penalise(self, name, limit, retry_after, adaptive):
+        now = time.time()
+        with self._lock:
+            _penalise(self._states.setdefault(name, _new_state(limit, now)), limit, retry_after, adaptive, now)
+
+    def reward(self, name, limit):
+        with self._lock:
+            state = self._states.get(name)
+            if state is not None and state["rate"] < limit["per_minute"]:
+                state["rate"] = min(limit["per_minute"], state["rate"] + limit["per_minute"] * ADAPTIVE_INCREASE)
+
+    def states(self):
+        with self._lock:
+            return {name: dict(state) for name, state in self._states.items()}
+
+
+class SQLiteBackend:
+    """Buckets shared by every process using the same file (gunicorn workers and their subprocesses)."""
+
+    COLUMNS = ("tokens", "updated", "rate", "blocked_until", "granted", "consumed", "waited", "throttled")
+
+    def __init__(self, path=GOVERNOR_PATH):
+        self.path = path
+        self._local = threading.local()
+        # Successes are counted in memory and folded into the next take() of the same
+        # bucket instead of one UPDATE each; whatever is left is written at exit
+        self._rewards = {}  # name -> (count, limit)
+        self._rewards_lock = threading.Lock()
+        atexit.register(self.flush_rewards)
+        self._connect().execute(f"""
+            CREATE TABLE IF NOT EXISTS buckets (
+                name TEXT PRIMARY KEY,
+                {", ".join(f"{column} REAL NOT NULL" for column in self.COLUMNS)}
+            )
+        """)
+
+    def _connect(self):
+        # One connection per thread, and never one inherited across a gunicorn fork
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")  # Losing the last bucket update on power loss is harmless
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _load(self, conn, names, limits, now):
+        rows = conn.execute(f"SELECT name, {', '.join(self.COLUMNS)} FROM buckets WHERE name IN ({','.join('?' * len(names))})",
+                            names).fetchall()
+        states = {row[0]: dict(zip(self.COLUMNS, row[1:])) for row in rows}
+        for name, limit in zip(names, limits):
+            if not limit.get("learned"):
+                states.setdefault(name, _new_state(limit, now))
+        return states
+
+    def _take_rewards(self, names=None):
+        with self._rewards_lock:
+            if names is None:
+                names = list(self._rewards)
+            return {name: self._rewards.pop(name) for name in names if name in self._rewards}
+
+    def _apply_rewards(self, states, rewards):
+        for name, (count, limit) in rewards.items():
+            state = states.get(name)
+            if state is not None and state["rate"] < limit["per_minute"]:
+                state["rate"] = min(limit["per_minute"], state["rate"] + count * limit["per_minute"] * ADAPTIVE_INCREASE)
+
+    def _store(self, conn, states):
+        conn.executemany(
+            f"INSERT OR REPLACE INTO buckets (name, {', '.join(self.COLUMNS)}) VALUES (?{', ?' * len(self.COLUMNS)})",
+            [(name, *(state[column] for column in self.COLUMNS)) for name, state in states.items()],
+        )
+
+    def _transaction(self, update):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = update(conn)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return result
+
+    def take(self, wanted, adaptive, waited=0.0):
+        names = [name for name, _, _ in wanted]
+        if all(limit.get("learned") for _, _, limit in wanted) and not self._connect().execute(
+                f"SELECT 1 FROM buckets WHERE name IN ({','.join('?' * len(names))}) LIMIT 1", names).fetchone():
+            return 0.0  # No 429 from this provider yet: skip the write transaction
+
+        def update(conn):
+            now = time.time()
+            states = self._load(conn, names, [limit for _, _, limit in wanted], now)
+            self._apply_rewards(states, self._take_rewards(states))
+            current = [item for item in wanted if item[0] in states]
+            wait = _take(states, current, now, adaptive) if current else 0.0
+            if not wait:
+                for state in states.values():
+                    state["waited"] += waited
+            self._store(conn, states)
+            return wait
+        return self._transaction(update)
+
+    def penalise(self, name, limit, retry_after, adaptive):
+        def update(conn):
+            now = time.time()
+            states = self._load(conn, [name], [limit], now)
+            self._take_rewards([name])  # Successes before a 429 do not count
+            _penalise(states.setdefault(name, _new_state(limit, now)), limit, retry_after, adaptive, now)
+            self._store(conn, states)
+        self._transaction(update)
+
+    def reward(self, name, limit):
+        with self._rewards_lock:
+            count, _ = self._rewards.get(name, (0, limit))
+            self._rewards[name] = (count + 1, limit)
+
+    def flush_rewards(self):
+        """Write the rate increases not yet folded into a take()."""
+        rewards = self._take_rewards()
+        if not rewards:
+            return
+
+        def update(conn):
+            names = list(rewards)
+            states = self._load(conn, names, [limit for _, limit in rewards.values()], time.time())
+            self._apply_rewards(states, rewards)
+            self._store(conn, states)
+        try:
+            self._transaction(update)
+        except sqlite3.Error as e:
+            print(f"Error writing governor state to {self.path}: {e}")
+
+    def states(self):
+        self.flush_rewards()
+        rows = self._connect().execute(f"SELECT name, {', '.join(self.COLUMNS)} FROM buckets").fetchall()
+        return {row[0]: dict(zip(self.COLUMNS, row[1:])) for row in rows}
+
+
+class Governor:
+    def __init__(self, backend, limits=None, adaptive=ADAPTIVE, max_wait=MAX_WAIT_SECONDS):
+        self.backend = backend
+        self.limits = load_limits() if limits is None else limits
+        self.adaptive = adaptive
+        self.max_wait = max_wait
+
+    def _dimensions(self, provider):
+        # Providers without configured limits are only limited once they send a 429
+        return self.limits.get(provider) or {"requests": learned_limit()}
+
+    def _wanted(self, provider, key, cost):
+        dimensions = self._dimensions(provider)
+        cost = cost or {"requests": 1}
+        return [(_bucket_name(provider, key, dimension), float(amount), dimensions[dimension])
+                for dimension, amount in cost.items() if dimension in dimensions and amount > 0]
+
+    def acquire(self, provider, key=None, cost=None):
+        """Block until provider has capacity for cost ({"requests": 1, "tokens": n}); returns seconds waited."""
+        wanted = self._wanted(provider, key, cost)
+        if not wanted:
+            return 0.0
+        started, waited = time.time(), 0.0
+        while True:
+            wait = self.backend.take(wanted, self.adaptive, waited)
+            if not wait:
+                return waited
+            if waited + wait > self.max_wait:
+                raise QuotaTimeout(f"{provider} quota not available within {self.max_wait:.0f}s")
+            # Jitter so waiting processes do not all retry at the same instant
+            time.sleep(wait * random.uniform(1.0, 1.2))
+            waited = time.time() - started
+
+    async def acquire_async(self, provider, key=None, cost=None):
+        wanted = self._wanted(provider, key, cost)
+        if not wanted:
+            return 0.0
+        started, waited = time.time(), 0.0
+        while True:
+            wait = await asyncio.to_thread(self.backend.take, wanted, self.adaptive, waited)
+            if not wait:
+                return waited
+            if waited + wait > self.max_wait:
+                raise QuotaTimeout(f"{provider} quota not available within {self.max_wait:.0f}s")
+            await asyncio.sleep(wait * random.uniform(1.0, 1.2))
+            waited = time.time() - started
+
+    def report(self, provider, key=None, throttled=False, retry_after=None):
+        """Feed back the outcome of a call: a 429 blocks and (adaptively) slows the provider's buckets."""
+        if throttled:
+            print(f"{provider} rate limited; backing off {retry_after or DEFAULT_RETRY_AFTER:.1f}s")
+        for dimension, limit in self._dimensions(provider).items():
+            name = _bucket_name(provider, key, dimension)
+            if throttled:
+                self.backend.penalise(name, limit, retry_after, self.adaptive)
+            elif self.adaptive:
+                self.backend.reward(name, limit)
+
+    def call(self, provider, fn, key=None, cost=None, throttled=None, retries=MAX_RETRIES):
+        """Run fn() within quota, waiting and retrying on 429s.
+
+        throttled(result) can flag rate-limited results that are not exceptions
+        (e.g. an HTTP response); the last such result is returned once retries run out.
+        A 429 raised on the last attempt becomes QuotaTimeout, so the work is requeued.
+        The wait before a retry happens in acquire(), on the bucket the 429 blocked.
+        """
+        for attempt in range(retries + 1):
+            self.acquire(provider, key, cost)
+            try:
+                result = fn()
+            except Exception as e:
+                limited, retry_after = rate_limit_info(e)
+                if not limited:
+                    raise
+                self.report(provider, key, throttled=True, retry_after=retry_after)
+                if attempt == retries:
+                    raise QuotaTimeout(f"{provider} still rate limited after {retries} retries") from e
+                continue
+            limited, retry_after = throttled(result) if throttled else (False, None)
+            self.report(provider, key, throttled=limited, retry_after=retry_after)
+            if not limited or attempt == retries:
+                return result
+
+    async def call_async(self, provider, fn, key=None, cost=None, throttled=None, retries=MAX_RETRIES):
+        """call() for coroutines: fn() must return an awaitable."""
+        for attempt in range(retries + 1):
+            await self.acquire_async(provider, key, cost)
+            try:
+                result = await fn()
+            except Exception as e:
+                limited, retry_after = rate_limit_info(e)
+                if not limited:
+                    raise
+                await asyncio.to_thread(self.report, provider, key, True, retry_after)
+                if attempt == retries:
+                    raise QuotaTimeout(f"{provider} still rate limited after {retries} retries") from e
+                continue
+            limited, retry_after = throttled(result) if throttled else (False, None)
+            if limited:
+                await asyncio.to_thread(self.report, provider, key, True, retry_after)
+            else:
+                self.report(provider, key)  # Successes are only counted in memory
+            if not limited or attempt == retries:
+                return result
+
+    def metrics(self):
+        now = time.time()
+        buckets = {}
+        for name, state in sorted(self.backend.states().items()):
+            provider, _, dimension = name.split(":")
+            limit = self._dimensions(provider).get(dimension)
+            buckets[name] = {
+                "tokens": round(state["tokens"], 2),
+                "configured_per_minute": limit["per_minute"] if limit and not limit.get("learned") else None,
+                "learned_ceiling_per_minute": limit["per_minute"] if limit and limit.get("learned") else None,
+                "learned_per_minute": round(state["rate"], 2),
+                "blocked_for_seconds": round(max(0.0, state["blocked_until"] - now), 2),
+                "granted": int(state["granted"]),
+                "consumed": round(state["consumed"], 2),
+                "waited_seconds": round(state["waited"], 3),
+                "throttled": int(state["throttled"]),
+            }
+        return {"backend": type(self.backend).__name__, "adaptive": self.adaptive, "buckets": buckets}
+
+
+class _NoGovernor:
+    """GOVERNOR_BACKEND=off: calls go straight through."""
+
+    def acquire(self, *args, **kwargs):
+        return 0.0
+
+    async def acquire_async(self, *args, **kwargs):
+        return 0.0
+
+    def report(self, *args, **kwargs):
+        pass
+
+    def call(self, provider, fn, **kwargs):
+        return fn()
+
+    async def call_async(self, provider, fn, **kwargs):
+        return await fn()
+
+    def metrics(self):
+        return {"backend": "off"}
+
+
+_governor = None
+_governor_lock = threading.Lock()
+
+
+# Function to get the shared governor for this process
+def get_governor():
+    global _governor
+    with _governor_lock:
+        if _governor is None:
+            if GOVERNOR_BACKEND == "off":
+                _governor = _NoGovernor()
+            elif GOVERNOR_BACKEND == "local":
+                _governor = Governor(LocalBackend())
+            else:
+                try:
+                    _governor = Governor(SQLiteBackend(GOVERNOR_PATH))
+                except sqlite3.Error as e:
+                    print(f"Error opening governor state at {GOVERNOR_PATH}, using in-process buckets: {e}")
+                    _governor = Governor(LocalBackend())
+        return _governor
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect or reset the provider quota governor.")
+    parser.add_argument("command", choices=["status", "limits", "reset"])
+    args = parser.parse_args()
+
+    if args.command == "limits":
+        print(json.dumps(load_limits(), indent=4))
+    elif args.command == "reset":
+        if GOVERNOR_BACKEND != "sqlite":
+            print("Only the sqlite backend keeps state between runs")
+            sys.exit(1)
+        SQLiteBackend(GOVERNOR_PATH)._connect().execute("DELETE FROM buckets")
+        print(f"Cleared {GOVERNOR_PATH}")
+    else:
+        print(json.dumps(get_governor().metrics(), indent=4))
@@ -0,0 +1,44 @@
+import os
+import multiprocessing
+
+# Production serving profile for server.py:
+#   gunicorn -c gunicorn.conf.py wsgi:app
+# Every setting can be overridden from the environment.
+
+bind = f"0.0.0.0:{os.getenv('PORT', '80')}"
+
+# /upload hands work to background threads and the other endpoints wait on
+# Firestore, so requests are I/O bound: a few processes with several threads each.
+workers = int(os.getenv("GUNICORN_WORKERS", min(4, multiprocessing.cpu_count() * 2 + 1)))
+threads = int(os.getenv("GUNICORN_THREADS", 8))
+worker_class = "gthread" if threads > 1 else "sync"
+
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 120))
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", 30))
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", 5))
+
+# Recycle workers now and then (0 disables); background processing threads of
+# a recycled worker get graceful_timeout to finish.
+max_requests = int(os.getenv("GUNICORN_MAX_REQUESTS", 0))
+max_requests_jitter = int(os.getenv("GUNICORN_MAX_REQUESTS_JITTER", 0))
+
+# Import the app once in the master so workers fork with Flask already loaded.
+# SDK clients are still created after the fork (see post_fork below).
+preload_app = os.getenv("GUNICORN_PRELOAD", "1") == "1"
+
+accesslog = os.getenv("GUNICORN_ACCESS_LOG", "-") or None  # Empty disables the access log
+errorlog = "-"
+loglevel = os.getenv("GUNICORN_LOG_LEVEL", "info")
+
+
+def post_fork(server, worker):
+    # Firestore (gRPC) and boto3 clients must not be shared across fork(),
+    # so each worker builds its own before it starts accepting requests.
+    from wsgi import init_worker
+    init_worker()
+    server.log.info(f"Worker {worker.pid} initialised SDK clients")
+
+
+def worker_exit(server, worker):
+    from wsgi import shutdown_worker
+    shutdown_worker()
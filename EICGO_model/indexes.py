@@ -0,0 +1,230 @@
+import re
+import os
+import sys
+import argparse
+from datetime import datetime
+
+from firebase_admin import firestore
+
+from phones import normalise_phone_number
+
+# Secondary indexes over post_details, maintained in the same write batch as
+# the post itself so readers never have to scan the whole collection.
+#
+# pending_by_office/{office_key}/posts/{post_id}
+#     latitude, longitude, address, name of an undelivered post, plus the
+#     office (its nearest_post_office) so the parent document is never written
+# One document per post: a busy office stays far from the 1 MiB document
+# limit and from the ~1 write/s a single document sustains.
+#
+# dispatch_manifests/{date}_{office_key}
+#     date:   YYYY-MM-DD the post was scanned at the booking office
+#     office: {name, pincode} of the destination post office
+#     posts:  {post_id: {time, receiver_pincode}} scanned that day for it
+# Entries are keyed by post_id so re-uploading a post never double counts.
+#
+# Posts written before an index existed are added by `python indexes.py backfill`.
+#
+# phone_index/{e164}/posts/{post_id}
+#     post_id, roles (["receiver"], ["sender"] or both), created_at
+# One small document per (phone, post) so a number with thousands of posts
+# still pages cheaply, newest first (post_ids are increasing timestamps).
+# Roles are an ArrayUnion so a customer posting to themselves keeps both.
+
+PENDING_BY_OFFICE = "pending_by_office"
+DISPATCH_MANIFESTS = "dispatch_manifests"
+PHONE_INDEX = "phone_index"
+
+
+# Function to build a stable document id for a post office
+def office_key(pincode, name):
+    slug = re.sub(r"[^a-z0-9]+", "-", str(name or "").lower()).strip("-")
+    return f"{pincode}_{slug}" if slug else str(pincode)
+
+
+def office_key_for(nearest_post_office):
+    if not nearest_post_office or "error" in nearest_post_office:
+        return None
+    if not nearest_post_office.get("pincode") or not nearest_post_office.get("name"):
+        return None
+    return office_key(nearest_post_office["pincode"], nearest_post_office["name"])
+
+
+def _pending_ref(db, key, post_id):
+    return db.collection(PENDING_BY_OFFICE).document(key).collection("posts").document(str(post_id))
+
+
+# Function to add a freshly received post to the pending-by-office index
+def index_pending_post(db, batch, post_id, data):
+    if data.get("isDelivered"):
+        return
+    nearest_post_office = data.get("nearest_post_office") or {}
+    key = office_key_for(nearest_post_office)
+    geocoded_info = data.get("geocoded_info") or {}
+    latitude = geocoded_info.get("latitude")
+    longitude = geocoded_info.get("longitude")
+    if key is None or latitude is None or longitude is None:
+        return
+
+    receiver_details = data.get("receiver_details") or {}
+    batch.set(_pending_ref(db, key, post_id), {
+        "post_id": str(post_id),
+        "latitude": latitude,
+        "longitude": longitude,
+        "address": geocoded_info.get("formattedAddress") or receiver_details.get("address"),
+        "name": receiver_details.get("name"),
+        "office": {
+            "name": nearest_post_office.get("name"),
+            "pincode": nearest_post_office.get("pincode"),
+            "latitude": nearest_post_office.get("latitude"),
+            "longitude": nearest_post_office.get("longitude"),
+        },
+    })
+
+
+# Function to drop a delivered post from the pending-by-office index
+def unindex_pending_post(db, batch, post_id, nearest_post_office):
+    key = office_key_for(nearest_post_office)
+    if key is None:
+        return
+    batch.delete(_pending_ref(db, key, post_id))
+
+
+# Function to read the undelivered posts of one office
+def fetch_pending_posts(db, key):
+    office = None
+    posts = []
+    for snapshot in db.collection(PENDING_BY_OFFICE).document(key).collection("posts").stream():
+        post = snapshot.to_dict()
+        office = post.pop("office", None) or office
+        post.setdefault("post_id", snapshot.id)
+        posts.append(post)
+    if not posts:
+        return None, []
+    return office or {}, posts
+
+
+# Function to pick the booking date/time of a post from its first event
+def _scanned_at(data):
+    events = data.get("events") or []
+    if events and events[0].get("date"):
+        return events[0]["date"], events[0].get("time")
+    updated_at = data.get("updated_at")
+    if isinstance(updated_at, datetime):
+        return updated_at.strftime("%Y-%m-%d"), updated_at.strftime("%I:%M %p")
+    now = datetime.now()
+    return now.strftime("%Y-%m-%d"), now.strftime("%I:%M %p")
+
+
+# Function to add a post to its destination office's manifest for the day
+def index_manifest_post(db, batch, post_id, data):
+    nearest_post_office = data.get("nearest_post_office") or {}
+    key = office_key_for(nearest_post_office)
+    if key is None:
+        key = office_key("unknown", "unknown")
+        nearest_post_office = {"name": "Unknown", "pincode": "Unknown"}
+
+    date, scanned_time = _scanned_at(data)
+    receiver_details = data.get("receiver_details") or {}
+    batch.set(db.collection(DISPATCH_MANIFESTS).document(f"{date}_{key}"), {
+        "date": date,
+        "office_key": key,
+        "office": {
+            "name": nearest_post_office.get("name"),
+            "pincode": nearest_post_office.get("pincode"),
+        },
+        "posts": {
+            str(post_id): {
+                "time": scanned_time,
+                "receiver_pincode": receiver_details.get("pincode"),
+            }
+        },
+    }, merge=True)
+
+
+# Function to read the dispatch manifests of one day, optionally for one office
+def fetch_manifests(db, date, key=None):
+    if key:
+        doc = db.collection(DISPATCH_MANIFESTS).document(f"{date}_{key}").get()
+        snapshots = [doc] if doc.exists else []
+    else:
+        snapshots = db.collection(DISPATCH_MANIFESTS).where(filter=firestore.FieldFilter("date", "==", date)).stream()
+
+    manifests = []
+    for snapshot in snapshots:
+        data = snapshot.to_dict()
+        posts = data.get("posts") or {}
+        manifests.append({
+            "date": data.get("date"),
+            "office_key": data.get("office_key"),
+            "office": data.get("office") or {},
+            "count": len(posts),
+            "post_ids": sorted(posts),
+        })
+    manifests.sort(key=lambda m: (str(m["office"].get("pincode")), str(m["office"].get("name"))))
+    return manifests
+
+
+# Function to map a post to the normalised phone number of its receiver or sender
+def index_phone_post(db, batch, post_id, raw_phone, role):
+    phone = normalise_phone_number(raw_phone)
+    if phone is None:
+        return None
+    ref = db.collection(PHONE_INDEX).document(phone).collection("posts").document(str(post_id))
+    batch.set(ref, {"post_id": str(post_id), "roles": firestore.ArrayUnion([role]), "created_at": datetime.now()},
+              merge=True)
+    return phone
+
+
+# Function to page through the post_ids of a phone number, newest first
+def fetch_posts_by_phone(db, raw_phone, limit=20, cursor=None):
+    phone = normalise_phone_number(raw_phone)
+    if phone is None:
+        return None, [], None
+    query = (db.collection(PHONE_INDEX).document(phone).collection("posts")
+             .order_by("post_id", direction=firestore.Query.DESCENDING))
+    if cursor:
+        query = query.start_after({"post_id": str(cursor)})
+    entries = [snapshot.to_dict() for snapshot in query.limit(limit + 1).stream()]
+    next_cursor = entries[limit - 1]["post_id"] if len(entries) > limit else None
+    return phone, entries[:limit], next_cursor
+
+
+# Function to add every stored post to the indexes above, e.g. after deploying a new one
+def backfill(db, batch_size=100):
+    counts = {"posts": 0, "pending": 0}
+    batch = db.batch()
+    pending_in_batch = 0
+    for snapshot in db.collection("post_details").stream():
+        data = snapshot.to_dict() or {}
+        post_id = snapshot.id
+        counts["pending"] += not data.get("isDelivered")
+        index_pending_post(db, batch, post_id, data)
+        index_manifest_post(db, batch, post_id, data)
+        index_phone_post(db, batch, post_id, (data.get("receiver_details") or {}).get("phone_number"), "receiver")
+        index_phone_post(db, batch, post_id, (data.get("sender_details") or {}).get("PhoneNumber"), "sender")
+        counts["posts"] += 1
+        pending_in_batch += 1
+        if pending_in_batch >= batch_size:  # 4 writes per post, Firestore batches stop at 500
+            batch.commit()
+            batch = db.batch()
+            pending_in_batch = 0
+    if pending_in_batch:
+        batch.commit()
+    return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Maintain the secondary indexes over post_details.")
+    parser.add_argument("command", choices=["backfill"])
+    args = parser.parse_args()
+
+    import firebase_admin
+    from firebase_admin import credentials
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    if not firebase_admin._apps:
+        firebase_admin.initialize_app(credentials.Certificate(os.path.abspath(os.getenv("FIREBASE_CREDENTIALS"))))
+    print(backfill(firestore.client()))
+    sys.exit(0)
@@ -0,0 +1,416 @@
+import os
+import sys
+import json
+import time
+import random
+import sqlite3
+import argparse
+import threading
+from datetime import datetime
+
+from google.api_core.exceptions import AlreadyExists
+
+from indexes import index_pending_post, index_manifest_post, index_phone_post
+
+# Local write-behind journal for post writes.
+# receiver.py and sender.py append each write to a SQLite (WAL) journal and
+# return; a flusher drains it to Firestore in grouped batch commits, retrying
+# failed entries with exponential backoff. A Firestore outage therefore delays
+# posts instead of dropping them, and a slow Firestore no longer blocks a scan.
+#
+# The flusher normally runs inside server.py (every gunicorn worker runs one;
+# entries are leased so two workers never push the same entry at once). When
+# receiver.py/sender.py run on their own they drain their entry inline.
+# An entry that still fails after JOURNAL_MAX_ATTEMPTS tries is moved to the
+# dead_letters table (`python journal.py dead` / `requeue`) instead of being
+# retried forever.
+
+JOURNAL_PATH = os.getenv("POST_JOURNAL", "post_journal.db")
+FLUSH_INTERVAL = float(os.getenv("JOURNAL_FLUSH_INTERVAL", 0.5))
+FLUSH_MAX_ENTRIES = int(os.getenv("JOURNAL_FLUSH_MAX_ENTRIES", 100))
+LEASE_SECONDS = 60
+MAX_BACKOFF_SECONDS = 300
+MAX_ATTEMPTS = int(os.getenv("JOURNAL_MAX_ATTEMPTS", 20))  # ~1.5 hours of retries at the capped backoff
+BATCH_WRITE_LIMIT = 480  # Firestore allows 500 writes per batch
+
+# Set by server.py so its subprocesses leave draining to the server's flusher
+FLUSHER_ENV = "POST_JOURNAL_FLUSHER"
+
+
+def _encode(value):
+    if isinstance(value, datetime):
+        return {"__datetime__": value.isoformat()}
+    raise TypeError(f"Cannot journal {type(value).__name__}")
+
+
+def _decode(obj):
+    if set(obj) == {"__datetime__"}:
+        return datetime.fromisoformat(obj["__datetime__"])
+    return obj
+
+
+# Functions that turn a journal entry into Firestore batch writes.
+# Every handler must be idempotent: an entry can be replayed after a crash,
+# possibly after hub scans or a delivery have already updated the post.
+# `existing` maps the post_ids of the batch already in post_details to their stored fields.
+def _apply_receiver_post(db, batch, post_id, data, existing):
+    ref = db.collection("post_details").document(post_id)
+    if post_id not in existing:
+        # create() fails the commit if the post appeared since the existence check
+        batch.create(ref, data)
+    elif "receiver_details" in existing[post_id]:
+        # Written before (with its index entries, in the same batch); replaying would
+        # reset isDelivered and events and put a delivered post back in the pending index
+        return
+    else:
+        # The sender details (or a hub scan) reached Firestore first, e.g. while this entry
+        # was backing off: add only the fields the post is missing, so a stored
+        # isDelivered / events is kept, and index the post as it now stands
+        stored = existing[post_id]
+        batch.set(ref, {key: value for key, value in data.items() if key not in stored}, merge=True)
+        data = dict(data, **stored)
+    index_pending_post(db, batch, post_id, data)
+    index_manifest_post(db, batch, post_id, data)
+    index_phone_post(db, batch, post_id, (data.get("receiver_details") or {}).get("phone_number"), "receiver")
+
+
+def _apply_sender_details(db, batch, post_id, data, existing):
+    batch.set(db.collection("post_details").document(post_id), {"sender_details": data}, merge=True)
+    index_phone_post(db, batch, post_id, (data or {}).get("PhoneNumber"), "sender")
+
+
+HANDLERS = {
+    "receiver_post": (_apply_receiver_post, 4),
+    "sender_details": (_apply_sender_details, 2),
+}
+CREATES = {"receiver_post"}  # Kinds whose handler needs to know if the post exists
+
+
+def _existing_posts(db, rows):
+    refs = [db.collection("post_details").document(post_id) for _, kind, post_id, _, _ in rows if kind in CREATES]
+    if not refs:
+        return {}
+    return {snapshot.id: snapshot.to_dict() for snapshot in db.get_all(refs) if snapshot.exists}
+
+
+class PostJournal:
+    def __init__(self, path=JOURNAL_PATH):
+        self.path = path
+        self._local = threading.local()
+        self.stats = {"appended": 0, "flushed": 0, "commits": 0, "failures": 0,
+                      "last_flush_at": None, "last_error": None}
+        conn = self._connect()
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS entries (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                post_id TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL DEFAULT 0,
+                lease_until REAL NOT NULL DEFAULT 0,
+                last_error TEXT
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS entries_post_id ON entries (post_id)")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS dead_letters (
+                id INTEGER PRIMARY KEY,
+                kind TEXT NOT NULL,
+                post_id TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                attempts INTEGER NOT NULL,
+                last_error TEXT,
+                failed_at REAL NOT NULL
+            )
+        """)
+
+    def _connect(self):
+        # One connection per thread, and never one inherited across a gunicorn fork
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=FULL")  # An appended post survives power loss
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def append(self, kind, post_id, payload):
+        if kind not in HANDLERS:
+            raise ValueError(f"Unknown journal entry kind: {kind}")
+        conn = self._connect()
+        cursor = conn.execute(
+            "INSERT INTO entries (kind, post_id, payload, created_at) VALUES (?, ?, ?, ?)",
+            (kind, str(post_id), json.dumps(payload, default=_encode), time.time()),
+        )
+        self.stats["appended"] += 1
+        return cursor.lastrowid
+
+    def _claim(self, limit, post_id=None):
+        now = time.time()
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            query = """
+                SELECT id, kind, post_id, payload, attempts FROM entries
+                WHERE next_attempt_at <= ? AND lease_until <= ?
+            """
+            params = [now, now]
+            if post_id is not None:
+                query += " AND post_id = ?"
+                params.append(str(post_id))
+            rows = conn.execute(query + " ORDER BY id LIMIT ?", params + [limit]).fetchall()
+            if rows:
+                conn.execute(f"UPDATE entries SET lease_until = ? WHERE id IN ({','.join('?' * len(rows))})",
+                             [now + LEASE_SECONDS] + [row[0] for row in rows])
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return rows
+
+    def _commit(self, db, rows):
+        existing = _existing_posts(db, rows)
+        batch = db.batch()
+        for _, kind, post_id, payload, _ in rows:
+            handler, _ = HANDLERS[kind]
+            handler(db, batch, post_id, json.loads(payload, object_hook=_decode), existing)
+        batch.commit()
+        self.stats["commits"] += 1
+
+    def _done(self, rows):
+        self._connect().execute(f"DELETE FROM entries WHERE id IN ({','.join('?' * len(rows))})", [row[0] for row in rows])
+        self.stats["flushed"] += len(rows)
+        self.stats["last_flush_at"] = time.time()
+
+    def _failed(self, row, error):
+        attempts = row[4] + 1
+        self.stats["failures"] += 1
+        self.stats["last_error"] = str(error)
+        conn = self._connect()
+        if attempts >= MAX_ATTEMPTS:
+            self._dead_letter(conn, row[0], attempts, error)
+            print(f"Journal entry {row[0]} ({row[1]} {row[2]}) failed {attempts} times, moved to dead_letters: {error}")
+            return
+        delay = min(MAX_BACKOFF_SECONDS, 2 ** attempts) * random.uniform(0.5, 1.0)
+        conn.execute(
+            "UPDATE entries SET attempts = ?, next_attempt_at = ?, lease_until = 0, last_error = ? WHERE id = ?",
+            (attempts, time.time() + delay, str(error)[:500], row[0]),
+        )
+        print(f"Error flushing journal entry {row[0]} ({row[1]} {row[2]}), retry in {delay:.0f}s: {error}")
+
+    def _dead_letter(self, conn, entry_id, attempts, error):
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("""
+                INSERT INTO dead_letters (id, kind, post_id, payload, created_at, attempts, last_error, failed_at)
+                SELECT id, kind, post_id, payload, created_at, ?, ?, ? FROM entries WHERE id = ?
+            """, (attempts, str(error)[:500], time.time(), entry_id))
+            conn.execute("DELETE FROM entries WHERE id = ?", (entry_id,))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def dead_letters(self, limit=100):
+        rows = self._connect().execute(
+            "SELECT id, kind, post_id, attempts, last_error, failed_at FROM dead_letters ORDER BY id LIMIT ?",
+            (limit,)).fetchall()
+        return [dict(zip(("id", "kind", "post_id", "attempts", "last_error", "failed_at"), row)) for row in rows]
+
+    def requeue(self, entry_ids=None):
+        """Move dead letters (all, or the given ids) back into the journal for another round of retries."""
+        conn = self._connect()
+        where, params = "", []
+        if entry_ids:
+            where = f" WHERE id IN ({','.join('?' * len(entry_ids))})"
+            params = list(entry_ids)
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            moved = conn.execute(f"""
+                INSERT INTO entries (id, kind, post_id, payload, created_at)
+                SELECT id, kind, post_id, payload, created_at FROM dead_letters{where}
+            """, params).rowcount
+            conn.execute(f"DELETE FROM dead_letters{where}", params)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return moved
+
+    def flush_once(self, db, post_id=None):
+        """Push up to FLUSH_MAX_ENTRIES due entries to Firestore; returns how many were written."""
+        rows = self._claim(FLUSH_MAX_ENTRIES, post_id)
+        if not rows:
+            return 0
+
+        # Group entries into batches under Firestore's write limit
+        groups, current, writes = [], [], 0
+        for row in rows:
+            cost = HANDLERS[row[1]][1]
+            if current and writes + cost > BATCH_WRITE_LIMIT:
+                groups.append(current)
+                current, writes = [], 0
+            current.append(row)
+            writes += cost
+        groups.append(current)
+
+        written = 0
+        for group in groups:
+            try:
+                self._commit(db, group)
+                self._done(group)
+                written += len(group)
+                continue
+            except Exception as e:
+                if len(group) == 1:
+                    self._failed(group[0], e)
+                    continue
+            # One bad entry must not hold back the rest: retry them one by one
+            for row in group:
+                try:
+                    self._commit(db, [row])
+                    self._done([row])
+                    written += 1
+                except Exception as e:
+                    self._failed(row, e)
+        return written
+
+    def drain(self, db, post_id=None, max_seconds=10):
+        """Flush until nothing is due (or max_seconds pass); used when no server flusher runs."""
+        deadline = time.time() + max_seconds
+        while time.time() < deadline:
+            if not self.flush_once(db, post_id):
+                break
+        return self.pending(post_id) == 0
+
+    def pending(self, post_id=None):
+        conn = self._connect()
+        if post_id is None:
+            return conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        return conn.execute("SELECT COUNT(*) FROM entries WHERE post_id = ?", (str(post_id),)).fetchone()[0]
+
+    def wait_for(self, post_id, timeout=30):
+        """Block until every journaled write of post_id has reached Firestore."""
+        deadline = time.time() + timeout
+        while self.pending(post_id):
+            if time.time() >= deadline:
+                return False
+            time.sleep(0.1)
+        return True
+
+    def metrics(self):
+        conn = self._connect()
+        now = time.time()
+        pending, oldest, retrying, max_attempts = conn.execute(
+            "SELECT COUNT(*), MIN(created_at), SUM(attempts > 0), MAX(attempts) FROM entries"
+        ).fetchone()
+        dead_letters, = conn.execute("SELECT COUNT(*) FROM dead_letters").fetchone()
+        last_flush_at = self.stats["last_flush_at"]
+        return {
+            "pending": pending,
+            "dead_letters": dead_letters,
+            "retrying": retrying or 0,
+            "max_attempts": max_attempts or 0,
+            "lag_seconds": round(now - oldest, 3) if oldest else 0.0,
+            "seconds_since_last_flush": round(now - last_flush_at, 3) if last_flush_at else None,
+            "appended": self.stats["appended"],
+            "flushed": self.stats["flushed"],
+            "commits": self.stats["commits"],
+            "failures": self.stats["failures"],
+            "last_error": self.stats["last_error"],
+        }
+
+
+class JournalFlusher:
+    def __init__(self, journal, get_db, interval=FLUSH_INTERVAL):
+        self.journal = journal
+        self._get_db = get_db
+        self._interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="post-journal-flusher", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                written = self.journal.flush_once(self._get_db())
+            except Exception as e:
+                print(f"Error in journal flusher: {e}")
+                written = 0
+            # Keep going without pause while there is a backlog
+            if written < FLUSH_MAX_ENTRIES:
+                self._stop.wait(self._interval)
+
+
+_journal = None
+_journal_lock = threading.Lock()
+
+
+def get_journal():
+    global _journal
+    with _journal_lock:
+        if _journal is None:
+            _journal = PostJournal(JOURNAL_PATH)
+        return _journal
+
+
+# Function used by receiver.py/sender.py to record a post write.
+# Returns True once the write is in Firestore, False if it is only journaled so far.
+def record_write(db, kind, post_id, payload):
+    try:
+        get_journal().append(kind, post_id, payload)
+    except Exception as e:
+        # Journal unavailable (disk full, read-only FS): write straight through as before
+        print(f"Error writing to post journal, writing directly: {e}")
+        batch = db.batch()
+        row = (None, kind, str(post_id), None, 0)
+        HANDLERS[kind][0](db, batch, str(post_id), payload, _existing_posts(db, [row]))
+        try:
+            batch.commit()
+        except AlreadyExists:
+            pass  # Same post already stored
+        return True
+    if os.getenv(FLUSHER_ENV) == "server":
+        return False
+    if not get_journal().drain(db, post_id):
+        print(f"Post {post_id} is journaled; Firestore write will be retried by the flusher")
+        return False
+    return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect or drain the local post journal.")
+    parser.add_argument("command", choices=["status", "flush", "dead", "requeue"])
+    parser.add_argument("ids", nargs="*", type=int, help="dead letter ids for requeue (default: all)")
+    args = parser.parse_args()
+
+    journal = get_journal()
+    if args.command == "dead":
+        print(json.dumps(journal.dead_letters(), indent=4))
+        sys.exit(0)
+    if args.command == "requeue":
+        print(f"Requeued {journal.requeue(args.ids)} entries")
+    if args.command == "flush":
+        import firebase_admin
+        from firebase_admin import credentials, firestore
+        from dotenv import load_dotenv
+
+        load_dotenv()
+        if not firebase_admin._apps:
+            firebase_admin.initialize_app(credentials.Certificate(os.path.abspath(os.getenv("FIREBASE_CREDENTIALS"))))
+        ok = journal.drain(firestore.client(), max_seconds=300)
+        print(json.dumps(journal.metrics(), indent=4))
+        sys.exit(0 if ok else 1)
+    print(json.dumps(journal.metrics(), indent=4))
@@ -0,0 +1,299 @@
+import os
+import re
+import json
+import time
+import asyncio
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from governor import QuotaTimeout
+
+# Micro-batching of LLM address extraction across concurrent jobs.
+# OCR texts submitted within LLM_BATCH_MAX_WAIT_MS of each other (up to
+# LLM_BATCH_MAX_ITEMS) go to the LLM as one numbered request that asks for a
+# JSON array of results keyed by index, so the system prompt is sent once per
+# batch instead of once per envelope. A batch of one uses the normal
+# single-text call, and items missing from a batch reply are retried singly.
+# The LLM can number its answers wrongly, so an item is only used for a text
+# that contains the item's pincode and phone number and a word of its name;
+# anything that fits no text, or more than one, is retried singly too.
+#
+# Batching only happens between extractions running in the same process:
+# LLMBatcher serves the address blocks of one photo in receiver.py --batch
+# (/upload_batch) and AsyncLLMBatcher serves async_pipeline.py. The default
+# server.py flow runs receiver.py and sender.py once per envelope, with one
+# text each, so those calls are never batched (LLM_BATCH has no effect there).
+
+BATCH_ENABLED = os.getenv("LLM_BATCH", "1") == "1"
+MAX_ITEMS = int(os.getenv("LLM_BATCH_MAX_ITEMS", 8))
+MAX_WAIT_MS = float(os.getenv("LLM_BATCH_MAX_WAIT_MS", 30))
+COMPLETION_TOKENS_PER_ITEM = 200
+
+FIELDS = ("Name", "PhoneNumber", "Address", "Pincode")
+
+BATCH_INSTRUCTIONS = """
+                    You will be given several OCR texts, each starting with its index in square brackets, e.g. [0].
+                    Answer with one JSON array only, holding one object per text, in the same order:
+                    [{"index": 0, "Name": "value", "PhoneNumber": "value", "Address": "value", "Pincode": "value"}]
+                    """
+
+
+# Function to build the chat messages for one batched request
+def batch_messages(prompt, texts):
+    numbered = "\n\n".join(f"[{i}] {text}" for i, text in enumerate(texts))
+    return [
+        {"role": "system", "content": prompt + BATCH_INSTRUCTIONS},
+        {"role": "user", "content": numbered},
+    ]
+
+
+def batch_max_tokens(count):
+    return min(8000, max(1024, COMPLETION_TOKENS_PER_ITEM * count * 2))
+
+
+def _digits(value):
+    return re.sub(r"\D", "", str(value or ""))
+
+
+# Function to check that a result was read from this text: its pincode and phone digits
+# must appear in the text, and so must a word of its name (envelopes of one bulk
+# mailing often share a pincode and carry no phone number)
+def matches_text(item, text):
+    digits = _digits(text)
+    pincode = _digits(item.get("Pincode"))
+    phone = _digits(item.get("PhoneNumber"))[-10:]
+    names = [word for word in re.findall(r"[^\W\d_]+", str(item.get("Name") or "").casefold()) if len(word) >= 3]
+    if not (pincode or phone or names):
+        return False
+    folded = (text or "").casefold()
+    return (all(value in digits for value in (pincode, phone) if value)
+            and (not names or any(word in folded for word in names)))
+
+
+# Function to read a batched reply into {index: result} for texts; unusable or unverifiable items are left out
+def parse_batch_reply(content, texts):
+    count = len(texts)
+    match = re.search(r"\[.*\]", content or "", re.DOTALL)
+    if not match:
+        print("No valid JSON array found in batched response.")
+        return {}
+    try:
+        items = json.loads(match.group(0))
+    except json.JSONDecodeError as e:
+        print("Error decoding batched JSON(llama):", e)
+        return {}
+    if not isinstance(items, list):
+        return {}
+
+    results = {}
+    misplaced = []
+    for position, item in enumerate(items):
+        if not isinstance(item, dict) or not any(field in item for field in FIELDS):
+            continue
+        item = dict(item)
+        try:
+            index = int(item.pop("index", position))
+        except (TypeError, ValueError):
+            index = None
+        if index is not None and 0 <= index < count and index not in results and matches_text(item, texts[index]):
+            results[index] = item
+        else:
+            misplaced.append(item)
+
+    # A shuffled or mis-numbered item is kept only if exactly one remaining text fits it
+    dropped = 0
+    for item in misplaced:
+        fits = [i for i in range(count) if i not in results and matches_text(item, texts[i])]
+        if len(fits) == 1:
+            results[fits[0]] = item
+        else:
+            dropped += 1
+    if dropped:
+        print(f"{dropped} batched results did not match their OCR text; retrying those texts singly")
+    return results
+
+
+def _new_stats():
+    return {"items": 0, "batches": 0, "batched_items": 0, "single_items": 0, "fallback_items": 0, "llm_requests": 0}
+
+
+def _metrics(stats):
+    items, batches = stats["items"], stats["batches"]
+    batched = stats["batched_items"] + stats["fallback_items"]
+    return dict(stats,
+                average_batch_size=round(batched / batches, 2) if batches else None,
+                requests_per_item=round(stats["llm_requests"] / items, 3) if items else None)
+
+
+class LLMBatcher:
+    """Thread-side batcher: extract(text) blocks until its result is in."""
+
+    def __init__(self, send_batch, single, max_items=MAX_ITEMS, max_wait_ms=MAX_WAIT_MS, workers=4):
+        self._send_batch = send_batch  # (texts) -> reply text holding a JSON array
+        self._single = single          # (text) -> result dict or None
+        self._max_items = max_items
+        self._max_wait = max_wait_ms / 1000
+        self._cond = threading.Condition()
+        self._queue = []  # (text, future)
+        self._thread = None
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="llm-batch")
+        self.stats = _new_stats()
+
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="llm-batcher", daemon=True)
+            self._thread.start()
+
+    def submit(self, text):
+        future = Future()
+        with self._cond:
+            self._queue.append((text, future))
+            self.stats["items"] += 1
+            self._ensure_thread()
+            self._cond.notify()
+        return future
+
+    def extract(self, text):
+        return self.submit(text).result()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                deadline = time.monotonic() + self._max_wait
+                while len(self._queue) < self._max_items:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                items, self._queue = self._queue[:self._max_items], self._queue[self._max_items:]
+            self._executor.submit(self._dispatch, items)
+
+    def _count(self, name):
+        # Dispatches run on the executor threads; the counters share the queue's lock
+        with self._cond:
+            self.stats[name] += 1
+
+    def _resolve(self, future, text):
+        self._count("llm_requests")
+        try:
+            future.set_result(self._single(text))
+        except Exception as e:
+            future.set_exception(e)
+
+    def _dispatch(self, items):
+        if len(items) == 1:
+            self._count("single_items")
+            self._resolve(items[0][1], items[0][0])
+            return
+
+        texts = [text for text, _ in items]
+        self._count("batches")
+        self._count("llm_requests")
+        try:
+            results = parse_batch_reply(self._send_batch(texts), texts)
+        except QuotaTimeout as e:
+            # Single calls would wait on the same quota; the callers retry later
+            for _, future in items:
+                future.set_exception(e)
+            return
+        except Exception as e:
+            print(f"Error in batched extraction of {len(texts)} texts: {e}")
+            results = {}
+
+        for i, (text, future) in enumerate(items):
+            if i in results:
+                self._count("batched_items")
+                future.set_result(results[i])
+            else:
+                self._count("fallback_items")
+                self._executor.submit(self._resolve, future, text)
+
+    def metrics(self):
+        with self._cond:
+            return _metrics(self.stats)
+
+
+class AsyncLLMBatcher:
+    """asyncio batcher: await extract(text); send_batch and single are coroutine functions."""
+
+    def __init__(self, send_batch, single, max_items=MAX_ITEMS, max_wait_ms=MAX_WAIT_MS):
+        self._send_batch = send_batch
+        self._single = single
+        self._max_items = max_items
+        self._max_wait = max_wait_ms / 1000
+        self._queue = []  # (text, future)
+        self._timer = None
+        self._tasks = set()
+        self.stats = _new_stats()
+
+    async def extract(self, text):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._queue.append((text, future))
+        self.stats["items"] += 1
+        if len(self._queue) >= self._max_items:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self._max_wait, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        while self._queue:
+            items, self._queue = self._queue[:self._max_items], self._queue[self._max_items:]
+            self._spawn(self._dispatch(items))
+
+    def _spawn(self, coro):
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _resolve(self, future, text):
+        self.stats["llm_requests"] += 1
+        try:
+            result = await self._single(text)
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+            return
+        if not future.done():
+            future.set_result(result)
+
+    async def _dispatch(self, items):
+        if len(items) == 1:
+            self.stats["single_items"] += 1
+            await self._resolve(items[0][1], items[0][0])
+            return
+
+        texts = [text for text, _ in items]
+        self.stats["batches"] += 1
+        self.stats["llm_requests"] += 1
+        try:
+            results = parse_batch_reply(await self._send_batch(texts), texts)
+        except QuotaTimeout as e:
+            for _, future in items:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        except Exception as e:
+            print(f"Error in batched extraction of {len(texts)} texts: {e}")
+            results = {}
+
+        fallbacks = []
+        for i, (text, future) in enumerate(items):
+            if future.done():
+                continue
+            if i in results:
+                self.stats["batched_items"] += 1
+                future.set_result(results[i])
+            else:
+                self.stats["fallback_items"] += 1
+                fallbacks.append(self._resolve(future, text))
+        await asyncio.gather(*fallbacks)
+
+    def metrics(self):
+        return _metrics(self.stats)
@@ -0,0 +1,290 @@
+import os
+import re
+import sys
+import json
+import time
+import atexit
+import hashlib
+import sqlite3
+import argparse
+import threading
+
+from cachetools import LRUCache
+
+# Cache of parsed Name/PhoneNumber/Address/Pincode results.
+# The same senders (businesses, government offices) appear on thousands of
+# envelopes with near-identical OCR text, so results are keyed by the OCR text
+# with case, punctuation and whitespace folded, plus the model and a hash of
+# the prompt (editing a prompt starts a fresh cache). Lookups go to an
+# in-process LRU first, then to a SQLite file shared by all processes.
+# Hit/miss counters and last-used times are kept in memory and written every
+# LLM_CACHE_FLUSH_SECONDS (and at exit), so a lookup is not a disk write.
+#
+# Cached results are receivers' and senders' names, phone numbers and
+# addresses, i.e. personal data. They are kept for LLM_CACHE_TTL_DAYS (7 by
+# default; raise it only if your data retention policy allows): expired
+# entries are never served and are deleted by the hourly prune of the next
+# process that uses the cache. Keys are hashes, so the OCR text itself is not
+# stored. `python llm_cache.py clear` erases everything.
+
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE", "1") == "1"
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", "llm_cache.db")
+MEMORY_ENTRIES = int(os.getenv("LLM_CACHE_MEMORY_ENTRIES", 2048))
+DISK_ENTRIES = int(os.getenv("LLM_CACHE_DISK_ENTRIES", 100000))
+TTL_DAYS = float(os.getenv("LLM_CACHE_TTL_DAYS", 7))
+FLUSH_SECONDS = float(os.getenv("LLM_CACHE_FLUSH_SECONDS", 30))
+MIN_CHARS = 12        # Shorter texts are OCR failures, not addresses worth remembering
+PRUNE_INTERVAL_SECONDS = 3600
+
+_PUNCTUATION = re.compile(r"[\W_]+", re.UNICODE)
+
+
+# Function to fold OCR text so trivial differences share a cache entry
+def normalise_text(text):
+    return _PUNCTUATION.sub(" ", (text or "").casefold()).strip()
+
+
+def prompt_version(prompt):
+    return hashlib.sha1(prompt.encode("utf-8")).hexdigest()[:8]
+
+
+def cache_key(text, model, prompt):
+    normalised = normalise_text(text)
+    if len(normalised) < MIN_CHARS:
+        return None
+    return hashlib.sha256(f"{model}\0{prompt_version(prompt)}\0{normalised}".encode("utf-8")).hexdigest()
+
+
+class LLMCache:
+    def __init__(self, path=LLM_CACHE_PATH, memory_entries=MEMORY_ENTRIES, disk_entries=DISK_ENTRIES, ttl_days=TTL_DAYS,
+                 flush_seconds=FLUSH_SECONDS):
+        self.path = path
+        self.disk_entries = disk_entries
+        self.ttl = ttl_days * 86400
+        self.flush_seconds = flush_seconds
+        self._memory = LRUCache(maxsize=memory_entries)  # key -> (result JSON, created_at)
+        self._memory_lock = threading.Lock()
+        self._local = threading.local()
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0}
+        self._stats_lock = threading.Lock()
+        self._unflushed_counts = {}  # counter name -> increments not yet written
+        self._unflushed_uses = {}    # key -> (last_used, hits) of disk hits not yet written
+        self._flushed_at = time.time()
+        conn = self._connect()
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY,
+                model TEXT NOT NULL,
+                result TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_used REAL NOT NULL,
+                hits INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)")
+        conn.execute("CREATE INDEX IF NOT EXISTS entries_created_at ON entries (created_at)")
+        # Counters shared by every process, since receiver.py/sender.py exit after one envelope
+        # (plus "pruned_at", the time of the last prune)
+        conn.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        atexit.register(self.flush)
+        try:
+            self._prune_if_due()
+        except sqlite3.Error as e:
+            print(f"Error pruning LLM cache: {e}")
+
+    def _connect(self):
+        # One connection per thread, and never one inherited across a gunicorn fork
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")  # A lost entry is just one more LLM call
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _count(self, name, key=None):
+        now = time.time()
+        with self._stats_lock:
+            self.stats[name] += 1
+            self._unflushed_counts[name] = self._unflushed_counts.get(name, 0) + 1
+            if key is not None:
+                _, hits = self._unflushed_uses.get(key, (now, 0))
+                self._unflushed_uses[key] = (now, hits + 1)
+            due = now - self._flushed_at >= self.flush_seconds
+        if due:
+            self.flush()
+
+    def flush(self):
+        """Write the counters and last-used times gathered since the last flush in one transaction."""
+        with self._stats_lock:
+            counts, self._unflushed_counts = self._unflushed_counts, {}
+            uses, self._unflushed_uses = self._unflushed_uses, {}
+            self._flushed_at = time.time()
+        try:
+            if counts or uses:
+                conn = self._connect()
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    conn.executemany(
+                        "INSERT INTO counters (name, value) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+                        counts.items())
+                    conn.executemany("UPDATE entries SET last_used = MAX(last_used, ?), hits = hits + ? WHERE key = ?",
+                                     [(last_used, hits, key) for key, (last_used, hits) in uses.items()])
+                    conn.execute("COMMIT")
+                except BaseException:
+                    conn.execute("ROLLBACK")
+                    raise
+            self._prune_if_due()
+        except sqlite3.Error as e:
+            print(f"Error updating LLM cache counters: {e}")
+
+    def _prune_if_due(self):
+        conn = self._connect()
+        row = conn.execute("SELECT value FROM counters WHERE name = 'pruned_at'").fetchone()
+        now = time.time()
+        if row is not None and now - row[0] < PRUNE_INTERVAL_SECONDS:
+            return
+        conn.execute("INSERT OR REPLACE INTO counters (name, value) VALUES ('pruned_at', ?)", (int(now),))
+        self.prune()
+
+    def get(self, text, model, prompt):
+        """Cached result for text, or None."""
+        key = cache_key(text, model, prompt)
+        if key is None:
+            return None
+        with self._memory_lock:
+            stored = self._memory.get(key)
+        if stored is not None and time.time() - stored[1] <= self.ttl:
+            self._count("memory_hits")
+            return json.loads(stored[0])
+
+        try:
+            conn = self._connect()
+            row = conn.execute("SELECT result, created_at FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is not None and time.time() - row[1] <= self.ttl:
+                with self._memory_lock:
+                    self._memory[key] = row
+                self._count("disk_hits", key)
+                return json.loads(row[0])
+        except sqlite3.Error as e:
+            print(f"Error reading LLM cache: {e}")
+        self._count("misses")
+        return None
+
+    def put(self, text, model, prompt, result):
+        key = cache_key(text, model, prompt)
+        if key is None or not isinstance(result, dict):
+            return
+        stored = json.dumps(result)
+        now = time.time()
+        with self._memory_lock:
+            self._memory[key] = (stored, now)
+        try:
+            self._connect().execute(
+                "INSERT OR REPLACE INTO entries (key, model, result, created_at, last_used) VALUES (?, ?, ?, ?, ?)",
+                (key, model, stored, now, now))
+            self._count("stores")
+        except sqlite3.Error as e:
+            print(f"Error writing LLM cache: {e}")
+
+    def cached(self, text, model, prompt, compute):
+        """Return the cached result for text, or compute() it and cache it if it parsed."""
+        result = self.get(text, model, prompt)
+        if result is not None:
+            return result
+        result = compute()
+        self.put(text, model, prompt, result)
+        return result
+
+    def prune(self):
+        """Drop expired entries, then the least recently used beyond the size limit."""
+        conn = self._connect()
+        expired = conn.execute("DELETE FROM entries WHERE created_at < ?", (time.time() - self.ttl,)).rowcount
+        overflow = conn.execute("""
+            DELETE FROM entries WHERE key IN (
+                SELECT key FROM entries ORDER BY last_used DESC LIMIT -1 OFFSET ?
+            )
+        """, (self.disk_entries,)).rowcount
+        return expired + overflow
+
+    def clear(self):
+        with self._memory_lock:
+            self._memory.clear()
+        with self._stats_lock:
+            self._unflushed_counts.clear()
+            self._unflushed_uses.clear()
+        conn = self._connect()
+        conn.execute("DELETE FROM entries")
+        conn.execute("DELETE FROM counters")
+
+    def metrics(self):
+        self.flush()
+        conn = self._connect()
+        counters = dict(conn.execute("SELECT name, value FROM counters").fetchall())
+        entries, = conn.execute("SELECT COUNT(*) FROM entries").fetchone()
+
+        def hit_rate(stats):
+            lookups = stats.get("memory_hits", 0) + stats.get("disk_hits", 0) + stats.get("misses", 0)
+            return round((lookups - stats.get("misses", 0)) / lookups, 4) if lookups else None
+
+        return {
+            "entries": entries,
+            "memory_entries": len(self._memory),
+            "hit_rate": hit_rate(counters),
+            "all_processes": {name: counters.get(name, 0) for name in self.stats},
+            "this_process": dict(self.stats, hit_rate=hit_rate(self.stats)),
+        }
+
+
+class _NoCache:
+    """LLM_CACHE=0: every extraction goes to the LLM."""
+
+    def get(self, *args):
+        return None
+
+    def put(self, *args):
+        pass
+
+    def cached(self, text, model, prompt, compute):
+        return compute()
+
+    def metrics(self):
+        return {"enabled": False}
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+# Function to get the shared LLM result cache for this process
+def get_llm_cache():
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            if not LLM_CACHE_ENABLED:
+                _cache = _NoCache()
+            else:
+                try:
+                    _cache = LLMCache(LLM_CACHE_PATH)
+                except sqlite3.Error as e:
+                    print(f"Error opening LLM cache at {LLM_CACHE_PATH}, caching disabled: {e}")
+                    _cache = _NoCache()
+        return _cache
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect, prune or clear the LLM extraction cache.")
+    parser.add_argument("command", choices=["status", "prune", "clear"])
+    args = parser.parse_args()
+
+    cache = get_llm_cache()
+    if not isinstance(cache, LLMCache):
+        print("LLM cache is disabled")
+        sys.exit(1)
+    if args.command == "prune":
+        print(f"Removed {cache.prune()} entries")
+    elif args.command == "clear":
+        cache.clear()
+        print(f"Cleared {LLM_CACHE_PATH}")
+    print(json.dumps(cache.metrics(), indent=4))
@@ -0,0 +1,193 @@
+import io
+import os
+import sys
+import time
+import random
+import shutil
+import signal
+import argparse
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from PIL import Image
+
+import fakes
+
+# Load-test harness for the production serving profile.
+# For every workers x threads configuration it starts
+#   gunicorn -c gunicorn.conf.py wsgi:app
+# with DAKMADAD_FAKE_BACKENDS=1 (in-memory Firestore/S3, no OCR/LLM/SMS
+# subprocesses), hammers /upload, /check_delivery and /delivery_status and
+# reports requests per second and p50/p95/p99 latency per endpoint.
+#
+#   python loadtest.py --configs 1x1,2x4,4x8 --duration 20 --concurrency 64
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ENDPOINTS = ("upload", "check_delivery", "delivery_status")
+
+
+def make_photo(rng):
+    # Fresh noise for every upload: a reused image would be caught by the perceptual
+    # dedup check and only measure the duplicate short-circuit, not the pipeline
+    img = Image.frombytes("L", (64, 64), rng.randbytes(64 * 64))
+    buf = io.BytesIO()
+    img.save(buf, format="JPEG")
+    return buf.getvalue()
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return float("nan")
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def start_server(port, workers, threads, workdir, env_overrides):
+    env = dict(os.environ)
+    env.update(env_overrides)
+    env.update({
+        "DAKMADAD_FAKE_BACKENDS": "1",
+        "PORT": str(port),
+        "GUNICORN_WORKERS": str(workers),
+        "GUNICORN_THREADS": str(threads),
+        "GUNICORN_ACCESS_LOG": "",
+        "GUNICORN_LOG_LEVEL": "warning",
+        "PYTHONPATH": HERE + os.pathsep + env.get("PYTHONPATH", ""),
+    })
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-c", os.path.join(HERE, "gunicorn.conf.py"), "--chdir", workdir, "wsgi:app"],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True,
+    )
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"gunicorn exited early: {proc.stderr.read()}")
+        try:
+            if requests.get(f"http://127.0.0.1:{port}/", timeout=1).status_code == 200:
+                return proc
+        except requests.RequestException:
+            time.sleep(0.2)
+    stop_server(proc)
+    raise RuntimeError("gunicorn did not become ready within 30s")
+
+
+def stop_server(proc):
+    proc.send_signal(signal.SIGTERM)
+    try:
+        proc.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+
+
+def run_load(base_url, duration, concurrency, mix, post_ids):
+    latencies = {name: [] for name in ENDPOINTS}
+    errors = {name: 0 for name in ENDPOINTS}
+    duplicates = [0]
+    lock = threading.Lock()
+    stop_at = time.time() + duration
+    weights = [mix[name] for name in ENDPOINTS]
+    local = threading.local()
+
+    def one_request(rng):
+        endpoint = rng.choices(ENDPOINTS, weights)[0]
+        session = getattr(local, "session", None)
+        if session is None:
+            session = local.session = requests.Session()
+        duplicate = False
+        if endpoint == "upload":
+            front, rear = make_photo(rng), make_photo(rng)
+        started = time.perf_counter()
+        try:
+            if endpoint == "upload":
+                n = rng.randrange(1 << 30)
+                response = session.post(f"{base_url}/upload", files={
+                    "photo1": (f"lt_{n}_front.jpg", front, "image/jpeg"),
+                    "photo2": (f"lt_{n}_rear.jpg", rear, "image/jpeg"),
+                }, data={"id1": "1", "id2": "2"}, timeout=30)
+                ok = response.status_code == 200
+                duplicate = ok and response.json().get("duplicate", False)
+            else:
+                response = session.get(f"{base_url}/{endpoint}", params={"post_id": rng.choice(post_ids)},
+                                       allow_redirects=False, timeout=30)
+                ok = response.status_code in (200, 302)
+        except requests.RequestException:
+            ok = False
+        elapsed = time.perf_counter() - started
+        with lock:
+            if ok:
+                latencies[endpoint].append(elapsed)
+            else:
+                errors[endpoint] += 1
+            if duplicate:
+                duplicates[0] += 1
+
+    def client(seed):
+        rng = random.Random(seed)
+        while time.time() < stop_at:
+            one_request(rng)
+
+    started = time.time()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for seed in range(concurrency):
+            pool.submit(client, seed)
+    return latencies, errors, duplicates[0], time.time() - started
+
+
+def report(label, latencies, errors, duplicates, elapsed):
+    total = sum(len(v) for v in latencies.values())
+    print(f"\n== {label}: {total / elapsed:.1f} req/s over {elapsed:.1f}s")
+    print(f"{'endpoint':<18}{'ok':>8}{'err':>6}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    for name in ENDPOINTS:
+        values = sorted(latencies[name])
+        print(f"{name:<18}{len(values):>8}{errors[name]:>6}{len(values) / elapsed:>9.1f}"
+              f"{percentile(values, 50) * 1000:>9.1f}{percentile(values, 95) * 1000:>9.1f}"
+              f"{percentile(values, 99) * 1000:>9.1f}")
+    # Every upload is a new image, so this should stay at 0; anything else skipped the pipeline
+    uploads = len(latencies["upload"])
+    if uploads:
+        print(f"upload duplicates: {duplicates} ({duplicates / uploads:.1%} of ok uploads)")
+
+
+def parse_configs(text):
+    configs = []
+    for item in text.split(","):
+        workers, _, threads = item.strip().partition("x")
+        configs.append((int(workers), int(threads or 1)))
+    return configs
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test server.py under gunicorn against local fakes.")
+    parser.add_argument("--configs", default="1x1,1x8,2x8,4x8", help="Comma separated WORKERSxTHREADS list")
+    parser.add_argument("--duration", type=float, default=15, help="Seconds per configuration")
+    parser.add_argument("--concurrency", type=int, default=32, help="Concurrent client threads")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--mix", default="1,6,3", help="Relative weights of upload,check_delivery,delivery_status")
+    parser.add_argument("--firestore-latency-ms", type=float, default=fakes.FIRESTORE_LATENCY * 1000)
+    parser.add_argument("--pipeline-seconds", type=float, default=fakes.PIPELINE_SECONDS)
+    args = parser.parse_args()
+
+    mix = dict(zip(ENDPOINTS, (float(w) for w in args.mix.split(","))))
+    post_ids = fakes.seeded_post_ids()
+    env_overrides = {
+        "FAKE_FIRESTORE_LATENCY_MS": str(args.firestore_latency_ms),
+        "FAKE_PIPELINE_SECONDS": str(args.pipeline_seconds),
+    }
+
+    for workers, threads in parse_configs(args.configs):
+        workdir = tempfile.mkdtemp(prefix="dakmadad-loadtest-")
+        proc = start_server(args.port, workers, threads, workdir, env_overrides)
+        try:
+            latencies, errors, duplicates, elapsed = run_load(f"http://127.0.0.1:{args.port}", args.duration,
+                                                              args.concurrency, mix, post_ids)
+        finally:
+            stop_server(proc)
+            shutil.rmtree(workdir, ignore_errors=True)
+        report(f"{workers} workers x {threads} threads", latencies, errors, duplicates, elapsed)
+
+
+if __name__ == "__main__":
+    main()
@@ -6,6 +6,8 @@ import re
 import os
 from dotenv import load_dotenv
 from pathlib import Path
+from phones import format_phone_number, is_valid_phone_number
+from governor import get_governor, QuotaTimeout, QUOTA_EXIT_CODE
 
 # Set correct path to .env inside EICGO
 env_path = Path(__file__).parent / "EICGO" / ".env"
@@ -55,20 +57,6 @@ try:
         print(f"Raw Receiver Phone: {raw_receiver_phone}")
         print(f"Raw Sender Phone: {raw_sender_phone}")
 
-        # Function to format phone number to E.164 standard
-        def format_phone_number(phone):
-            if phone:
-                phone = phone.strip()  # Remove any leading or trailing spaces
-                if not phone.startswith("+91") and len(phone) == 10 and phone.isdigit():
-                    phone = f"+91{phone}"  # Add +91 for Indian numbers if missing
-                elif not phone.startswith("+") and phone.isdigit():
-                    phone = f"+{phone}"  # Handle other missing '+' for international numbers
-            return phone
-
-        # Function to validate phone number
-        def is_valid_phone_number(phone):
-            return bool(re.fullmatch(r'\+?[1-9]\d{1,14}$', phone))  # Regex for E.164 format
-
         # Format and validate phone numbers
         receiver_phone = format_phone_number(raw_receiver_phone)
         sender_phone = format_phone_number(raw_sender_phone)
@@ -87,11 +75,12 @@ try:
         # Send message to receiver
         if receiver_phone:
             print(f"Sending message to receiver: {receiver_phone}")
-            message = client.messages.create(
+            # Twilio sends about one SMS per second per number; wait for a slot (see governor.py)
+            message = get_governor().call("twilio", lambda: client.messages.create(
                 to=receiver_phone,
                 from_=twilio_number,
                 body=message_content
-            )
+            ), key=twilio_number)
             print(f"Message sent to receiver: {receiver_phone}, SID: {message.sid}")
         else:
             print("Skipping message to receiver due to invalid phone number.")
@@ -99,11 +88,11 @@ try:
         # Send message to sender
         if sender_phone:
             print(f"Sending message to sender: {sender_phone}")
-            message = client.messages.create(
+            message = get_governor().call("twilio", lambda: client.messages.create(
                 to=sender_phone,
                 from_=twilio_number,
                 body=message_content
-            )
+            ), key=twilio_number)
             print(f"Message sent to sender: {sender_phone}, SID: {message.sid}")
         else:
             print("Skipping message to sender due to invalid phone number.")
@@ -111,5 +100,9 @@ try:
     else:
         print(f"No document found for post_id: {post_id}")
 
+except QuotaTimeout as e:
+    # server.py sends the messages again later
+    print(f"Out of quota: {e}")
+    sys.exit(QUOTA_EXIT_CODE)
 except Exception as e:
     print(f"Error: {e}")
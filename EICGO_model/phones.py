@@ -0,0 +1,34 @@
+import re
+
+# Phone number helpers shared by message.py (SMS) and the track-by-phone index.
+
+
+# Function to format phone number to E.164 standard
+def format_phone_number(phone):
+    if phone:
+        phone = phone.strip()  # Remove any leading or trailing spaces
+        if not phone.startswith("+91") and len(phone) == 10 and phone.isdigit():
+            phone = f"+91{phone}"  # Add +91 for Indian numbers if missing
+        elif not phone.startswith("+") and phone.isdigit():
+            phone = f"+{phone}"  # Handle other missing '+' for international numbers
+    return phone
+
+
+# Function to validate phone number
+def is_valid_phone_number(phone):
+    return bool(phone) and bool(re.fullmatch(r'\+?[1-9]\d{1,14}$', phone))  # Regex for E.164 format
+
+
+# Function to normalise a raw OCR/LLM phone number to E.164, or None
+def normalise_phone_number(phone):
+    if phone is None:
+        return None
+    phone = re.sub(r"[\s\-().]", "", str(phone))  # "74705 59957", "(0731) 255-1234"
+    if len(phone) == 11 and phone.startswith("0") and phone.isdigit():
+        phone = phone[1:]  # Trunk prefix on Indian numbers
+    elif phone.startswith("0091"):
+        phone = "+91" + phone[4:]
+    phone = format_phone_number(phone)
+    if not is_valid_phone_number(phone):
+        return None
+    return phone if phone.startswith("+") else f"+{phone}"
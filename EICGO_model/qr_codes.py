@@ -0,0 +1,65 @@
+import os
+
+import qrcode
+from PIL import Image, ImageDraw, ImageFont
+
+# QR labels stuck on each envelope. Every label can be rebuilt from the
+# post_id and its nearest post office, so old PNGs in QR/ can be deleted
+# (retention.py) and served again on demand by server.py's /qr/<post_id>.
+
+QR_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "QR")
+
+
+# Function to build the URL printed in a post's QR code
+def qr_link_for(post_id):
+    return f"https://cd6d-49-249-229-42.ngrok-free.app/check_delivery?post_id={post_id}"
+
+
+# Function to draw a QR code with the pincode and post office printed above it
+def render_qr_code(data, pincode=None, post_office_name=None):
+    qr = qrcode.make(data)
+    qr_image = qr.convert('RGB')
+
+    margin_top = 50
+    width, height = qr_image.size
+    new_image = Image.new('RGB', (width, height + margin_top), (255, 255, 255))
+    new_image.paste(qr_image, (0, margin_top))
+
+    draw = ImageDraw.Draw(new_image)
+
+    try:
+        font = ImageFont.truetype("arial.ttf", 25)
+    except IOError:
+        font = ImageFont.load_default()
+
+    text = f"Pincode: {pincode}\nPost Office: {post_office_name}"
+    text_bbox = draw.textbbox((0, 0), text, font=font)
+    text_width = text_bbox[2] - text_bbox[0]
+    text_x = (width - text_width) // 2  # Center text horizontally
+    text_y = 10
+
+    draw.text((text_x, text_y), text, font=font, fill="black")
+    return new_image
+
+
+def generate_qr_code(data, pincode=None, post_office_name=None, output_path="qr_code.png"):
+    try:
+        folder_path = QR_FOLDER
+        if not os.path.exists(folder_path):
+            os.makedirs(folder_path)
+
+        new_image = render_qr_code(data, pincode, post_office_name)
+
+        output_path = os.path.join(folder_path, output_path)
+        new_image.save(output_path)
+        print(f"QR code generated and saved as {output_path}")
+
+    except Exception as e:
+        print(f"Error generating QR code: {e}")
+
+
+# Function to rebuild the QR label of a stored post
+def render_post_qr_code(post_id, data):
+    nearest_post_office = data.get("nearest_post_office") or {}
+    return render_qr_code(qr_link_for(post_id), nearest_post_office.get("pincode", "Unknown"),
+                          nearest_post_office.get("name", "Unknown"))
@@ -5,8 +5,11 @@ import math
 import json
 import re
 import time
+import threading
 from datetime import datetime
+from concurrent.futures import Future, ThreadPoolExecutor
 from dotenv import load_dotenv
+from filelock import FileLock
 import firebase_admin
 from firebase_admin import credentials, firestore, initialize_app
 from azure.core.credentials import AzureKeyCredential
@@ -14,8 +17,12 @@ from azure.ai.formrecognizer import DocumentAnalysisClient, AnalysisFeature
 from azure.core.exceptions import HttpResponseError
 from groq import Groq
 import os
-import qrcode
-from PIL import Image, ImageDraw, ImageFont
+from journal import record_write
+from governor import get_governor, estimate_tokens, rate_limit_info, QuotaTimeout, QUOTA_EXIT_CODE, QUOTA_MAX_RETRIES
+from llm_cache import get_llm_cache
+from llm_batcher import BATCH_ENABLED, LLMBatcher, batch_messages, batch_max_tokens, COMPLETION_TOKENS_PER_ITEM
+from gazetteer import get_gazetteer, normalise_pincode
+from qr_codes import generate_qr_code, qr_link_for
 
 load_dotenv()
 
@@ -82,33 +89,75 @@ def fetch_post_offices_by_pincode(pincode):
 # Function to geocode an address using Google Geocoding API
 def geocode_address(api_key, addr, pincode):
     url = "https://maps.googleapis.com/maps/api/geocode/json"
-    address = addr + pincode
+    address = f"{addr or ''} {pincode or ''}".strip()
     params = {"address": address, "key": api_key}
-    response = requests.get(url, params=params)
+    try:
+        response = get_governor().call("google", lambda: requests.get(url, params=params, timeout=10),
+                                       key=api_key, throttled=geocode_throttled)
+    except requests.RequestException as e:
+        return geocode_fallback(pincode, f"Geocoding failed: {e}")
     if response.status_code == 200:
-        data = response.json()
-        if data.get("results"):
-            result = data["results"][0]
-            geometry = result["geometry"]
-            address_components = result["address_components"]
-
-            output = {
-                "formattedAddress": result.get("formatted_address", ""),
-                "latitude": geometry["location"]["lat"],
-                "longitude": geometry["location"]["lng"],
-                "pincode": "",
-                "city": "",
-                "state": ""
-            }
-            for component in address_components:
-                if "locality" in component.get("types", []):
-                    output["city"] = component["long_name"]
-                if "administrative_area_level_1" in component.get("types", []):
-                    output["state"] = component["long_name"]
-                if "postal_code" in component.get("types", []):
-                    output["pincode"] = component["long_name"]
+        output = parse_geocode_response(response.json())
+        if output is not None:
             return output
-    return {"error": f"Geocoding failed: {response.status_code}"}
+    return geocode_fallback(pincode, f"Geocoding failed: {response.status_code}")
+
+# Function to spot a rate-limited Geocoding response (429, or OVER_QUERY_LIMIT in a 200)
+def geocode_throttled(response):
+    if response.status_code == 200:
+        try:
+            return response.json().get("status") == "OVER_QUERY_LIMIT", None
+        except ValueError:
+            return False, None
+    return rate_limit_info(response)
+
+# Function to turn a Geocoding API response into geocoded_info, or None if nothing matched
+def parse_geocode_response(data):
+    if not data.get("results"):
+        return None
+    result = data["results"][0]
+    geometry = result["geometry"]
+    address_components = result["address_components"]
+
+    output = {
+        "formattedAddress": result.get("formatted_address", ""),
+        "latitude": geometry["location"]["lat"],
+        "longitude": geometry["location"]["lng"],
+        "pincode": "",
+        "city": "",
+        "state": ""
+    }
+    for component in address_components:
+        if "locality" in component.get("types", []):
+            output["city"] = component["long_name"]
+        if "administrative_area_level_1" in component.get("types", []):
+            output["state"] = component["long_name"]
+        if "postal_code" in component.get("types", []):
+            output["pincode"] = component["long_name"]
+    return output
+
+# Function to locate a pincode from the offline gazetteer when Google cannot
+def geocode_fallback(pincode, error):
+    gazetteer = get_gazetteer()
+    fallback = gazetteer.fallback_geocode(pincode) if gazetteer else None
+    if fallback is None:
+        return {"error": error}
+    print(f"{error}; using gazetteer centroid for pincode {fallback['pincode']}")
+    return fallback
+
+# Function to check a pincode against the gazetteer and repair single-digit OCR slips
+def validate_pincode(pincode):
+    gazetteer = get_gazetteer()
+    if gazetteer is None or pincode is None:
+        return pincode
+    corrected = gazetteer.correct_pincode(pincode)
+    if corrected is None:
+        # Kept as read; build_receiver_post flags the post for review
+        print(f"Pincode {pincode} is not a valid pincode, keeping it for review")
+        return pincode
+    if corrected != str(pincode).strip():
+        print(f"Pincode corrected: {pincode} -> {corrected}")
+    return corrected
 
 # Function to find the nearest post office to a given address
 def find_nearest_post_office(api_key, pc, address):
@@ -117,6 +166,10 @@ def find_nearest_post_office(api_key, pc, address):
         return geocoded_info
     
     lat, lon, pincode = geocoded_info["latitude"], geocoded_info["longitude"], geocoded_info["pincode"]
+    return nearest_post_office_to(lat, lon, pc)
+
+# Function to pick the post office of a pincode closest to a point
+def nearest_post_office_to(lat, lon, pc):
     post_offices = fetch_post_offices_by_pincode(pc)
 
     if not post_offices:
@@ -141,7 +194,7 @@ def create_google_maps_link(latitude, longitude):
 # Load environment variables
 load_dotenv()
 
-def process_photo(photo_path):
+def analyze_photo(photo_path):
     # Fetch Azure credentials from environment variables
     endpoint = os.getenv("AZURE_ENDPOINT")
     key = os.getenv("AZURE_KEY")
@@ -154,17 +207,103 @@ def process_photo(photo_path):
     )
 
     with open(photo_path, "rb") as f:
-        poller = document_analysis_client.begin_analyze_document(
-            "prebuilt-read", document=f, features=[AnalysisFeature.LANGUAGES]
-        )
-    
-    result = poller.result()
+        document = f.read()
 
-    address = " ".join(line.content for page in result.pages for line in page.lines)
+    # Waits for Azure quota and retries 429s (see governor.py)
+    return get_governor().call("azure", lambda: document_analysis_client.begin_analyze_document(
+        "prebuilt-read", document=document, features=[AnalysisFeature.LANGUAGES]
+    ).result(), key=key)
+
+def process_photo(photo_path):
+    result = analyze_photo(photo_path)
+
+    # Keep the OCR line breaks; the pincode guesser works line by line
+    address = "\n".join(line.content for page in result.pages for line in page.lines)
 
     return address.strip()
 
+# Batch mode: several envelopes photographed in one frame.
+# Lines are grouped into address blocks by the gaps between their bounding
+# polygons, measured in units of the page's median line height.
+BLOCK_VERTICAL_GAP = float(os.getenv("BATCH_BLOCK_VERTICAL_GAP", 1.2))
+BLOCK_HORIZONTAL_GAP = float(os.getenv("BATCH_BLOCK_HORIZONTAL_GAP", 1.5))
+BLOCK_MIN_LINES = int(os.getenv("BATCH_BLOCK_MIN_LINES", 2))
+BATCH_WORKERS = int(os.getenv("BATCH_WORKERS", 8))
+
+def _line_box(line):
+    xs = [point.x for point in line.polygon]
+    ys = [point.y for point in line.polygon]
+    return min(xs), min(ys), max(xs), max(ys)
+
+def cluster_address_blocks(result):
+    blocks = []
+    for page in result.pages:
+        lines = [line for line in page.lines if line.polygon and line.content.strip()]
+        if not lines:
+            continue
+        boxes = [_line_box(line) for line in lines]
+        heights = sorted(box[3] - box[1] for box in boxes)
+        line_height = max(heights[len(heights) // 2], 1e-6)
+
+        # Union-find over lines that sit close enough to belong to one block
+        parent = list(range(len(lines)))
+
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        for i in range(len(lines)):
+            for j in range(i + 1, len(lines)):
+                a, b = boxes[i], boxes[j]
+                dx = max(0.0, max(a[0], b[0]) - min(a[2], b[2]))
+                dy = max(0.0, max(a[1], b[1]) - min(a[3], b[3]))
+                if dy <= BLOCK_VERTICAL_GAP * line_height and dx <= BLOCK_HORIZONTAL_GAP * line_height:
+                    parent[find(i)] = find(j)
+
+        groups = {}
+        for i in range(len(lines)):
+            groups.setdefault(find(i), []).append(i)
+
+        page_blocks = []
+        for members in groups.values():
+            members.sort(key=lambda i: (boxes[i][1], boxes[i][0]))
+            text = "\n".join(lines[i].content for i in members).strip()
+            # Stamps, logos and stray labels are single lines without digits
+            if len(members) < BLOCK_MIN_LINES or not re.search(r"\d", text):
+                continue
+            top = min(boxes[i][1] for i in members)
+            left = min(boxes[i][0] for i in members)
+            page_blocks.append((top, left, text))
+
+        blocks.extend(text for _, _, text in sorted(page_blocks))
+    return blocks
+
+RECEIVER_MODEL = "llama-3.3-70b-versatile"
+RECEIVER_PROMPT = """Identify Address, Pincode, Phone Number, and Name if present.
+                    Note: Dont give any other information just provide the asked information in the specified format. 
+                    print that in this sequence: Name, PhoneNumber, Address, Pincode.
+                    i want the ouput in json format.
+                    """
+
+# Function to pull the JSON object out of an LLM reply (raises json.JSONDecodeError if malformed)
+def parse_address_json(response_content):
+    # Extracting only the JSON part using regex
+    json_match = re.search(r'\{.*\}', response_content, re.DOTALL)
+    
+    if json_match:
+        json_str = json_match.group(0)  # Get the matched JSON string
+        return json.loads(json_str)  # Parse it into a dictionary
+    print("No valid JSON found in response.")
+    return None
+
+# Function to extract receiver details, reusing the result for OCR text seen before (see llm_cache.py)
 def extract_address_details(address):
+    return get_llm_cache().cached(address, RECEIVER_MODEL, RECEIVER_PROMPT,
+                                  lambda: extract_address_details_uncached(address))
+
+def extract_address_details_uncached(address):
     try:
     # Fetch API key from .env
         apikey = os.getenv("GROQ_API_KEY")
@@ -174,48 +313,45 @@ def extract_address_details(address):
 
         client = Groq(api_key=apikey)
 
-        # Sending the request to Groq API to process the address
-        completion = client.chat.completions.create(
-            model="llama-3.3-70b-versatile",
-            messages=[
-                {
-                    "role": "system",
-                    "content": """Identify Address, Pincode, Phone Number, and Name if present.
-                    Note: Dont give any other information just provide the asked information in the specified format. 
-                    print that in this sequence: Name, PhoneNumber, Address, Pincode.
-                    i want the ouput in json format.
-                    """
-                },
-                {
-                    "role": "user",
-                    "content": address
-                }
-            ],
-            temperature=1,
-            max_tokens=1024,
-            top_p=1,
-            stream=True,
-            stop=None,
+        def complete():
+            # Sending the request to Groq API to process the address
+            completion = client.chat.completions.create(
+                model=RECEIVER_MODEL,
+                messages=[
+                    {
+                        "role": "system",
+                        "content": RECEIVER_PROMPT
+                    },
+                    {
+                        "role": "user",
+                        "content": address
+                    }
+                ],
+                temperature=1,
+                max_tokens=1024,
+                top_p=1,
+                stream=True,
+                stop=None,
+            )
+
+            response_content = ""
+            for chunk in completion:
+                if chunk.choices[0].delta.content:  # Check for valid content
+                    response_content += chunk.choices[0].delta.content
+            return response_content
+
+        response_content = get_governor().call(
+            "groq", complete, key=f"{apikey}:{RECEIVER_MODEL}",
+            cost={"requests": 1, "tokens": estimate_tokens(RECEIVER_PROMPT, address)},
         )
 
-        response_content = ""
-        for chunk in completion:
-            if chunk.choices[0].delta.content:  # Check for valid content
-                response_content += chunk.choices[0].delta.content
-
         # Debug: Print full response content before parsing
         print("Response Content:", response_content)
 
-        # Extracting only the JSON part using regex
-        json_match = re.search(r'\{.*\}', response_content, re.DOTALL)
-        
-        if json_match:
-            json_str = json_match.group(0)  # Get the matched JSON string
-            dic = json.loads(json_str)  # Parse it into a dictionary
-            return dic
-        else:
-            print("No valid JSON found in response.")
+        return parse_address_json(response_content)
     
+    except QuotaTimeout:
+        raise  # Not a failed extraction: the caller retries the envelope later
     except json.JSONDecodeError as e:
         print("Error decoding JSON(llama):", e)
     except Exception as e:
@@ -224,168 +360,318 @@ def extract_address_details(address):
     return None  # Return None in case of an error
 
 
+# Function to send several OCR texts to the LLM in one request (see llm_batcher.py)
+def send_address_batch(texts):
+    apikey = os.getenv("GROQ_API_KEY")
+    if not apikey:
+        raise ValueError("Groq API key is not set in .env")
+    client = Groq(api_key=apikey)
+    messages = batch_messages(RECEIVER_PROMPT, texts)
+
+    def complete():
+        completion = client.chat.completions.create(
+            model=RECEIVER_MODEL,
+            messages=messages,
+            temperature=1,
+            max_tokens=batch_max_tokens(len(texts)),
+            top_p=1,
+        )
+        return completion.choices[0].message.content or ""
+
+    return get_governor().call(
+        "groq", complete, key=f"{apikey}:{RECEIVER_MODEL}",
+        cost={"requests": 1, "tokens": estimate_tokens(messages[0]["content"], messages[1]["content"],
+                                                       completion=COMPLETION_TOKENS_PER_ITEM * len(texts))},
+    )
+
+address_batcher = LLMBatcher(send_address_batch, extract_address_details_uncached)
+
+# Function used by batch mode, where many blocks are extracted at once
+def extract_address_details_batched(address):
+    return get_llm_cache().cached(address, RECEIVER_MODEL, RECEIVER_PROMPT,
+                                  lambda: address_batcher.extract(address))
+
 # Function to generate unique post_id
+# post_ids are 12-digit 10 ms timestamps. Several gunicorn workers can run
+# receiver.py at the same moment, so the last issued id is kept in a shared
+# state file under a file lock and every new id is strictly greater than it.
+POST_ID_STATE = os.getenv("POST_ID_STATE", ".post_id_state")
+
 def generate_unique_post_id():
     timestamp = int(time.time() * 1000)
-    return str(timestamp)[:12]
+    candidate = int(str(timestamp)[:12])
+    with FileLock(POST_ID_STATE + ".lock"):
+        try:
+            with open(POST_ID_STATE, "r") as f:
+                last = int(f.read().strip() or 0)
+        except (FileNotFoundError, ValueError):
+            last = 0
+        candidate = max(candidate, last + 1)
+        with open(POST_ID_STATE, "w") as f:
+            f.write(str(candidate))
+    return str(candidate)
 
 # Function to upload data to Firestore
+# The write goes to the local post journal first (see journal.py), which
+# pushes the post and its index entries to Firestore in one batch.
 def upload_to_firestore(post_id, data):
     try:
-        db.collection("post_details").document(post_id).set(data)
-        print(f"Data uploaded successfully with post_id: {post_id}")
+        if record_write(db, "receiver_post", post_id, data):
+            print(f"Data uploaded successfully with post_id: {post_id}")
+        else:
+            print(f"Data journaled with post_id: {post_id}; the journal flusher will upload it to Firestore")
     except Exception as e:
         print(f"Error uploading data to Firestore: {e}")
         
 
 
-def generate_qr_code(data, pincode=None, post_office_name=None, output_path="qr_code.png"):
-    try:
-        folder_path = "QR"
-        if not os.path.exists(folder_path):
-            os.makedirs(folder_path)
-        
-        qr = qrcode.make(data)
-        qr_image = qr.convert('RGB')
-        
-        margin_top = 50
-        width, height = qr_image.size
-        new_image = Image.new('RGB', (width, height + margin_top), (255, 255, 255))
-        new_image.paste(qr_image, (0, margin_top))
-        
-        draw = ImageDraw.Draw(new_image)
-        
+# Function to turn the OCR text of one address into a stored, labelled post
+def resolve_location(api_key, receiver_address, receiver_pincode):
+    geocoded_info = geocode_address(api_key, receiver_address ,receiver_pincode)
+    if "pincode" in geocoded_info:
+        correct_receiver_pincode = geocoded_info["pincode"]
+    else :
+        correct_receiver_pincode = receiver_pincode    
+        print("Pincode:", correct_receiver_pincode)
+    if "formattedAddress" in geocoded_info:
+        updated_receiver_address = geocoded_info["formattedAddress"]
+        print("formattedAddress:", updated_receiver_address)  
+    else :
+        updated_receiver_address = receiver_address                  
+    print(correct_receiver_pincode, receiver_pincode, updated_receiver_address, receiver_address)            
+    nearest_post_office = find_nearest_post_office(api_key, correct_receiver_pincode, updated_receiver_address)
+    return geocoded_info, nearest_post_office
+
+# Speculative geocoding: the OCR text usually already holds the pincode, so the
+# nearest office lookup starts from a regex guess while the LLM runs. Only the
+# pincode and the locality words next to it are geocoded (names, phone numbers
+# and house numbers just confuse Google), and the office is kept only if the
+# LLM's pincode agrees with the guess. The stored geocode always comes from the
+# full extracted address.
+#
+# Each guess runs on a daemon thread, at most SPECULATIVE_WORKERS at a time, so
+# a discarded guess still waiting on Google never holds up the process exit.
+SPECULATIVE_GEOCODE = os.getenv("SPECULATIVE_GEOCODE", "1") == "1"
+_speculation_slots = threading.BoundedSemaphore(int(os.getenv("SPECULATIVE_WORKERS", 8)))
+
+PINCODE_PATTERN = re.compile(r"(?<!\d)([1-9]\d{2})\s?(\d{3})(?!\d)")
+PHONE_PATTERN = re.compile(r"(?:\+?91[\s-]?)?(?<!\d)[6-9]\d{4}[\s-]?\d{5}(?!\d)")
+LOCALITY_NOISE = {"pin", "pincode", "code", "mob", "mobile", "phone", "tel", "ph", "dist", "district",
+                  "post", "office", "india", "the", "and", "near", "opp", "from"}
+MAX_LOCALITY_WORDS = 4
+
+def guess_locality_and_pincode(text):
+    lines = [line for line in PHONE_PATTERN.sub(" ", text or "").splitlines() if line.strip()]
+    for number in range(len(lines) - 1, -1, -1):
+        # The pincode closes an Indian address, so prefer the last one
+        matches = PINCODE_PATTERN.findall(lines[number])
+        if matches:
+            break
+    else:
+        return None, None
+    pincode = validate_pincode("".join(matches[-1]))
+    # The town / district sits on the pincode line or the line above it
+    nearby = PINCODE_PATTERN.sub(" ", " ".join(lines[max(number - 1, 0):number + 1]))
+    words = [word for word in re.findall(r"[A-Za-z]{3,}", nearby) if word.lower() not in LOCALITY_NOISE]
+    return " ".join(words[-MAX_LOCALITY_WORDS:]) or None, pincode
+
+def _speculate(function, *args):
+    if not _speculation_slots.acquire(blocking=False):
+        return None  # Enough guesses in flight; the normal path will geocode this one
+    future = Future()
+
+    def run():
         try:
-            font = ImageFont.truetype("arial.ttf", 25)
-        except IOError:
-            font = ImageFont.load_default()
-        
-        text = f"Pincode: {pincode}\nPost Office: {post_office_name}"
-        text_bbox = draw.textbbox((0, 0), text, font=font)
-        text_width = text_bbox[2] - text_bbox[0]
-        text_x = (width - text_width) // 2  # Center text horizontally
-        text_y = 10
-        
-        draw.text((text_x, text_y), text, font=font, fill="black")
-        
-        output_path = os.path.join(folder_path, output_path)
-        new_image.save(output_path)
-        print(f"QR code generated and saved as {output_path}")
-    
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(function(*args))
+                except Exception as e:
+                    future.set_exception(e)
+        finally:
+            _speculation_slots.release()
+
+    threading.Thread(target=run, name="speculative-geocode", daemon=True).start()
+    return future
+
+def start_speculative_office(api_key, text):
+    if not SPECULATIVE_GEOCODE:
+        return None, None
+    guess_locality, guess_pincode = guess_locality_and_pincode(text)
+    if not guess_pincode:
+        return None, None
+    future = _speculate(find_nearest_post_office, api_key, guess_pincode, guess_locality)
+    return (guess_pincode, future) if future is not None else (None, None)
+
+def take_speculative_office(guess_pincode, future, receiver_pincode):
+    if future is None:
+        return None
+    if normalise_pincode(receiver_pincode) != guess_pincode:
+        future.cancel()
+        print(f"Speculative geocode discarded: guessed {guess_pincode}, LLM said {receiver_pincode}")
+        return None
+    try:
+        nearest_post_office = future.result()
     except Exception as e:
-        print(f"Error generating QR code: {e}")
+        print(f"Speculative geocode failed: {e}")
+        return None
+    if "error" in nearest_post_office:
+        return None
+    print(f"Speculative office kept for pincode {guess_pincode}")
+    return nearest_post_office
+
+def process_address(address, extract=extract_address_details):
+    api_key = os.getenv("GOOGLE_API_KEY")
+    guess_pincode, speculative = start_speculative_office(api_key, address)
+
+    # Extract structured details
+    address_details = extract(address)
+    if address_details is None:
+        if speculative is not None:
+            speculative.cancel()
+        raise ValueError("Could not extract address details")
+    receiver_name = address_details.get('Name')
+    receiver_phone_number = address_details.get('PhoneNumber')
+    receiver_address = address_details.get('Address')
+    receiver_pincode = validate_pincode(address_details.get('Pincode'))
+
+    # Geocode and find nearest post office
+    nearest_post_office = take_speculative_office(guess_pincode, speculative, receiver_pincode)
+    if nearest_post_office is None:
+        geocoded_info, nearest_post_office = resolve_location(api_key, receiver_address, receiver_pincode)
+    else:
+        geocoded_info = geocode_address(api_key, receiver_address, receiver_pincode)
+    near_po_name = nearest_post_office.get("name", "Unknown")
+    near_pincode = nearest_post_office.get("pincode", "Unknown")
+    print(nearest_post_office)
+    # Generate unique post_id
+    
+    print(near_po_name, near_pincode)
+    post_id = generate_unique_post_id()
+    print(post_id)
+    data = build_receiver_post(post_id, receiver_name, receiver_phone_number, receiver_address,
+                               receiver_pincode, geocoded_info, nearest_post_office)
+
+    # Upload to Firestore
+    upload_to_firestore(post_id, data)
+    
+    # Assuming you already have post_id, near_pincode, and near_po_name defined
+    qr_link = qr_link_for(post_id)
+    print(qr_link)
+
+    # Generate QR code with the URL
+    output_path = f"{post_id}.png"  # Save the QR code as {post_id}.png
+    generate_qr_code(qr_link, near_pincode, near_po_name, output_path)
+    
+    return receiver_data_for(address, post_id, data)
+
+
+# Function to build the post_details document for a new post
+def build_receiver_post(post_id, receiver_name, receiver_phone_number, receiver_address, receiver_pincode,
+                        geocoded_info, nearest_post_office):
+    current_time = datetime.now().strftime("%I:%M %p")  # Time in 12-hour format
+    current_date = datetime.now().strftime("%Y-%m-%d")  # Date in YYYY-MM-DD format
+    
+    initial_event = {
+    "date": current_date,
+    "time": current_time,
+    "location": "post office",
+    "status": "Post Received",
+    }
+    # Prepare data for Firestore
+    data = {
+        "isDelivered" : False,
+        "receiver_details": {
+            "post_id": post_id,
+            "name": receiver_name,
+            "phone_number": receiver_phone_number,
+            "address":receiver_address,
+            "pincode": receiver_pincode
+        },
+        "geocoded_info": geocoded_info,
+        "nearest_post_office": nearest_post_office,
+        "updated_at": datetime.now(),
+        "events": [initial_event]  # Add the initial event to the events array
         
+    }
+    # A pincode the gazetteer does not know (and could not safely correct) needs a human to check it
+    gazetteer = get_gazetteer()
+    if gazetteer is not None and not gazetteer.is_valid(receiver_pincode):
+        data["pincode_needs_review"] = True
+    return data
+
+# Function to build the JSON summary saved to receiver.json
+def receiver_data_for(address, post_id, data):
+    return {
+        "azure": address,
+        "post_id": post_id,
+        "receiver_details": dict(data["receiver_details"]),
+        "geocoded_info": data["geocoded_info"],
+        "nearest_post_office": data["nearest_post_office"],
+        "events": [dict(event) for event in data["events"]],
+        "updated_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),  # Format datetime as string
+    }
+
+
+# Function to OCR a frame once and create one post per address block in parallel
+def process_batch_photo(photo_path, max_workers=BATCH_WORKERS):
+    result = analyze_photo(photo_path)
+    blocks = cluster_address_blocks(result)
+    print(f"Found {len(blocks)} address blocks in {photo_path}")
+
+    # Blocks are extracted concurrently, so their LLM calls can share batched requests
+    extract = extract_address_details_batched if BATCH_ENABLED else extract_address_details
+    posts = []
+    # Blocks that ran out of quota go round again once the others are done, so the
+    # frame is never rerun and the posts already created are not duplicated
+    for _ in range(QUOTA_MAX_RETRIES + 1):
+        out_of_quota = []
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(blocks) or 1))) as executor:
+            futures = [executor.submit(process_address, block, extract) for block in blocks]
+            for block, future in zip(blocks, futures):
+                try:
+                    posts.append(future.result())
+                except QuotaTimeout as e:
+                    print(f"Out of quota for address block {block!r}: {e}")
+                    out_of_quota.append(block)
+                except Exception as e:
+                    print(f"Error processing address block {block!r}: {e}")
+        blocks = out_of_quota
+        if not blocks:
+            break
+    if blocks:
+        print(f"Gave up on {len(blocks)} address blocks still out of quota")
+    return posts
+
 
 # Main execution flow
 if __name__ == "__main__":
     try:
         # Fetch photo path from command-line arguments
-        if len(sys.argv) < 2:
+        batch_mode = "--batch" in sys.argv[1:]
+        args = [arg for arg in sys.argv[1:] if arg != "--batch"]
+        if len(args) < 1:
             print("Error: Please provide a photo path!")
             sys.exit(1)
 
-        photo_path = sys.argv[1]
+        photo_path = args[0]
 
         if not os.path.exists(photo_path):
             raise FileNotFoundError(f"No such file or directory: {photo_path}")
 
-        # Extract text from photo (Azure)
-        address = process_photo(photo_path)
+        if batch_mode:
+            posts = process_batch_photo(photo_path)
 
-        # Extract structured details
-        address_details = extract_address_details(address)
-        receiver_name = address_details.get('Name')
-        receiver_phone_number = address_details.get('PhoneNumber')
-        receiver_address = address_details.get('Address')
-        receiver_pincode = address_details.get('Pincode')
+            with open("receiver_batch.json", "w") as json_file:
+                json.dump(posts, json_file, indent=4)
 
-        # Geocode and find nearest post office
-        with open("credentials.json", "r") as file:
-            credentials = json.load(file)
-        
-        api_key = os.getenv("GOOGLE_API_KEY")
-        geocoded_info = geocode_address(api_key, receiver_address ,receiver_pincode)
-        if "pincode" in geocoded_info:
-            correct_receiver_pincode = geocoded_info["pincode"]
-        else :
-            correct_receiver_pincode = receiver_pincode    
-            print("Pincode:", correct_receiver_pincode)
-        if "formattedAddress" in geocoded_info:
-            updated_receiver_address = geocoded_info["formattedAddress"]
-            print("formattedAddress:", updated_receiver_address)  
-        else :
-            updated_receiver_address = receiver_address                  
-        print(correct_receiver_pincode, receiver_pincode, updated_receiver_address, receiver_address)            
-        nearest_post_office = find_nearest_post_office(api_key, correct_receiver_pincode, updated_receiver_address)
-        near_po_name = nearest_post_office.get("name", "Unknown")
-        near_pincode = nearest_post_office.get("pincode", "Unknown")
-        print(nearest_post_office)
-        # Generate unique post_id
-        
-        print(near_po_name, near_pincode)
-        post_id = generate_unique_post_id()
-        print(post_id)
-        current_time = datetime.now().strftime("%I:%M %p")  # Time in 12-hour format
-        current_date = datetime.now().strftime("%Y-%m-%d")  # Date in YYYY-MM-DD format
-        
-        initial_event = {
-        "date": current_date,
-        "time": current_time,
-        "location": "post office",
-        "status": "Post Received",
-        }
-        # Prepare data for Firestore
-        data = {
-            "isDelivered" : False,
-            "receiver_details": {
-                "post_id": post_id,
-                "name": receiver_name,
-                "phone_number": receiver_phone_number,
-                "address":receiver_address,
-                "pincode": receiver_pincode
-            },
-            "geocoded_info": geocoded_info,
-            "nearest_post_office": nearest_post_office,
-            "updated_at": datetime.now(),
-            "events": [initial_event]  # Add the initial event to the events array
-            
-        }
-
-        # Upload to Firestore
-        # upload_to_firestore(post_id, data)
-        
-        # Assuming you already have post_id, near_pincode, and near_po_name defined
-        qr_link = f"https://cd6d-49-249-229-42.ngrok-free.app/check_delivery?post_id={post_id}"
-        print(qr_link)
+            print(json.dumps({"post_ids": [post["post_id"] for post in posts]}))
+            sys.exit(0 if posts else 1)
 
-        # Generate QR code with the URL
-        output_path = f"{post_id}.png"  # Save the QR code as {post_id}.png
-        generate_qr_code(qr_link, near_pincode, near_po_name, output_path)
-        
-        
-        
-        receiver_data_json = {
-            "azure": address,
-            "post_id": post_id,
-            "receiver_details": {
-                "post_id": post_id,
-                "name": receiver_name,
-                "phone_number": receiver_phone_number,
-                "address":receiver_address,
-                "pincode": receiver_pincode
-            },
-            "geocoded_info": geocoded_info,
-            "nearest_post_office": nearest_post_office,
-            "events": [
-                {
-                    "date": initial_event["date"],
-                    "time": initial_event["time"],
-                    "location": initial_event["location"],
-                    "status": initial_event["status"],
-                }
-            ],
-            "updated_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),  # Format datetime as string
-        }
+        # Extract text from photo (Azure)
+        address = process_photo(photo_path)
+
+        receiver_data_json = process_address(address)
+        post_id = receiver_data_json["post_id"]
 
         # Save the receiver_data to receiver.json
         with open("receiver.json", "w") as json_file:
@@ -396,6 +682,10 @@ if __name__ == "__main__":
         
         
         
+    except QuotaTimeout as e:
+        # Nothing was stored; server.py runs this photo again later
+        print("Out of quota:", str(e))
+        sys.exit(QUOTA_EXIT_CODE)
     except Exception as e:
         print("Error:", str(e))
         sys.exit(1)  # Error exit
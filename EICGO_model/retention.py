@@ -0,0 +1,358 @@
+import os
+import io
+import sys
+import json
+import glob
+import time
+import tarfile
+import argparse
+import threading
+from datetime import datetime
+
+from filelock import FileLock, Timeout
+from PIL import Image, ImageOps
+
+# Retention and compaction of scanned_posts/ and QR/.
+# Each run, oldest step last:
+#   1. scans older than RETENTION_REENCODE_DAYS are re-encoded to WebP
+#      (downscaled to RETENTION_MAX_SIDE) when that makes them smaller;
+#   2. scans older than RETENTION_ARCHIVE_DAYS are moved into uncompressed tar
+#      bundles, one per date partition of the file's mtime, e.g.
+#      scans-2025-04-11.tar, with a scans-2025-04-11.index.json giving each
+#      member's byte offset and size so one scan can be read without unpacking;
+#   3. bundles no longer appended to for RETENTION_OFFLOAD_DAYS are uploaded to
+#      an S3-compatible store if RETENTION_S3_BUCKET is set (and then removed
+#      locally if RETENTION_DELETE_AFTER_OFFLOAD=1; the index stays);
+#   4. QR PNGs older than RETENTION_QR_DAYS are deleted; server.py serves
+#      /qr/<post_id> from Firestore data instead.
+# `python retention.py report` shows what a run would do without changing anything.
+
+BUNDLE_PREFIX = "scans-"
+MODULE_DIR = os.path.dirname(os.path.abspath(__file__))
+SCAN_SUFFIXES = {".jpg", ".jpeg", ".png", ".webp"}
+REENCODE_SUFFIXES = {".jpg", ".jpeg", ".png"}
+
+
+def _env_list(name, default):
+    return [part.strip() for part in os.getenv(name, default).split(",") if part.strip()]
+
+
+def _default_dirs(name):
+    # Next to this file and in the repo root, wherever the server was started from
+    return ",".join(os.path.normpath(os.path.join(MODULE_DIR, parent, name)) for parent in (".", ".."))
+
+
+# Function to read the retention policy from the environment
+def load_policy():
+    return {
+        "scan_dirs": _env_list("RETENTION_SCAN_DIRS", _default_dirs("scanned_posts")),
+        "qr_dirs": _env_list("RETENTION_QR_DIRS", _default_dirs("QR")),
+        "archive_dir": os.getenv("RETENTION_ARCHIVE_DIR", os.path.join(MODULE_DIR, "scanned_archive")),
+        "reencode_days": float(os.getenv("RETENTION_REENCODE_DAYS", 7)),
+        "archive_days": float(os.getenv("RETENTION_ARCHIVE_DAYS", 30)),
+        "offload_days": float(os.getenv("RETENTION_OFFLOAD_DAYS", 2)),
+        "qr_days": float(os.getenv("RETENTION_QR_DAYS", 7)),
+        "webp_quality": int(os.getenv("RETENTION_WEBP_QUALITY", 60)),
+        "max_side": int(os.getenv("RETENTION_MAX_SIDE", 1600)),
+        "partition_format": os.getenv("RETENTION_PARTITION_FORMAT", "%Y-%m-%d"),
+        "s3_bucket": os.getenv("RETENTION_S3_BUCKET") or None,
+        "s3_endpoint": os.getenv("RETENTION_S3_ENDPOINT") or None,
+        "s3_prefix": os.getenv("RETENTION_S3_PREFIX", "scanned_archive/"),
+        "delete_after_offload": os.getenv("RETENTION_DELETE_AFTER_OFFLOAD", "0") == "1",
+    }
+
+
+def _age_days(path, now):
+    return (now - os.path.getmtime(path)) / 86400
+
+
+def _files(directory, suffixes):
+    # Dotfiles (the dedup index, partial uploads) are never touched
+    if not os.path.isdir(directory):
+        return []
+    return sorted(entry.path for entry in os.scandir(directory)
+                  if entry.is_file() and not entry.name.startswith(".")
+                  and os.path.splitext(entry.name)[1].lower() in suffixes)
+
+
+def _dir_label(directory):
+    # scanned_posts and ../scanned_posts hold files with the same names
+    relative = os.path.relpath(directory, MODULE_DIR)
+    return os.path.normpath(relative).replace("..", "parent").replace(os.sep, "_").strip("_.") or "root"
+
+
+# Function to re-encode one scan to WebP; returns the new path, or None if it was kept as is
+def reencode_scan(path, quality, max_side):
+    target = os.path.splitext(path)[0] + ".webp"
+    stat = os.stat(path)
+    with Image.open(path) as image:
+        image = ImageOps.exif_transpose(image).convert("RGB")
+        image.thumbnail((max_side, max_side))
+        buffer = io.BytesIO()
+        image.save(buffer, "WEBP", quality=quality, method=6)
+    if buffer.tell() >= stat.st_size or os.path.exists(target):
+        return None
+    with open(target + ".tmp", "wb") as f:
+        f.write(buffer.getvalue())
+    os.replace(target + ".tmp", target)
+    os.utime(target, (stat.st_atime, stat.st_mtime))  # Keep the scan's age for the archive step
+    os.remove(path)
+    return target
+
+
+def reencode_scans(policy, now, dry_run=False, report=None):
+    section = {"files": 0, "bytes_before": 0, "bytes_after": 0}
+    for directory in policy["scan_dirs"]:
+        for path in _files(directory, REENCODE_SUFFIXES):
+            age = _age_days(path, now)
+            if age < policy["reencode_days"] or age >= policy["archive_days"]:
+                continue
+            size = os.path.getsize(path)
+            if dry_run:
+                section["files"] += 1
+                section["bytes_before"] += size
+                continue
+            try:
+                target = reencode_scan(path, policy["webp_quality"], policy["max_side"])
+            except Exception as e:
+                report["errors"].append(f"reencode {path}: {e}")
+                continue
+            if target is not None:
+                section["files"] += 1
+                section["bytes_before"] += size
+                section["bytes_after"] += os.path.getsize(target)
+    return section
+
+
+def _load_index(index_path):
+    try:
+        with open(index_path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"members": {}, "offloaded": None}
+
+
+def _save_index(index_path, index):
+    with open(index_path + ".tmp", "w") as f:
+        json.dump(index, f, indent=1)
+    os.replace(index_path + ".tmp", index_path)
+
+
+def _bundle_for(archive_dir, partition):
+    # A bundle that has been offloaded is closed; late files start the next one
+    n = 0
+    while True:
+        name = f"{BUNDLE_PREFIX}{partition}" + (f"-{n}" if n else "")
+        index = _load_index(os.path.join(archive_dir, name + ".index.json"))
+        if not index.get("offloaded"):
+            return name, index
+        n += 1
+
+
+def archive_scans(policy, now, dry_run=False, report=None):
+    section = {"files": 0, "bytes": 0, "bundles": []}
+    by_partition = {}
+    for directory in policy["scan_dirs"]:
+        for path in _files(directory, SCAN_SUFFIXES):
+            if _age_days(path, now) >= policy["archive_days"]:
+                partition = datetime.fromtimestamp(os.path.getmtime(path)).strftime(policy["partition_format"])
+                by_partition.setdefault(partition, []).append((directory, path))
+
+    if not dry_run and by_partition:
+        os.makedirs(policy["archive_dir"], exist_ok=True)
+    for partition, files in sorted(by_partition.items()):
+        name, index = _bundle_for(policy["archive_dir"], partition)
+        section["bundles"].append(name)
+        if dry_run:
+            section["files"] += len(files)
+            section["bytes"] += sum(os.path.getsize(path) for _, path in files)
+            continue
+
+        tar_path = os.path.join(policy["archive_dir"], name + ".tar")
+        index_path = os.path.join(policy["archive_dir"], name + ".index.json")
+        archived = []
+        with tarfile.open(tar_path, "a") as tar:
+            for directory, path in files:
+                member = f"{_dir_label(directory)}/{os.path.basename(path)}"
+                try:
+                    stat = os.stat(path)
+                    if index["members"].get(member, {}).get("size") != stat.st_size:
+                        info = tar.gettarinfo(path, arcname=member)
+                        with open(path, "rb") as f:
+                            tar.addfile(info, f)
+                        # Data ends padded to a whole block right where the tar now ends
+                        offset = tar.offset - -(-info.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+                        index["members"][member] = {"offset": offset, "size": info.size,
+                                                    "mtime": stat.st_mtime, "source": path}
+                    archived.append(path)
+                    section["files"] += 1
+                    section["bytes"] += stat.st_size
+                except OSError as e:
+                    report["errors"].append(f"archive {path}: {e}")
+            tar.fileobj.flush()
+            os.fsync(tar.fileobj.fileno())
+        # Originals go only once the bundle and its index are on disk
+        _save_index(index_path, index)
+        for path in archived:
+            os.remove(path)
+    return section
+
+
+def _s3_client(policy):
+    import boto3
+    return boto3.client("s3", endpoint_url=policy["s3_endpoint"],
+                        aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
+                        aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"))
+
+
+def offload_bundles(policy, now, dry_run=False, report=None, s3=None):
+    section = {"bundles": [], "bytes": 0}
+    if not policy["s3_bucket"]:
+        return section
+    for tar_path in sorted(glob.glob(os.path.join(policy["archive_dir"], BUNDLE_PREFIX + "*.tar"))):
+        name = os.path.basename(tar_path)[:-len(".tar")]
+        index_path = os.path.join(policy["archive_dir"], name + ".index.json")
+        index = _load_index(index_path)
+        if index.get("offloaded") or _age_days(tar_path, now) < policy["offload_days"]:
+            continue
+        section["bundles"].append(name)
+        section["bytes"] += os.path.getsize(tar_path)
+        if dry_run:
+            continue
+        try:
+            s3 = s3 or _s3_client(policy)
+            key = policy["s3_prefix"] + name + ".tar"
+            s3.upload_file(tar_path, policy["s3_bucket"], key)
+            s3.upload_file(index_path, policy["s3_bucket"], policy["s3_prefix"] + name + ".index.json")
+            index["offloaded"] = {"bucket": policy["s3_bucket"], "key": key, "endpoint": policy["s3_endpoint"],
+                                  "at": datetime.fromtimestamp(now).isoformat(timespec="seconds")}
+            _save_index(index_path, index)
+            if policy["delete_after_offload"]:
+                os.remove(tar_path)
+        except Exception as e:
+            report["errors"].append(f"offload {name}: {e}")
+    return section
+
+
+def prune_qr_codes(policy, now, dry_run=False, report=None):
+    section = {"files": 0, "bytes": 0}
+    for directory in policy["qr_dirs"]:
+        for path in _files(directory, {".png"}):
+            # Only labels named <post_id>.png can be regenerated
+            if not os.path.splitext(os.path.basename(path))[0].isdigit() or _age_days(path, now) < policy["qr_days"]:
+                continue
+            section["files"] += 1
+            section["bytes"] += os.path.getsize(path)
+            if not dry_run:
+                try:
+                    os.remove(path)
+                except OSError as e:
+                    report["errors"].append(f"qr {path}: {e}")
+    return section
+
+
+def run_retention(policy=None, dry_run=False, now=None, s3=None):
+    """Apply the policy once; with dry_run=True only report what would be done."""
+    policy = policy or load_policy()
+    now = now or time.time()
+    report = {"dry_run": dry_run, "started_at": datetime.fromtimestamp(now).isoformat(timespec="seconds"),
+              "errors": []}
+    report["reencode"] = reencode_scans(policy, now, dry_run, report)
+    report["archive"] = archive_scans(policy, now, dry_run, report)
+    report["offload"] = offload_bundles(policy, now, dry_run, report, s3)
+    report["qr"] = prune_qr_codes(policy, now, dry_run, report)
+    report["seconds"] = round(time.time() - now, 3)
+    return report
+
+
+# Function to read one archived scan back, from the local bundle or the S3 copy
+def read_archived(member, archive_dir=None, s3=None):
+    policy = load_policy()
+    archive_dir = archive_dir or policy["archive_dir"]
+    for index_path in sorted(glob.glob(os.path.join(archive_dir, BUNDLE_PREFIX + "*.index.json"))):
+        index = _load_index(index_path)
+        entry = index["members"].get(member)
+        if entry is None:
+            continue
+        tar_path = index_path[:-len(".index.json")] + ".tar"
+        if os.path.exists(tar_path):
+            with open(tar_path, "rb") as f:
+                f.seek(entry["offset"])
+                return f.read(entry["size"])
+        offloaded = index.get("offloaded")
+        if offloaded:
+            s3 = s3 or _s3_client(dict(policy, s3_endpoint=offloaded.get("endpoint")))
+            response = s3.get_object(Bucket=offloaded["bucket"], Key=offloaded["key"],
+                                     Range=f"bytes={entry['offset']}-{entry['offset'] + entry['size'] - 1}")
+            return response["Body"].read()
+    raise KeyError(f"{member} is not in any archive bundle")
+
+
+class RetentionWorker:
+    """Runs the policy every RETENTION_INTERVAL_HOURS in a background thread.
+
+    Every gunicorn worker starts one; a file lock lets only one of them run at a time.
+    """
+
+    def __init__(self, policy=None, interval_hours=None):
+        self.policy = policy or load_policy()
+        self._interval = 3600 * float(interval_hours or os.getenv("RETENTION_INTERVAL_HOURS", 6))
+        self._stop = threading.Event()
+        self._thread = None
+        self.last_report = None
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="retention", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def run_once(self):
+        os.makedirs(self.policy["archive_dir"], exist_ok=True)
+        try:
+            with FileLock(os.path.join(self.policy["archive_dir"], ".retention.lock"), timeout=0):
+                self.last_report = run_retention(self.policy)
+        except Timeout:
+            return None
+        print(f"Retention run: {json.dumps(self.last_report)}")
+        return self.last_report
+
+    def _run(self):
+        # Let the server settle before the first pass
+        while not self._stop.wait(min(self._interval, 300) if self.last_report is None else self._interval):
+            try:
+                self.run_once()
+            except Exception as e:
+                print(f"Error in retention run: {e}")
+                self.last_report = {"errors": [str(e)]}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compact and archive old scans and QR codes.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("report", help="Show what a run would do (dry run)")
+    sub.add_parser("run", help="Apply the retention policy once")
+    sub.add_parser("policy", help="Print the policy read from the environment")
+    get = sub.add_parser("get", help="Extract one archived scan, e.g. scanned_posts/1733292766650_front.webp")
+    get.add_argument("member")
+    get.add_argument("--out")
+    args = parser.parse_args()
+
+    if args.command == "policy":
+        print(json.dumps(load_policy(), indent=4))
+    elif args.command == "get":
+        data = read_archived(args.member)
+        with open(args.out or os.path.basename(args.member), "wb") as f:
+            f.write(data)
+        print(f"Wrote {len(data)} bytes to {args.out or os.path.basename(args.member)}")
+    elif args.command == "report":
+        print(json.dumps(run_retention(dry_run=True), indent=4))
+    else:
+        report = RetentionWorker().run_once()
+        if report is None:
+            print("Another retention run is in progress")
+            sys.exit(1)
+        sys.exit(1 if report["errors"] else 0)
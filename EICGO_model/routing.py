@@ -0,0 +1,127 @@
+import time
+
+import numpy as np
+
+# Delivery route optimisation for a post office's undelivered posts.
+# Distances are great-circle km from a vectorised haversine matrix; the route
+# is built with nearest-neighbour and improved with 2-opt under a time budget.
+
+EARTH_RADIUS_KM = 6371.0
+
+
+# Function to compute the haversine distance matrix (km) between all points
+def haversine_matrix(latitudes, longitudes):
+    lat = np.radians(np.asarray(latitudes, dtype=np.float64))
+    lon = np.radians(np.asarray(longitudes, dtype=np.float64))
+    dlat = lat[:, None] - lat[None, :]
+    dlon = lon[:, None] - lon[None, :]
+    a = np.sin(dlat / 2) ** 2 + np.cos(lat)[:, None] * np.cos(lat)[None, :] * np.sin(dlon / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+# Function to build a tour from node 0 by always visiting the closest unvisited node
+def nearest_neighbour_tour(dist):
+    n = len(dist)
+    visited = np.zeros(n, dtype=bool)
+    tour = [0]
+    visited[0] = True
+    for _ in range(n - 1):
+        row = np.where(visited, np.inf, dist[tour[-1]])
+        nxt = int(np.argmin(row))
+        tour.append(nxt)
+        visited[nxt] = True
+    return tour
+
+
+# Function to improve a closed tour [0, ..., 0] with 2-opt segment reversals
+def two_opt(tour, dist, max_seconds=0.8):
+    tour = np.asarray(tour, dtype=np.int64)
+    deadline = time.perf_counter() + max_seconds
+    improved = True
+    while improved and time.perf_counter() < deadline:
+        improved = False
+        for i in range(1, len(tour) - 2):
+            # Reverse tour[i:j+1]: replace edges (a,b),(c,d) by (a,c),(b,d), for all j at once
+            a, b = tour[i - 1], tour[i]
+            c, d = tour[i + 1:-1], tour[i + 2:]
+            delta = dist[a, c] + dist[b, d] - dist[a, b] - dist[c, d]
+            j = int(np.argmin(delta))
+            if delta[j] < -1e-9:
+                j += i + 1
+                tour[i:j + 1] = tour[i:j + 1][::-1].copy()
+                improved = True
+            if time.perf_counter() >= deadline:
+                break
+    return tour.tolist()
+
+
+def tour_length(tour, dist):
+    return float(sum(dist[tour[k], tour[k + 1]] for k in range(len(tour) - 1)))
+
+
+# Function to order stops starting (and optionally ending) at the depot
+def optimise_order(depot, stops, return_to_start=True, max_seconds=0.8):
+    """depot and stops are (latitude, longitude) pairs; returns (order, km).
+
+    order lists indexes into stops in visiting order.
+    """
+    if not stops:
+        return [], 0.0
+    points = np.array([depot] + list(stops), dtype=np.float64)
+    dist = haversine_matrix(points[:, 0], points[:, 1])
+    if not return_to_start:
+        # Coming back to the depot is free, which turns the closed tour into an open path
+        dist[:, 0] = 0.0
+    tour = nearest_neighbour_tour(dist) + [0]
+    tour = two_opt(tour, dist, max_seconds=max_seconds)
+    return [node - 1 for node in tour[1:-1]], tour_length(tour, dist)
+
+
+# Function to split stops into K beats by sweeping around the depot
+def split_into_beats(depot, stops, beats):
+    if beats <= 1 or len(stops) <= 1:
+        return [list(range(len(stops)))]
+    points = np.asarray(stops, dtype=np.float64)
+    bearings = np.arctan2(points[:, 0] - depot[0], (points[:, 1] - depot[1]) * np.cos(np.radians(depot[0])))
+    order = np.argsort(bearings)
+    # Start the sweep after the widest angular gap so no beat straddles two directions
+    sorted_bearings = bearings[order]
+    gaps = np.diff(np.concatenate([sorted_bearings, sorted_bearings[:1] + 2 * np.pi]))
+    order = np.roll(order, -(int(np.argmax(gaps)) + 1))
+    return [chunk.tolist() for chunk in np.array_split(order, min(beats, len(stops)))]
+
+
+# Function to plan the delivery route(s) for an office's pending posts
+def plan_delivery_route(office, posts, beats=1, return_to_start=True, max_seconds=0.8):
+    depot = (float(office["latitude"]), float(office["longitude"]))
+    posts = [p for p in posts if p.get("latitude") is not None and p.get("longitude") is not None]
+    stops = [(float(p["latitude"]), float(p["longitude"])) for p in posts]
+
+    groups = split_into_beats(depot, stops, beats)
+    per_beat_seconds = max_seconds / max(len(groups), 1)
+    planned = []
+    for number, group in enumerate(groups, start=1):
+        order, distance_km = optimise_order(depot, [stops[k] for k in group], return_to_start, per_beat_seconds)
+        planned.append({
+            "beat": number,
+            "distance_km": round(distance_km, 3),
+            "stops": [
+                {
+                    "sequence": sequence,
+                    "post_id": posts[group[k]]["post_id"],
+                    "name": posts[group[k]].get("name"),
+                    "address": posts[group[k]].get("address"),
+                    "latitude": stops[group[k]][0],
+                    "longitude": stops[group[k]][1],
+                }
+                for sequence, k in enumerate(order, start=1)
+            ],
+        })
+
+    return {
+        "office": office,
+        "total_stops": len(stops),
+        "total_distance_km": round(sum(b["distance_km"] for b in planned), 3),
+        "return_to_start": return_to_start,
+        "beats": planned,
+    }
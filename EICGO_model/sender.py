@@ -14,6 +14,10 @@ from azure.core.exceptions import HttpResponseError
 from groq import Groq
 from dotenv import load_dotenv
 
+from journal import record_write
+from governor import get_governor, estimate_tokens, QuotaTimeout, QUOTA_EXIT_CODE
+from llm_cache import get_llm_cache
+
 # Load environment variables
 load_dotenv()
 
@@ -44,9 +48,11 @@ else:
 
 def upload_to_firestore(post_id, data):
     try:
-        doc_ref = db.collection("post_details").document(post_id)
-        doc_ref.set({"sender_details": data}, merge=True)
-        print(f"Data uploaded successfully for post_id: {post_id}")
+        # Journaled first; sender details and the sender's phone index entry are written together
+        if record_write(db, "sender_details", post_id, data):
+            print(f"Data uploaded successfully for post_id: {post_id}")
+        else:
+            print(f"Data journaled for post_id: {post_id}; the journal flusher will upload it to Firestore")
     except Exception as e:
         print(f"Error uploading data to Firestore: {e}")
 
@@ -65,10 +71,12 @@ def extract_text_from_image(photo_path):
     )
 
     with open(photo_path, "rb") as f:
-        poller = document_analysis_client.begin_analyze_document(
-            "prebuilt-read", document=f
-        )
-    result = poller.result()
+        document = f.read()
+
+    # Waits for Azure quota and retries 429s (see governor.py)
+    result = get_governor().call("azure", lambda: document_analysis_client.begin_analyze_document(
+        "prebuilt-read", document=document
+    ).result(), key=AZURE_KEY)
 
     # Combine text from all lines across all pages
     extracted_text = " ".join(
@@ -77,37 +85,52 @@ def extract_text_from_image(photo_path):
     
     return extracted_text.strip()
 
+SENDER_MODEL = "llama-3.1-70b-versatile"
+SENDER_PROMPT = """Identify Address, Pincode, Phone Number, and Name if present.
+                    Note: Don't give any other information, just provide the requested information in JSON format.
+                    Format: { "Name": "value", "PhoneNumber": "value", "Address": "value", "Pincode": "value" }
+                    """
+
 def analyze_address_with_groq(address_text):
+    # Repeat senders are answered from the cache without an LLM call (see llm_cache.py)
+    return get_llm_cache().cached(address_text, SENDER_MODEL, SENDER_PROMPT,
+                                  lambda: analyze_address_with_groq_uncached(address_text))
+
+def analyze_address_with_groq_uncached(address_text):
     try:
         client = Groq(api_key=GROQ_API_KEY)
 
-        # Sending the request to Groq API to process the address
-        completion = client.chat.completions.create(
-            model="llama-3.1-70b-versatile",
-            messages=[
-                {
-                    "role": "system",
-                    "content": """Identify Address, Pincode, Phone Number, and Name if present.
-                    Note: Don't give any other information, just provide the requested information in JSON format.
-                    Format: { "Name": "value", "PhoneNumber": "value", "Address": "value", "Pincode": "value" }
-                    """
-                },
-                {
-                    "role": "user",
-                    "content": address_text
-                }
-            ],
-            temperature=1,
-            max_tokens=1024,
-            top_p=1,
-            stream=True,
+        def complete():
+            # Sending the request to Groq API to process the address
+            completion = client.chat.completions.create(
+                model=SENDER_MODEL,
+                messages=[
+                    {
+                        "role": "system",
+                        "content": SENDER_PROMPT
+                    },
+                    {
+                        "role": "user",
+                        "content": address_text
+                    }
+                ],
+                temperature=1,
+                max_tokens=1024,
+                top_p=1,
+                stream=True,
+            )
+
+            response_content = ""
+            for chunk in completion:
+                if chunk.choices[0].delta.content:
+                    response_content += chunk.choices[0].delta.content
+            return response_content
+
+        response_content = get_governor().call(
+            "groq", complete, key=f"{GROQ_API_KEY}:{SENDER_MODEL}",
+            cost={"requests": 1, "tokens": estimate_tokens(SENDER_PROMPT, address_text)},
         )
 
-        response_content = ""
-        for chunk in completion:
-            if chunk.choices[0].delta.content:
-                response_content += chunk.choices[0].delta.content
-
         # Extracting only the JSON part using regex
         json_match = re.search(r'\{.*\}', response_content, re.DOTALL)
         
@@ -118,6 +141,8 @@ def analyze_address_with_groq(address_text):
         else:
             print("No valid JSON found in response.")
     
+    except QuotaTimeout:
+        raise  # Not a failed extraction: main() asks server.py to run this again later
     except json.JSONDecodeError as e:
         print("Error decoding JSON (Groq):", e)
     except Exception as e:
@@ -170,6 +195,9 @@ def main():
             upload_to_firestore(post_id, groq_result)
         else:
             print("No post_id provided. Data not uploaded to Firestore.")
+    except QuotaTimeout as e:
+        print("Out of quota:", e)
+        sys.exit(QUOTA_EXIT_CODE)
     except HttpResponseError as error:
         print("Azure OCR Error:", error)
     except Exception as e:
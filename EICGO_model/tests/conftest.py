@@ -0,0 +1,8 @@
+import os
+import sys
+
+# The modules live flat in EICGO_model/ and are run as scripts, not installed
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# In-memory Firestore (fakes.py) without simulated network time
+os.environ.setdefault("FAKE_FIRESTORE_LATENCY_MS", "0")
@@ -0,0 +1,86 @@
+import numpy as np
+import pytest
+from PIL import Image, ImageEnhance
+
+from dedup import PENDING, PerceptualIndex, dhash
+
+WINDOW = 3600
+
+
+def envelope(path, seed, brightness=1.0, size=(640, 480)):
+    rng = np.random.default_rng(seed)
+    pixels = rng.integers(0, 256, size=(12, 16), dtype=np.uint8)
+    img = Image.fromarray(pixels, "L").resize(size, Image.BILINEAR).convert("RGB")
+    ImageEnhance.Brightness(img).enhance(brightness).save(path)
+    return str(path)
+
+
+def distance(a, b):
+    return bin(a ^ b).count("1")
+
+
+@pytest.fixture
+def index(tmp_path):
+    return PerceptualIndex(path=str(tmp_path / "index.db"), window_seconds=WINDOW, max_distance=6)
+
+
+def test_dhash_matches_rescan_and_separates_envelopes(tmp_path):
+    first = dhash(envelope(tmp_path / "a.jpg", seed=1))
+    rescan = dhash(envelope(tmp_path / "b.jpg", seed=1, brightness=1.2, size=(800, 600)))
+    other = dhash(envelope(tmp_path / "c.jpg", seed=2))
+
+    assert 0 <= first < 1 << 64
+    assert distance(first, rescan) <= 6
+    assert distance(first, other) > 6
+
+
+def test_duplicate_within_window_returns_post_id(tmp_path, index):
+    photo = envelope(tmp_path / "a.jpg", seed=1)
+    assert index.check_and_add(photo, key="a", now=1000.0) is None
+    assert index.check_and_add(photo, key="b", now=1001.0) == (PENDING, 0)
+
+    index.assign("a", "1700000001")
+    assert index.check_and_add(photo, key="c", now=1002.0) == ("1700000001", 0)
+    assert len(index) == 1
+
+
+def test_lookup_window(tmp_path, index):
+    photo_hash = dhash(envelope(tmp_path / "a.jpg", seed=1))
+    index.add(photo_hash, "a", now=1000.0)
+    index.assign("a", "1700000001")
+
+    assert index.lookup(photo_hash, now=1000.0 + WINDOW - 1) == ("1700000001", 0)
+    assert index.lookup(photo_hash, now=1000.0 + WINDOW + 1) is None
+
+
+def test_stale_pending_entry_is_ignored(tmp_path, index):
+    photo_hash = dhash(envelope(tmp_path / "a.jpg", seed=1))
+    index.add(photo_hash, "a", now=1000.0)
+
+    assert index.lookup(photo_hash, now=1001.0) == (PENDING, 0)
+    assert index.lookup(photo_hash, now=1000.0 + 16 * 60) is None
+
+
+def test_discard_allows_rescan(tmp_path, index):
+    photo = envelope(tmp_path / "a.jpg", seed=1)
+    assert index.check_and_add(photo, key="a", now=1000.0) is None
+
+    index.discard("a")
+    assert len(index) == 0
+    assert index.check_and_add(photo, key="b", now=1001.0) is None
+
+
+def test_workers_share_the_log(tmp_path):
+    path = str(tmp_path / "index.db")
+    first = PerceptualIndex(path=path, window_seconds=WINDOW)
+    second = PerceptualIndex(path=path, window_seconds=WINDOW)
+    photo = envelope(tmp_path / "a.jpg", seed=1)
+    other = envelope(tmp_path / "b.jpg", seed=2)
+
+    assert first.check_and_add(photo, key="a", now=1000.0) is None
+    assert second.check_and_add(other, key="b", now=1000.5) is None
+    first.assign("a", "1700000001")
+    second.discard("b")
+
+    assert second.check_and_add(photo, key="c", now=1001.0) == ("1700000001", 0)
+    assert first.check_and_add(other, key="d", now=1001.0) is None
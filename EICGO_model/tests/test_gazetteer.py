@@ -0,0 +1,82 @@
+import sqlite3
+import threading
+import time
+
+import pytest
+
+import gazetteer
+from gazetteer import Gazetteer, build_gazetteer, normalise_pincode
+
+OFFICES = [
+    ("452009", "Sudama Nagar S.O", "MADHYA PRADESH", "INDORE", "22.6953", "75.8360"),
+    ("452018", "Rau S.O", "RAJASTHAN", "KOTA", "25.1800", "75.8300"),
+    ("110001", "Connaught Place S.O", "DELHI", "NEW DELHI", "28.6315", "77.2167"),
+]
+
+
+@pytest.fixture
+def base(tmp_path):
+    db_path = tmp_path / "post_office.db"
+    conn = sqlite3.connect(db_path)
+    conn.execute("CREATE TABLE PostOfficeDetails (Pincode, OfficeName, StateName, District, Latitude, Longitude)")
+    conn.executemany("INSERT INTO PostOfficeDetails VALUES (?, ?, ?, ?, ?, ?)", OFFICES)
+    conn.commit()
+    conn.close()
+    base = str(tmp_path / "gazetteer")
+    build_gazetteer(str(db_path), base)
+    return base
+
+
+def test_lookup_and_normalise(base):
+    gaz = Gazetteer(base)
+    assert len(gaz) == 3
+    assert gaz.lookup("452 009")["offices"] == ["Sudama Nagar S.O"]
+    assert normalise_pincode("45200g") == "452009"
+    assert normalise_pincode("052009") is None
+
+
+def test_sole_candidate_is_corrected(base):
+    gaz = Gazetteer(base)
+    assert gaz.correct_pincode("452009") == "452009"
+    assert gaz.correct_pincode("452007") == "452009"
+    assert gaz.correct_pincode("110010") == "110001"  # Adjacent swap
+
+
+def test_ambiguous_correction_needs_a_hint(base):
+    gaz = Gazetteer(base)
+    # 452009 (1 read for 0) and 452018 (9 read for 8) are both one slip away
+    assert gaz.correct_pincode("452019") is None
+    assert gaz.correct_pincode("452019", state="Madhya Pradesh") == "452009"
+    assert gaz.correct_pincode("452019", near=(25.18, 75.83)) == "452018"
+
+
+def test_get_gazetteer_loads_once_across_threads(base, monkeypatch):
+    loads = []
+
+    class SlowGazetteer(Gazetteer):
+        def __init__(self, path):
+            loads.append(path)
+            time.sleep(0.05)
+            super().__init__(path)
+
+    monkeypatch.setattr(gazetteer, "_gazetteer", None)
+    monkeypatch.setattr(gazetteer, "Gazetteer", SlowGazetteer)
+    monkeypatch.setattr(gazetteer, "GAZETTEER_PATH", base)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(gazetteer.get_gazetteer())) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert loads == [base]
+    assert len(results) == 8 and all(result is results[0] is not None for result in results)
+
+
+def test_get_gazetteer_retries_after_missing_files(base, monkeypatch):
+    monkeypatch.setattr(gazetteer, "_gazetteer", None)
+    monkeypatch.setattr(gazetteer, "GAZETTEER_PATH", base + "_missing")
+    assert gazetteer.get_gazetteer() is None
+
+    monkeypatch.setattr(gazetteer, "GAZETTEER_PATH", base)
+    assert gazetteer.get_gazetteer() is not None
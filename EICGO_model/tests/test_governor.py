@@ -0,0 +1,116 @@
+import pytest
+
+import governor
+from governor import Governor, LocalBackend, QuotaTimeout, SQLiteBackend, load_limits
+from llm_batcher import LLMBatcher
+
+
+class RateLimited(Exception):
+    status_code = 429
+    headers = {"retry-after": "0.01"}
+
+
+def test_no_limits_by_default():
+    assert load_limits(preset="", overrides="") == {}
+
+    backend = LocalBackend()
+    gov = Governor(backend, limits={})
+    assert gov.acquire("groq", key="k", cost={"requests": 1, "tokens": 10**6}) == 0.0
+    assert gov.call("twilio", lambda: "sent") == "sent"
+    assert backend.states() == {}
+
+
+def test_free_preset_is_opt_in_and_overridable():
+    limits = load_limits(preset="free", overrides='{"groq": {"requests": 1000}}')
+    assert limits["groq"]["requests"] == {"per_minute": 1000.0, "burst": 1000.0}
+    assert limits["groq"]["tokens"]["per_minute"] == 6000.0
+    assert limits["twilio"]["requests"]["burst"] == 1.0
+
+    with pytest.raises(ValueError):
+        load_limits(preset="unknown", overrides="")
+    with pytest.raises(ValueError):
+        load_limits(preset="", overrides='{"groq": {"requests": 0}}')
+    with pytest.raises(ValueError):
+        load_limits(preset="", overrides='{"groq": {"tokens": {"per_minute": 6000, "burst": -1}}}')
+
+
+def test_unlimited_provider_still_retries_429():
+    calls = []
+
+    def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise RateLimited()
+        return "ok"
+
+    backend = LocalBackend()
+    assert Governor(backend, limits={}).call("groq", flaky) == "ok"
+    assert len(calls) == 3
+    # The 429s created a learned bucket: two cuts below the ceiling, then one success
+    ceiling = governor.LEARNED_PER_MINUTE
+    state = backend.states()[governor._bucket_name("groq", None, "requests")]
+    assert state["throttled"] == 2
+    assert state["rate"] == pytest.approx(ceiling * governor.ADAPTIVE_DECREASE ** 2 + ceiling * governor.ADAPTIVE_INCREASE)
+
+
+def test_learned_bucket_is_shared_through_sqlite(tmp_path):
+    path = str(tmp_path / "governor.db")
+    first = Governor(SQLiteBackend(path), limits={})
+    second = Governor(SQLiteBackend(path), limits={})
+    assert second.acquire("google") == 0.0
+    assert second.backend.states() == {}
+
+    first.report("google", throttled=True, retry_after=60)
+    # Another process now waits for the Retry-After instead of calling straight away
+    assert second.backend.take(second._wanted("google", None, None), adaptive=True) > 50
+
+
+def test_quota_timeout_when_429s_outlast_retries():
+    def always_limited():
+        raise RateLimited()
+
+    with pytest.raises(QuotaTimeout) as raised:
+        Governor(LocalBackend(), limits={}).call("groq", always_limited, retries=1)
+    assert isinstance(raised.value.__cause__, RateLimited)
+
+
+def test_quota_timeout_when_bucket_stays_empty():
+    limits = load_limits(preset="", overrides='{"groq": {"requests": {"per_minute": 1, "burst": 1}}}')
+    gov = Governor(LocalBackend(), limits=limits, max_wait=0.1)
+    gov.acquire("groq", key="k")
+    with pytest.raises(QuotaTimeout):
+        gov.acquire("groq", key="k")
+
+
+def test_sqlite_rewards_stay_in_memory_until_next_take(tmp_path):
+    limits = load_limits(preset="", overrides='{"groq": {"requests": {"per_minute": 600, "burst": 600}}}')
+    backend = SQLiteBackend(str(tmp_path / "governor.db"))
+    gov = Governor(backend, limits=limits, adaptive=True)
+    name = governor._bucket_name("groq", "k", "requests")
+
+    gov.acquire("groq", key="k")
+    gov.report("groq", key="k", throttled=True, retry_after=0.01)
+    rate = lambda: backend._connect().execute("SELECT rate FROM buckets WHERE name = ?", (name,)).fetchone()[0]
+    throttled_rate = rate()
+    assert throttled_rate == 600 * governor.ADAPTIVE_DECREASE
+
+    for _ in range(5):
+        gov.report("groq", key="k")
+    assert rate() == throttled_rate
+
+    backend.take([(name, 1.0, limits["groq"]["requests"])], adaptive=True)
+    assert rate() == pytest.approx(throttled_rate + 5 * 600 * governor.ADAPTIVE_INCREASE)
+
+
+def test_batcher_passes_quota_timeout_to_every_caller():
+    singles = []
+
+    def send_batch(texts):
+        raise QuotaTimeout("groq quota not available within 120s")
+
+    batcher = LLMBatcher(send_batch, singles.append, max_items=2, max_wait_ms=1000)
+    futures = [batcher.submit("first"), batcher.submit("second")]
+    for future in futures:
+        with pytest.raises(QuotaTimeout):
+            future.result(timeout=5)
+    assert singles == []
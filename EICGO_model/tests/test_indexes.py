@@ -0,0 +1,76 @@
+import fakes
+from indexes import (PENDING_BY_OFFICE, backfill, fetch_pending_posts, fetch_posts_by_phone, index_pending_post,
+                     index_phone_post, office_key_for, unindex_pending_post)
+
+POST_ID = "170000000001"
+
+
+def test_pending_posts_are_one_document_each():
+    db = fakes.FakeFirestore()
+    post = fakes.fake_post(POST_ID)
+    key = office_key_for(post["nearest_post_office"])
+
+    batch = db.batch()
+    index_pending_post(db, batch, POST_ID, post)
+    index_pending_post(db, batch, "170000000003", fakes.fake_post("170000000003"))
+    batch.commit()
+
+    assert (PENDING_BY_OFFICE, key) not in db.docs
+    office, posts = fetch_pending_posts(db, key)
+    assert office["name"] == "Sudama Nagar S.O"
+    assert sorted(p["post_id"] for p in posts) == [POST_ID, "170000000003"]
+
+    batch = db.batch()
+    unindex_pending_post(db, batch, POST_ID, post["nearest_post_office"])
+    batch.commit()
+    assert [p["post_id"] for p in fetch_pending_posts(db, key)[1]] == ["170000000003"]
+
+
+def test_fetch_pending_posts_unknown_office():
+    assert fetch_pending_posts(fakes.FakeFirestore(), "000000_nowhere") == (None, [])
+
+
+def test_backfill_indexes_existing_posts():
+    db = fakes.FakeFirestore()
+    post_ids = fakes.seeded_post_ids(10)
+    for post_id in post_ids:
+        db.docs[("post_details", post_id)] = fakes.fake_post(post_id)
+    db.docs[("post_details", post_ids[0])]["sender_details"] = {"Name": "Sender", "PhoneNumber": "91234 56789"}
+    key = office_key_for(fakes.fake_post(post_ids[0])["nearest_post_office"])
+
+    counts = backfill(db, batch_size=3)
+    assert counts == {"posts": 10, "pending": 5}
+    _, posts = fetch_pending_posts(db, key)
+    assert sorted(p["post_id"] for p in posts) == [p for p in post_ids if int(p) % 2]
+    _, entries, _ = fetch_posts_by_phone(db, "9123456789")
+    assert [(e["post_id"], e["roles"]) for e in entries] == [(post_ids[0], ["sender"])]
+
+
+def test_phone_index_keeps_both_roles():
+    db = fakes.FakeFirestore()
+    batch = db.batch()
+    index_phone_post(db, batch, POST_ID, "98765 43210", "receiver")
+    index_phone_post(db, batch, POST_ID, "+91-9876543210", "sender")
+    index_phone_post(db, batch, "170000000002", "9876543210", "sender")
+    batch.commit()
+
+    phone, entries, cursor = fetch_posts_by_phone(db, "9876543210")
+    assert phone == "+919876543210"
+    assert [(e["post_id"], e["roles"]) for e in entries] == [("170000000002", ["sender"]),
+                                                               (POST_ID, ["receiver", "sender"])]
+    assert cursor is None
+
+
+def test_phone_index_pages_newest_first():
+    db = fakes.FakeFirestore.seeded(20)
+    phone = fakes.fake_post(POST_ID)["receiver_details"]["phone_number"]
+    for post_id, role in (("170000000000", "receiver"), ("170000000005", "sender"), ("170000000009", "sender")):
+        batch = db.batch()
+        index_phone_post(db, batch, post_id, phone, role)
+        batch.commit()
+
+    _, first, cursor = fetch_posts_by_phone(db, phone, limit=2)
+    _, second, last = fetch_posts_by_phone(db, phone, limit=2, cursor=cursor)
+    assert [e["post_id"] for e in first + second] == ["170000000009", "170000000005", POST_ID, "170000000000"]
+    assert second[-1]["roles"] == ["receiver"]
+    assert last is None
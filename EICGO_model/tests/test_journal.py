@@ -0,0 +1,146 @@
+import pytest
+
+import fakes
+import journal
+from journal import PostJournal
+from tracking import ScanEventBuffer, parse_scan_event
+
+POST_ID = "180000000001"
+
+
+def receiver_post():
+    post = fakes.fake_post(POST_ID)
+    post["isDelivered"] = False
+    return post
+
+
+def pending_docs(db):
+    return [path for path in db.docs if path[0] == "pending_by_office" and path[-1] == POST_ID]
+
+
+def expire_leases(pj):
+    pj._connect().execute("UPDATE entries SET lease_until = 0, next_attempt_at = 0")
+
+
+@pytest.fixture
+def pj(tmp_path):
+    return PostJournal(str(tmp_path / "journal.db"))
+
+
+def test_flush_writes_post_and_indexes(pj):
+    db = fakes.FakeFirestore()
+    pj.append("receiver_post", POST_ID, receiver_post())
+    pj.append("sender_details", POST_ID, {"Name": "Sender", "PhoneNumber": "9876543210"})
+
+    assert pj.flush_once(db) == 2
+    assert pj.pending() == 0
+    assert db.docs[("post_details", POST_ID)]["sender_details"]["Name"] == "Sender"
+    assert pending_docs(db)
+
+
+def test_replay_after_delivery_does_not_reset_post(pj, monkeypatch):
+    db = fakes.FakeFirestore()
+    pj.append("receiver_post", POST_ID, receiver_post())
+
+    # The commit reaches Firestore but the process dies before removing the entry
+    with monkeypatch.context() as m:
+        m.setattr(pj, "_done", lambda rows: None)
+        pj.flush_once(db)
+    assert pj.pending() == 1
+
+    scans = ScanEventBuffer(lambda: db)
+    post_id, event, delivered = parse_scan_event({"post_id": POST_ID, "location": "Sudama Nagar S.O", "status": "Delivered"})
+    scans.submit(post_id, event, delivered)
+    scans.flush()
+    assert not pending_docs(db)
+
+    expire_leases(pj)
+    assert pj.flush_once(db) == 1
+    post = db.docs[("post_details", POST_ID)]
+    assert post["isDelivered"] is True
+    assert [e["status"] for e in post["events"]] == ["Post Received", "Delivered"]
+    assert not pending_docs(db)
+    assert pj.pending() == 0
+
+
+def test_receiver_post_replayed_after_sender_details(pj, monkeypatch):
+    db = fakes.FakeFirestore()
+    pj.append("receiver_post", POST_ID, receiver_post())
+    pj.append("sender_details", POST_ID, {"Name": "Sender", "PhoneNumber": "9876543210"})
+
+    def unavailable(*args):
+        raise RuntimeError("Firestore unavailable")
+
+    # The receiver write fails and backs off; the sender merge goes through and creates the doc
+    with monkeypatch.context() as m:
+        m.setitem(journal.HANDLERS, "receiver_post", (unavailable, 4))
+        assert pj.flush_once(db) == 1
+    assert ("post_details", POST_ID) in db.docs
+    assert "receiver_details" not in db.docs[("post_details", POST_ID)]
+
+    expire_leases(pj)
+    assert pj.flush_once(db) == 1
+    post = db.docs[("post_details", POST_ID)]
+    assert post["receiver_details"] == receiver_post()["receiver_details"]
+    assert post["sender_details"]["Name"] == "Sender"
+    assert post["isDelivered"] is False
+    assert pending_docs(db)
+    assert pj.pending() == 0
+
+
+def test_receiver_post_replay_keeps_scanned_delivery(pj):
+    db = fakes.FakeFirestore()
+    # A delivery scan and the sender details landed before the receiver entry
+    db.docs[("post_details", POST_ID)] = {"sender_details": {"Name": "Sender"}, "isDelivered": True,
+                                          "events": [{"status": "Delivered"}]}
+    pj.append("receiver_post", POST_ID, receiver_post())
+
+    assert pj.flush_once(db) == 1
+    post = db.docs[("post_details", POST_ID)]
+    assert post["receiver_details"] == receiver_post()["receiver_details"]
+    assert post["isDelivered"] is True
+    assert post["events"] == [{"status": "Delivered"}]
+    assert not pending_docs(db)
+
+
+def test_create_conflict_is_retried_then_skipped(pj):
+    db = fakes.FakeFirestore()
+    pj.append("receiver_post", POST_ID, receiver_post())
+    # Another writer stores the post between the existence check and the commit
+    original = journal._existing_posts
+    journal._existing_posts = lambda db, rows: set()
+    try:
+        db.docs[("post_details", POST_ID)] = dict(receiver_post(), isDelivered=True)
+        assert pj.flush_once(db) == 0
+    finally:
+        journal._existing_posts = original
+
+    expire_leases(pj)
+    assert pj.flush_once(db) == 1
+    assert db.docs[("post_details", POST_ID)]["isDelivered"] is True
+
+
+class BrokenFirestore(fakes.FakeFirestore):
+    def batch(self):
+        batch = super().batch()
+        batch.commit = lambda: (_ for _ in ()).throw(RuntimeError("Firestore unavailable"))
+        return batch
+
+
+def test_entries_past_max_attempts_move_to_dead_letters(pj, monkeypatch):
+    monkeypatch.setattr(journal, "MAX_ATTEMPTS", 3)
+    db = BrokenFirestore()
+    entry_id = pj.append("sender_details", POST_ID, {"Name": "Sender"})
+
+    for _ in range(3):
+        assert pj.flush_once(db) == 0
+        expire_leases(pj)
+
+    assert pj.pending() == 0
+    dead = pj.dead_letters()
+    assert [(d["id"], d["attempts"], d["last_error"]) for d in dead] == [(entry_id, 3, "Firestore unavailable")]
+    assert pj.metrics()["dead_letters"] == 1
+
+    assert pj.requeue() == 1
+    assert pj.dead_letters() == []
+    assert pj.flush_once(fakes.FakeFirestore()) == 1
@@ -0,0 +1,56 @@
+import json
+
+from llm_batcher import LLMBatcher, matches_text, parse_batch_reply
+
+TEXTS = [
+    "Ramesh Kumar 5 A Parshwanath Nagar Indore (M.P) 452009 Mob 98765 43210",
+    "Sunita Sharma 12 MG Road Bhopal 462001 Ph +91 91234 56789",
+    "Anil Verma Flat 3 Civil Lines Jaipur 302006",
+]
+RESULTS = [
+    {"Name": "Ramesh Kumar", "PhoneNumber": "9876543210", "Address": "5 A Parshwanath Nagar Indore", "Pincode": "452009"},
+    {"Name": "Sunita Sharma", "PhoneNumber": "+91 9123456789", "Address": "12 MG Road Bhopal", "Pincode": "462001"},
+    {"Name": "Anil Verma", "PhoneNumber": None, "Address": "Flat 3 Civil Lines Jaipur", "Pincode": "302006"},
+]
+
+
+def reply(*items):
+    return "Here you go:\n" + json.dumps([dict(item, index=index) for index, item in items])
+
+
+def test_matches_text_needs_pincode_phone_and_name():
+    assert matches_text(RESULTS[0], TEXTS[0])
+    assert matches_text(RESULTS[1], TEXTS[1])  # Country code and spaces are ignored
+    assert not matches_text(RESULTS[0], TEXTS[1])
+    assert not matches_text(dict(RESULTS[2], Name="Rita Jain"), TEXTS[2])  # Same pincode, other envelope
+    assert not matches_text({"Address": "somewhere"}, TEXTS[0])
+
+
+def test_correct_reply_is_used_as_is():
+    results = parse_batch_reply(reply(*enumerate(RESULTS)), TEXTS)
+    assert results == {i: result for i, result in enumerate(RESULTS)}
+
+
+def test_shuffled_indexes_are_matched_by_content():
+    # The LLM answered in order but numbered the first two answers the wrong way round
+    results = parse_batch_reply(reply((1, RESULTS[0]), (0, RESULTS[1]), (2, RESULTS[2])), TEXTS)
+    assert results == {0: RESULTS[0], 1: RESULTS[1], 2: RESULTS[2]}
+
+
+def test_mismatched_item_falls_back_to_a_single_call():
+    wrong = dict(RESULTS[1], Name="Someone Else", PhoneNumber="9000000000", Pincode="110001")
+    results = parse_batch_reply(reply((0, RESULTS[0]), (1, wrong), (2, RESULTS[2])), TEXTS)
+    assert results == {0: RESULTS[0], 2: RESULTS[2]}
+
+    singles = []
+
+    def single(text):
+        singles.append(text)
+        return RESULTS[TEXTS.index(text)]
+
+    batcher = LLMBatcher(lambda texts: reply((0, RESULTS[0]), (1, wrong), (2, RESULTS[2])), single,
+                         max_items=3, max_wait_ms=1000)
+    futures = [batcher.submit(text) for text in TEXTS]
+    assert [future.result(timeout=5) for future in futures] == RESULTS
+    assert singles == [TEXTS[1]]
+    assert batcher.stats["batched_items"] == 2 and batcher.stats["fallback_items"] == 1
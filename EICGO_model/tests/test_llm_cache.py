@@ -0,0 +1,57 @@
+import time
+
+import pytest
+
+import llm_cache
+from llm_cache import LLMCache, cache_key
+
+MODEL = "llama-3.3-70b-versatile"
+PROMPT = "Identify Address, Pincode, Phone Number, and Name if present."
+TEXT = "Ramesh Kumar 5 A Parshwanath Nagar Indore 452009 9876543210"
+RESULT = {"Name": "Ramesh Kumar", "PhoneNumber": "9876543210", "Address": "5 A Parshwanath Nagar Indore", "Pincode": "452009"}
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return LLMCache(str(tmp_path / "llm_cache.db"), flush_seconds=3600)
+
+
+def counters(cache):
+    return dict(cache._connect().execute("SELECT name, value FROM counters WHERE name != 'pruned_at'").fetchall())
+
+
+def test_lookups_do_not_write_until_flush(cache):
+    cache.put(TEXT, MODEL, PROMPT, RESULT)
+    for _ in range(3):
+        assert cache.get(TEXT, MODEL, PROMPT) == RESULT
+    assert cache.get("Someone Else 1 Main Road Pune 411001", MODEL, PROMPT) is None
+    assert counters(cache) == {}
+
+    metrics = cache.metrics()  # Flushes first
+    assert metrics["all_processes"] == {"memory_hits": 3, "disk_hits": 0, "misses": 1, "stores": 1}
+    assert counters(cache) == {"memory_hits": 3, "misses": 1, "stores": 1}
+
+
+def test_disk_hits_update_last_used_on_flush(cache, tmp_path):
+    cache.put(TEXT, MODEL, PROMPT, RESULT)
+    other = LLMCache(str(tmp_path / "llm_cache.db"), flush_seconds=3600)
+    key = cache_key(TEXT, MODEL, PROMPT)
+    before = other._connect().execute("SELECT last_used, hits FROM entries WHERE key = ?", (key,)).fetchone()
+
+    assert other.get(TEXT, MODEL, PROMPT) == RESULT
+    assert other._connect().execute("SELECT hits FROM entries WHERE key = ?", (key,)).fetchone()[0] == before[1]
+
+    other.flush()
+    last_used, hits = other._connect().execute("SELECT last_used, hits FROM entries WHERE key = ?", (key,)).fetchone()
+    assert hits == before[1] + 1
+    assert last_used >= before[0]
+
+
+def test_expired_entries_are_not_served_and_are_pruned(cache, monkeypatch):
+    cache.put(TEXT, MODEL, PROMPT, RESULT)
+    later = time.time() + cache.ttl + 60
+    monkeypatch.setattr(llm_cache.time, "time", lambda: later)
+
+    assert cache.get(TEXT, MODEL, PROMPT) is None
+    cache.prune()
+    assert cache._connect().execute("SELECT COUNT(*) FROM entries").fetchone()[0] == 0
@@ -0,0 +1,83 @@
+import io
+import os
+import time
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import retention
+from retention import archive_scans, read_archived, reencode_scan
+
+DAY = 86400
+
+
+def noise(fmt, **options):
+    pixels = np.random.default_rng(7).integers(0, 256, size=(256, 256, 3), dtype=np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(pixels, "RGB").save(buffer, fmt, **options)
+    return buffer.getvalue()
+
+
+def write_scan(directory, name, data, age_days, now):
+    path = os.path.join(directory, name)
+    with open(path, "wb") as f:
+        f.write(data)
+    os.utime(path, (now - age_days * DAY, now - age_days * DAY))
+    return path
+
+
+@pytest.fixture
+def policy(tmp_path):
+    scans = tmp_path / "scanned_posts"
+    scans.mkdir()
+    return dict(retention.load_policy(), scan_dirs=[str(scans)], qr_dirs=[], archive_dir=str(tmp_path / "archive"))
+
+
+def test_archived_scans_read_back_from_bundle(policy):
+    now = time.time()
+    scans = policy["scan_dirs"][0]
+    first = noise("JPEG", quality=50)
+    write_scan(scans, "1733292766650_front.jpg", first, 40, now)
+    report = {"errors": []}
+    assert archive_scans(policy, now, report=report)["files"] == 1
+
+    # A late scan of the same day is appended to the same bundle
+    second = noise("PNG")
+    write_scan(scans, "1733292766650_rear.png", second, 40, now)
+    section = archive_scans(policy, now, report=report)
+    assert report["errors"] == []
+    assert len(set(section["bundles"])) == 1
+    assert os.listdir(scans) == []
+
+    label = retention._dir_label(scans)
+    assert read_archived(f"{label}/1733292766650_front.jpg", policy["archive_dir"]) == first
+    assert read_archived(f"{label}/1733292766650_rear.png", policy["archive_dir"]) == second
+    with pytest.raises(KeyError):
+        read_archived(f"{label}/missing.jpg", policy["archive_dir"])
+
+
+def test_scans_are_reencoded_only_when_smaller(policy):
+    now = time.time()
+    scans = policy["scan_dirs"][0]
+    png = write_scan(scans, "large.png", noise("PNG"), 10, now)
+    jpeg = write_scan(scans, "small.jpg", noise("JPEG", quality=5), 10, now)
+
+    target = reencode_scan(png, policy["webp_quality"], policy["max_side"])
+    assert target == os.path.join(scans, "large.webp")
+    assert not os.path.exists(png)
+    assert os.path.getmtime(target) == pytest.approx(now - 10 * DAY)
+
+    # WebP would be larger than this heavily compressed JPEG, so it is kept as is
+    assert reencode_scan(jpeg, policy["webp_quality"], policy["max_side"]) is None
+    assert sorted(os.listdir(scans)) == ["large.webp", "small.jpg"]
+
+
+def test_default_dirs_do_not_depend_on_cwd(tmp_path, monkeypatch):
+    for name in ("RETENTION_SCAN_DIRS", "RETENTION_QR_DIRS", "RETENTION_ARCHIVE_DIR"):
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.chdir(tmp_path)
+    policy = retention.load_policy()
+    assert policy["scan_dirs"][0] == os.path.join(retention.MODULE_DIR, "scanned_posts")
+    assert policy["qr_dirs"][1] == os.path.join(os.path.dirname(retention.MODULE_DIR), "QR")
+    assert retention._dir_label(policy["scan_dirs"][1]) == "parent_scanned_posts"
@@ -0,0 +1,92 @@
+import itertools
+
+import numpy as np
+import pytest
+
+from routing import (haversine_matrix, nearest_neighbour_tour, optimise_order, plan_delivery_route,
+                     split_into_beats, tour_length, two_opt)
+
+DEPOT = (22.70, 75.85)
+
+
+def test_haversine_matrix():
+    dist = haversine_matrix([22.70, 22.71], [75.85, 75.85])
+    assert dist.shape == (2, 2)
+    assert dist[0, 0] == 0.0
+    assert dist[0, 1] == pytest.approx(1.112, abs=0.01)  # 0.01 degree of latitude
+    assert dist[0, 1] == dist[1, 0]
+
+
+def test_two_opt_removes_crossing():
+    # Corners of a square visited in crossing order 0 -> 2 -> 1 -> 3
+    points = np.array([(0.0, 0.0), (0.0, 0.01), (0.01, 0.0), (0.01, 0.01)])
+    dist = haversine_matrix(points[:, 0], points[:, 1])
+    crossing = [0, 2, 1, 3, 0]
+
+    tour = two_opt(crossing, dist)
+    assert tour[0] == tour[-1] == 0
+    assert sorted(tour[:-1]) == [0, 1, 2, 3]
+    assert tour_length(tour, dist) < tour_length(crossing, dist)
+    assert tour_length(tour, dist) == pytest.approx(4 * 1.112, abs=0.01)
+
+
+def test_optimise_order_matches_brute_force():
+    rng = np.random.default_rng(7)
+    stops = [tuple(p) for p in np.asarray(DEPOT) + rng.uniform(-0.02, 0.02, size=(7, 2))]
+
+    order, km = optimise_order(DEPOT, stops)
+    assert sorted(order) == list(range(len(stops)))
+
+    points = np.array([DEPOT] + stops)
+    dist = haversine_matrix(points[:, 0], points[:, 1])
+    best = min(tour_length([0] + [k + 1 for k in perm] + [0], dist)
+               for perm in itertools.permutations(range(len(stops))))
+    assert km <= best * 1.05
+
+
+def test_open_path_does_not_return_to_depot():
+    # Stops on a line heading away from the depot: the open path just walks outwards
+    stops = [(DEPOT[0] + 0.01 * k, DEPOT[1]) for k in (3, 1, 2)]
+
+    order, km = optimise_order(DEPOT, stops, return_to_start=False)
+    assert order == [1, 2, 0]
+    assert km == pytest.approx(3 * 1.112, abs=0.01)
+
+    _, closed_km = optimise_order(DEPOT, stops, return_to_start=True)
+    assert closed_km == pytest.approx(2 * km, abs=0.01)
+
+
+def test_nearest_neighbour_visits_every_node():
+    points = np.random.default_rng(1).uniform(0, 0.1, size=(20, 2))
+    tour = nearest_neighbour_tour(haversine_matrix(points[:, 0], points[:, 1]))
+    assert tour[0] == 0
+    assert sorted(tour) == list(range(20))
+
+
+def test_split_into_beats_groups_by_direction():
+    north = [(DEPOT[0] + 0.01 * k, DEPOT[1] + 0.001 * k) for k in range(1, 4)]
+    south = [(DEPOT[0] - 0.01 * k, DEPOT[1] - 0.001 * k) for k in range(1, 4)]
+    groups = split_into_beats(DEPOT, north + south, beats=2)
+
+    assert sorted(sorted(group) for group in groups) == [[0, 1, 2], [3, 4, 5]]
+
+
+def test_split_into_beats_edge_cases():
+    assert split_into_beats(DEPOT, [(22.71, 75.85)], beats=3) == [[0]]
+    assert split_into_beats(DEPOT, [(22.71, 75.85), (22.69, 75.85)], beats=1) == [[0, 1]]
+    assert len(split_into_beats(DEPOT, [(22.71, 75.85), (22.69, 75.85)], beats=5)) == 2
+
+
+def test_plan_delivery_route():
+    office = {"name": "Sudama Nagar S.O", "pincode": 452009, "latitude": DEPOT[0], "longitude": DEPOT[1]}
+    posts = [{"post_id": str(k), "latitude": DEPOT[0] + 0.01 * k, "longitude": DEPOT[1], "name": f"R{k}"}
+             for k in range(1, 5)]
+    posts.append({"post_id": "no-location", "latitude": None, "longitude": None})
+
+    route = plan_delivery_route(office, posts, beats=2, return_to_start=False)
+    assert route["total_stops"] == 4
+    assert len(route["beats"]) == 2
+    visited = [stop["post_id"] for beat in route["beats"] for stop in beat["stops"]]
+    assert sorted(visited) == ["1", "2", "3", "4"]
+    assert [stop["sequence"] for stop in route["beats"][0]["stops"]] == [1, 2]
+    assert route["total_distance_km"] == pytest.approx(sum(b["distance_km"] for b in route["beats"]), abs=0.01)
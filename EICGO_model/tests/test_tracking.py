@@ -0,0 +1,65 @@
+import pytest
+
+import fakes
+from tracking import ScanEventBuffer, delivery_cache, parse_scan_event
+
+POST_ID = "170000000001"  # Seeded as undelivered
+
+
+def submit(buffer, raw):
+    post_id, event, delivered = parse_scan_event(raw)
+    return buffer.submit(post_id, event, delivered)
+
+
+def test_identical_scans_are_both_recorded():
+    db = fakes.FakeFirestore.seeded(4)
+    buffer = ScanEventBuffer(lambda: db)
+    raw = {"post_id": POST_ID, "location": "Indore hub", "status": "In transit", "timestamp": "2025-04-12T10:00:00"}
+    futures = [submit(buffer, raw), submit(buffer, raw)]
+    buffer.flush()
+
+    assert all(future.result(timeout=1) for future in futures)
+    events = db.docs[("post_details", POST_ID)]["events"]
+    assert [event["location"] for event in events[1:]] == ["Indore hub", "Indore hub"]
+
+
+def test_retried_scan_is_recorded_once():
+    db = fakes.FakeFirestore.seeded(4)
+    buffer = ScanEventBuffer(lambda: db)
+    raw = {"post_id": POST_ID, "location": "Indore hub", "status": "In transit", "scan_id": "hub-7-0001"}
+    submit(buffer, raw)
+    buffer.flush()
+    submit(buffer, raw)
+    buffer.flush()
+
+    assert len(db.docs[("post_details", POST_ID)]["events"]) == 2
+    assert buffer.stats["commits"] == 2
+
+
+def test_delivery_is_cached_and_unindexed():
+    db = fakes.FakeFirestore.seeded(4)
+    buffer = ScanEventBuffer(lambda: db)
+    delivery_cache.pop(POST_ID, None)
+    future = submit(buffer, {"post_id": POST_ID, "location": "Sudama Nagar S.O", "status": "Delivered"})
+    buffer.flush()
+
+    assert future.result(timeout=1)
+    assert db.docs[("post_details", POST_ID)]["isDelivered"] is True
+    assert delivery_cache.get(POST_ID) is True
+    assert not [path for path in db.docs if path[0] == "pending_by_office" and path[-1] == POST_ID]
+
+
+@pytest.mark.parametrize("timestamp", [1e20, -1e20, float("nan")])
+def test_out_of_range_timestamp_is_a_validation_error(timestamp):
+    with pytest.raises(ValueError):
+        parse_scan_event({"post_id": POST_ID, "location": "Indore hub", "status": "In transit", "timestamp": timestamp})
+
+
+def test_close_writes_buffered_events():
+    db = fakes.FakeFirestore.seeded(4)
+    buffer = ScanEventBuffer(lambda: db, flush_interval_ms=60000)
+    future = submit(buffer, {"post_id": POST_ID, "location": "Indore hub", "status": "In transit"})
+    buffer.close()
+
+    assert future.result(timeout=1)
+    assert db.docs[("post_details", POST_ID)]["events"][-1]["location"] == "Indore hub"
@@ -0,0 +1,71 @@
+import io
+import os
+
+import numpy as np
+import pytest
+from PIL import Image
+from werkzeug.datastructures import FileStorage, MultiDict
+
+import uploads
+from dedup import PerceptualIndex
+
+
+def jpeg(seed):
+    pixels = np.random.default_rng(seed).integers(0, 256, size=(12, 16), dtype=np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(pixels, "L").resize((320, 240)).save(buffer, "JPEG")
+    return buffer.getvalue()
+
+
+def photo(seed, filename="photo1.jpg"):
+    return FileStorage(io.BytesIO(jpeg(seed)), filename=filename)
+
+
+@pytest.fixture
+def index(tmp_path, monkeypatch):
+    monkeypatch.setattr(uploads, "UPLOAD_FOLDER", str(tmp_path))
+    return PerceptualIndex(path=str(tmp_path / ".phash_index.db"))
+
+
+def test_same_client_filename_gets_distinct_paths(index):
+    form = MultiDict({"id1": "a", "id2": "b"})
+    _, _, first, first_key = uploads.accept_photos(form, {"photo1": photo(1), "photo2": photo(2, "photo2.jpg")}, index)
+    _, _, second, second_key = uploads.accept_photos(form, {"photo1": photo(3), "photo2": photo(4, "photo2.jpg")}, index)
+
+    paths = list(first.values()) + list(second.values())
+    assert len(set(paths)) == 4 and all(os.path.exists(path) for path in paths)
+    assert first_key == first["1"] and second_key == second["1"]
+    assert os.path.basename(first["1"]) != "photo1.jpg"
+
+
+def test_duplicate_removes_only_its_own_file(index):
+    form = MultiDict({"id1": "a"})
+    _, _, first, _ = uploads.accept_photos(form, {"photo1": photo(1)}, index)
+    status, response, second, key = uploads.accept_photos(form, {"photo1": photo(1)}, index)
+
+    assert status == 200 and response["duplicate"] and response["pending"]
+    assert second == {} and key is None
+    assert os.path.exists(first["1"])
+    assert [name for name in os.listdir(uploads.UPLOAD_FOLDER) if not name.startswith(".")] == [os.path.basename(first["1"])]
+
+
+def test_force_skips_the_duplicate_check(index):
+    uploads.accept_photos(MultiDict({"id1": "a"}), {"photo1": photo(1)}, index)
+    _, response, photos, key = uploads.accept_photos(MultiDict({"id1": "a", "force": "1"}), {"photo1": photo(1)}, index)
+    assert "1" in photos and key is None and "duplicate" not in response
+
+
+def test_missing_ids_and_batch_photo(index):
+    _, response, photos, _ = uploads.accept_photos(MultiDict(), {"photo1": photo(1)}, index)
+    assert photos == {}
+    assert response["uploads"][0] == {"error": "Missing id1 for photo1"}
+
+    assert uploads.accept_batch_photo({})[0] == 400
+    status, response, path = uploads.accept_batch_photo({"photo": photo(5, "frame.png")})
+    assert status == 200 and path.endswith(".png") and os.path.exists(path)
+
+
+def test_upload_path_keeps_only_a_plain_extension(index):
+    assert uploads.upload_path("../../etc/passwd").endswith(".jpg")
+    assert uploads.upload_path("scan.JPEG").endswith(".jpeg")
+    assert os.path.dirname(uploads.upload_path("photo1.jpg")) == uploads.UPLOAD_FOLDER
@@ -0,0 +1,191 @@
+import os
+import time
+import uuid
+import threading
+from datetime import datetime
+from concurrent.futures import Future
+
+from cachetools import TTLCache
+from firebase_admin import firestore
+
+from indexes import unindex_pending_post
+
+# Ingestion of transit events from hub QR scans.
+# Scans are coalesced in memory for up to FLUSH_INTERVAL_MS (or FLUSH_MAX_EVENTS
+# events) and applied per post as one ArrayUnion append, with one get_all and
+# one batch commit per group of up to BATCH_LIMIT posts. Every event carries a
+# scan_id, so two identical scans stay two events while a retried scan (same
+# scan_id) is still only appended once. Scans acknowledged but not yet written
+# are flushed by close() when the worker exits (gunicorn worker_exit / atexit).
+
+FLUSH_INTERVAL_MS = int(os.getenv("SCAN_FLUSH_INTERVAL_MS", 250))
+FLUSH_MAX_EVENTS = int(os.getenv("SCAN_FLUSH_MAX_EVENTS", 400))
+BATCH_LIMIT = 450  # Firestore allows 500 writes per batch; index updates need room too
+MAX_ATTEMPTS = 3
+
+DELIVERED_STATUSES = {"delivered", "post delivered"}
+
+# post_ids known to be delivered, read by /check_delivery and filled by the flusher.
+# Delivery is final, so only True is ever cached: an undelivered post is always
+# read from Firestore and another worker's delivery scan is seen at once.
+delivery_cache = TTLCache(maxsize=int(os.getenv("DELIVERY_CACHE_SIZE", 50000)),
+                          ttl=int(os.getenv("DELIVERY_CACHE_TTL", 60)))
+delivery_cache_lock = threading.Lock()
+
+
+# Function to validate one scan and convert it to the stored event format
+def parse_scan_event(raw):
+    if not isinstance(raw, dict):
+        raise ValueError("event must be an object")
+    post_id = str(raw.get("post_id") or "").strip()
+    location = str(raw.get("location") or "").strip()
+    status = str(raw.get("status") or "").strip()
+    if not post_id or not location or not status:
+        raise ValueError("post_id, location and status are required")
+
+    timestamp = raw.get("timestamp")
+    if timestamp is None:
+        scanned_at = datetime.now()
+    elif isinstance(timestamp, (int, float)):
+        try:
+            scanned_at = datetime.fromtimestamp(timestamp / 1000 if timestamp > 1e11 else timestamp)
+        except (OverflowError, OSError, ValueError):
+            raise ValueError("timestamp is out of range")
+    else:
+        try:
+            scanned_at = datetime.fromisoformat(str(timestamp))
+        except ValueError:
+            raise ValueError("timestamp must be ISO 8601 or epoch seconds/milliseconds")
+
+    delivered = bool(raw.get("isDelivered")) or status.lower() in DELIVERED_STATUSES
+    event = {
+        "scan_id": str(raw.get("scan_id") or uuid.uuid4().hex),
+        "date": scanned_at.strftime("%Y-%m-%d"),
+        "time": scanned_at.strftime("%I:%M %p"),
+        "location": location,
+        "status": status,
+        "timestamp": scanned_at.isoformat(timespec="seconds"),
+    }
+    return post_id, event, delivered
+
+
+class ScanEventBuffer:
+    def __init__(self, get_db, flush_interval_ms=FLUSH_INTERVAL_MS, flush_max_events=FLUSH_MAX_EVENTS):
+        self._get_db = get_db
+        self._interval = flush_interval_ms / 1000
+        self._max_events = flush_max_events
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._pending = []  # (post_id, event, delivered, future, attempts)
+        self._thread = None
+        self.stats = {"events": 0, "flushes": 0, "commits": 0, "unknown_posts": 0, "failures": 0}
+
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="scan-event-flusher", daemon=True)
+            self._thread.start()
+
+    def submit(self, post_id, event, delivered=False):
+        future = Future()
+        with self._lock:
+            self._pending.append((post_id, event, delivered, future, 0))
+            self.stats["events"] += 1
+            self._ensure_thread()
+            if len(self._pending) >= self._max_events:
+                self._wakeup.set()
+        return future
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def close(self):
+        """Write out everything still buffered, e.g. when the worker exits."""
+        for _ in range(MAX_ATTEMPTS):
+            self.flush()
+            with self._lock:
+                left = len(self._pending)
+            if not left:
+                return
+        print(f"{left} scan events could not be written before exit")
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self._interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, []
+        if not pending:
+            return
+        self._count("flushes")
+
+        # Coalesce: one append per post, in scan order
+        by_post = {}
+        for item in pending:
+            by_post.setdefault(item[0], []).append(item)
+
+        post_ids = list(by_post)
+        for start in range(0, len(post_ids), BATCH_LIMIT // 2):
+            group = {post_id: by_post[post_id] for post_id in post_ids[start:start + BATCH_LIMIT // 2]}
+            try:
+                self._commit_group(group)
+            except Exception as e:
+                print(f"Error committing scan events: {e}")
+                self._count("failures")
+                self._retry(group, e)
+
+    def _commit_group(self, group):
+        db = self._get_db()
+        refs = [db.collection("post_details").document(post_id) for post_id in group]
+        snapshots = {snapshot.id: snapshot for snapshot in db.get_all(refs)}
+
+        batch = db.batch()
+        delivered_posts = []
+        applied = []
+        for ref, (post_id, items) in zip(refs, group.items()):
+            snapshot = snapshots.get(post_id)
+            if snapshot is None or not snapshot.exists:
+                self._count("unknown_posts")
+                for item in items:
+                    item[3].set_exception(KeyError(f"No post found with post_id {post_id}"))
+                continue
+
+            update = {
+                "events": firestore.ArrayUnion([item[1] for item in items]),
+                "updated_at": datetime.now(),
+            }
+            if any(item[2] for item in items):
+                update["isDelivered"] = True
+                data = snapshot.to_dict()
+                if not data.get("isDelivered"):
+                    unindex_pending_post(db, batch, post_id, data.get("nearest_post_office"))
+                delivered_posts.append(post_id)
+            batch.update(ref, update)
+            applied.append(items)
+
+        if not applied:
+            return
+        batch.commit()
+        self._count("commits")
+
+        with delivery_cache_lock:
+            for post_id in delivered_posts:
+                delivery_cache[post_id] = True
+        for items in applied:
+            for item in items:
+                item[3].set_result(True)
+
+    def _retry(self, group, error):
+        with self._lock:
+            for items in group.values():
+                for post_id, event, delivered, future, attempts in items:
+                    if future.done():
+                        continue
+                    if attempts + 1 >= MAX_ATTEMPTS:
+                        future.set_exception(error)
+                    else:
+                        self._pending.append((post_id, event, delivered, future, attempts + 1))
+        time.sleep(min(self._interval * 4, 2.0))
@@ -0,0 +1,114 @@
+import os
+import re
+import uuid
+import threading
+
+from dedup import PerceptualIndex
+
+# Photos uploaded by the scanning app. server.py (Flask) and async_pipeline.py
+# (ASGI) both hand their parsed form to accept_photos / accept_batch_photo, so
+# saving, naming and the duplicate check behave the same behind either one.
+# Files are werkzeug FileStorage objects in both cases.
+
+UPLOAD_FOLDER = "scanned_posts"
+os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+
+_EXTENSION = re.compile(r"\.[a-z0-9]{1,5}")
+
+_dedup_index = None
+_dedup_index_lock = threading.Lock()
+
+
+# Function to get the perceptual-hash index of recent front scans, used to catch re-photographed envelopes
+def get_dedup_index():
+    global _dedup_index
+    with _dedup_index_lock:
+        if _dedup_index is None:
+            _dedup_index = PerceptualIndex(path=os.path.join(UPLOAD_FOLDER, ".phash_index.db"))
+        return _dedup_index
+
+
+# Function to pick where an upload is saved. Every phone sends "photo1.jpg", so the
+# client filename only contributes its extension and the name is a fresh uuid.
+def upload_path(filename):
+    extension = os.path.splitext(filename or "")[1].lower()
+    if not _EXTENSION.fullmatch(extension):
+        extension = ".jpg"
+    return os.path.join(UPLOAD_FOLDER, f"{uuid.uuid4().hex}{extension}")
+
+
+def save_upload(upload):
+    path = upload_path(upload.filename)
+    upload.save(path)
+    return path
+
+
+# Function to save the photos of one envelope and check the front against recent scans.
+# Returns (status, response, photos, dedup_key); photos ({"1": path, "2": path}) is empty
+# when there is nothing to process, and dedup_key must be assigned or discarded afterwards.
+def accept_photos(form, files, index=None):
+    if index is None:
+        index = get_dedup_index()
+    photos = {}
+    responses = []
+    dedup_key = None
+
+    # Check and process 'photo1' and 'id1'
+    if "photo1" in files:
+        if not form.get('id1'):
+            print("Missing id1 for photo1")
+            responses.append({"error": "Missing id1 for photo1"})
+        else:
+            photo1_path = save_upload(files['photo1'])
+            print(f"Saved photo1 at: {photo1_path}")
+
+            # Skip OCR/LLM/QR/SMS if this envelope was already scanned recently
+            if form.get('force') != '1':
+                try:
+                    duplicate = index.check_and_add(photo1_path, key=photo1_path)
+                except Exception as e:
+                    print(f"Error hashing photo1: {e}")
+                    duplicate = None
+                if duplicate:
+                    duplicate_post_id, distance = duplicate
+                    print(f"photo1 looks like a duplicate of post_id={duplicate_post_id or 'pending'} (distance {distance})")
+                    os.remove(photo1_path)
+                    return 200, {
+                        "message": "Duplicate scan detected",
+                        "duplicate": True,
+                        "post_id": duplicate_post_id or None,
+                        "pending": not duplicate_post_id,
+                        "distance": distance,
+                    }, {}, None
+                dedup_key = photo1_path
+
+            photos['1'] = photo1_path
+            responses.append({"message": "photo1 uploaded successfully", "photo1_path": photo1_path})
+    else:
+        print("No photo1 part in the request")
+        responses.append({"error": "No photo1 part in the request"})
+
+    # Check and process 'photo2' and 'id2' if present
+    if "photo2" in files:
+        if not form.get('id2'):
+            print("Missing id2 for photo2")
+            responses.append({"error": "Missing id2 for photo2"})
+        else:
+            photo2_path = save_upload(files['photo2'])
+            photos['2'] = photo2_path
+            print(f"Saved photo2 at: {photo2_path}")
+            responses.append({"message": "photo2 uploaded successfully", "photo2_path": photo2_path})
+    else:
+        print("No photo2 part in the request")
+        responses.append({"error": "No photo2 part in the request"})
+
+    return 200, {"message": "Photos uploaded successfully", "uploads": responses}, photos, dedup_key
+
+
+# Function to save one photo of several envelopes; returns (status, response, photo_path)
+def accept_batch_photo(files):
+    if "photo" not in files:
+        return 400, {"error": "No photo part in the request"}, None
+    photo_path = save_upload(files['photo'])
+    print(f"Saved batch photo at: {photo_path}")
+    return 200, {"message": "Batch photo uploaded successfully", "photo_path": photo_path}, photo_path
@@ -0,0 +1,20 @@
+import os
+import sys
+
+# WSGI entry point for gunicorn (see gunicorn.conf.py). Run from EICGO_model/
+# or with --chdir so the relative scanned_posts/ and QR/ folders resolve.
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from server import app, init_clients, scan_events
+
+
+def init_worker():
+    init_clients()
+
+
+def shutdown_worker():
+    # Scan events acknowledged with 202 may still be buffered in this worker
+    scan_events.close()
+
+
+application = app